@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+"""
+Benchmark serving converted audio with sendfile and with chunks read into Python.
+
+A 100 MB file of random bytes stands in for a converted episode in ``./audio`` of a
+temporary directory. For every mode a fresh server process serves it through the
+AudioHandler while this process downloads it with 200 concurrent range requests, each
+for a random range of 10 MiB, discarding the bodies. Reported are the wall time, the
+aggregate throughput and the CPU time the server process used. "chunks" reads the file
+in 1 MiB chunks and writes them through Tornado, "sendfile" uses os.sendfile.
+
+Every request opens a new connection, so the cost of sendfile closing the connection
+after each response, a new TCP and TLS handshake for clients that would have reused it,
+is not part of the comparison.
+
+Usage: python benchmarks/audio_serving.py [--size 100000000] [--clients 200] [--range-size 10485760]
+"""
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psutil
+from tornado import gen, httpclient, ioloop, netutil, web
+import youtube
+
+def serve(directory: str, mode: str, port: int):
+    """Serve ./audio of the directory in this process until it is killed."""
+    os.chdir(directory)
+    youtube.sendfile_audio = mode == 'sendfile'
+    app = web.Application([(r'/youtube/audio/(.*)', youtube.AudioHandler)])
+    app.listen(port, '127.0.0.1')
+    ioloop.IOLoop.current().start()
+
+async def download(url: str, size: int, clients: int, range_size: int) -> int:
+    """Download random ranges, all at the same time, and return the bytes received."""
+    client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=clients)
+    received = 0
+    def discard(data):
+        nonlocal received
+        received += len(data)
+    async def fetch():
+        start = random.randrange(0, size - range_size)
+        await client.fetch(
+            url,
+            headers={'Range': f'bytes={start}-{start + range_size - 1}'},
+            streaming_callback=discard,
+            request_timeout=600
+        )
+    await gen.multi([fetch() for _ in range(clients)])
+    client.close()
+    return received
+
+def run(directory: str, mode: str):
+    """Benchmark one mode against a fresh server process."""
+    sock = netutil.bind_sockets(0, '127.0.0.1')[0]
+    port = sock.getsockname()[1]
+    sock.close()
+    server = subprocess.Popen([sys.executable, __file__, '--serve', directory, '--mode', mode, '--port', str(port)])
+    try:
+        url = f'http://127.0.0.1:{port}/youtube/audio/bench'
+        for _ in range(100):
+            try:
+                # Also warms up the page cache
+                ioloop.IOLoop.current().run_sync(lambda: download(url, ARGS.size, 1, ARGS.range_size))
+                break
+            except (ConnectionError, httpclient.HTTPClientError, OSError):
+                time.sleep(0.1)
+        cpu = psutil.Process(server.pid).cpu_times()
+        started = time.perf_counter()
+        received = ioloop.IOLoop.current().run_sync(lambda: download(url, ARGS.size, ARGS.clients, ARGS.range_size))
+        elapsed = time.perf_counter() - started
+        used = psutil.Process(server.pid).cpu_times()
+        cpu_time = used.user + used.system - cpu.user - cpu.system
+        print(f'{mode:>9}: {elapsed:6.2f} s, {received / elapsed / 1048576:8.1f} MiB/s, '
+              f'server CPU {cpu_time:6.2f} s ({used.user - cpu.user:.2f} user, {used.system - cpu.system:.2f} system)')
+    finally:
+        server.kill()
+        server.wait()
+
+ARGS = None
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark serving converted audio')
+    parser.add_argument('--size', type=int, default=100000000, help='Size of the served file in bytes')
+    parser.add_argument('--clients', type=int, default=200, help='Number of concurrent range downloads')
+    parser.add_argument('--range-size', type=int, default=10485760, help='Size of each range in bytes')
+    parser.add_argument('--serve', type=str, help='Directory to serve from, used for the server processes')
+    parser.add_argument('--mode', choices=('chunks', 'sendfile'))
+    parser.add_argument('--port', type=int)
+    ARGS = parser.parse_args()
+    if ARGS.serve:
+        serve(ARGS.serve, ARGS.mode, ARGS.port)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'audio'))
+            with open(os.path.join(directory, 'audio', 'bench.mp3'), 'wb') as audio_file:
+                for _ in range(0, ARGS.size, 1048576):
+                    audio_file.write(os.urandom(1048576))
+                audio_file.truncate(ARGS.size)
+            print(f'{ARGS.clients} concurrent downloads of {ARGS.range_size / 1048576:.0f} MiB ranges '
+                  f'of a {ARGS.size / 1000000:.0f} MB file')
+            for name in ('chunks', 'sendfile'):
+                run(directory, name)
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+"""
+Benchmark the encoder profiles of MP3 conversions.
+
+A sample resembling the audio-only streams of YouTube, AAC at 128kbit/s, is generated with
+the lavfi sources of ffmpeg: a voice-like tone over pink noise. Unless another sample is
+given, it is then converted once per encoder profile with the same ffmpeg arguments the
+conversions use, and once remuxed to M4A for comparison. Reported are the wall time, the
+CPU time of ffmpeg, the speed relative to real time and the size of the output.
+
+Requires ffmpeg on the PATH.
+
+Usage: python benchmarks/encoder_profiles.py [--duration 600] [--sample FILE]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import youtube
+
+def generate_sample(path: str, duration: int):
+    """Generate a stereo AAC sample of the given duration in seconds."""
+    subprocess.run([
+        'ffmpeg', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'sine=frequency=180:beep_factor=4:duration={duration}',
+        '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.05:duration={duration}',
+        '-filter_complex', '[0][1]amix=inputs=2,aformat=sample_rates=44100:channel_layouts=stereo',
+        '-c:a', 'aac', '-b:a', '128k', '-f', 'ipod', path
+    ], check=True)
+
+def children_cpu() -> float:
+    """CPU time of the finished child processes in seconds."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run(name: str, sample: str, output: list, path: str, duration: float):
+    """Convert the sample and print the measurements."""
+    cpu = children_cpu()
+    started = time.perf_counter()
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-i', sample, '-threads', '1', *output, path], check=True)
+    elapsed = time.perf_counter() - started
+    cpu = children_cpu() - cpu
+    size = os.path.getsize(path)
+    print(f'{name:>16}: {elapsed:6.2f} s, CPU {cpu:6.2f} s, {duration / elapsed:6.1f}x real time, '
+          f'{size / 1048576:6.1f} MiB, {size * 8 / duration / 1000:5.0f} kbit/s')
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the encoder profiles of MP3 conversions')
+    parser.add_argument('--duration', type=int, default=600, help='Duration of the generated sample in seconds')
+    parser.add_argument('--sample', type=str, help='Audio file to convert instead of a generated sample')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        sample = args.sample
+        if sample is None:
+            sample = os.path.join(directory, 'sample.m4a')
+            generate_sample(sample, args.duration)
+        probe = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', sample],
+            check=True, capture_output=True, text=True
+        )
+        duration = float(probe.stdout)
+        print(f'Sample of {duration:.0f} s, {os.path.getsize(sample) / 1048576:.1f} MiB')
+        mp3 = youtube.AUDIO_FORMATS['mp3']['encode']
+        run('default', sample, mp3, os.path.join(directory, 'default.mp3'), duration)
+        for profile, settings in youtube.ENCODER_PROFILES.items():
+            run(profile, sample, settings + mp3, os.path.join(directory, f'{profile}.mp3'), duration)
+        run('m4a (copy)', sample, youtube.AUDIO_FORMATS['m4a']['copy'], os.path.join(directory, 'copy.m4a'), duration)
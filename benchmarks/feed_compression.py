@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+"""
+Benchmark serving a large cached feed with and without pre-compressed bodies.
+
+"identity" serves the plain body, which is what PodTube sent before feeds were compressed
+once when cached (Tornado's compress_response does not cover application/rss+xml).
+"per-request" gzips the body on every request, which is what enabling on-the-fly
+compression for feeds would cost. "precompressed" serves the stored gzip variant.
+
+Usage: python benchmarks/feed_compression.py [--items 3000] [--requests 2000] [--concurrency 20]
+"""
+import datetime
+import gzip
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from feedgen.feed import FeedGenerator
+from tornado import gen, httpclient, ioloop, netutil, httpserver, web
+import feeds
+
+def build_feed(items: int) -> bytes:
+    fg = FeedGenerator()
+    fg.load_extension('podcast')
+    fg.title('Benchmark channel')
+    fg.id('http://localhost/benchmark')
+    fg.description('A large channel')
+    fg.link(href='http://localhost/benchmark', rel='self')
+    for index in range(items):
+        fe = fg.add_entry()
+        fe.title(f'Episode {index}')
+        fe.id(f'video{index:08d}')
+        fe.description(f'Description of episode {index}. ' * 8)
+        fe.enclosure(url=f'http://localhost/youtube/audio/video{index:08d}', type='audio/mpeg')
+        fe.pubDate('2024-01-01T00:00:00Z')
+    return fg.rss_str()
+
+class BenchmarkFeedHandler(feeds.FeedHandler):
+    def initialize(self, feed, compress_each_request=False):
+        self.feed = feed
+        self.compress_each_request = compress_each_request
+
+    def get(self):
+        feed = self.feed
+        if self.compress_each_request:
+            feed = dict(feed, encoded={'gzip': gzip.compress(feed['feed'], compresslevel=6)})
+        self.write_feed(feed)
+
+async def measure(port: int, path: str, requests: int, concurrency: int) -> float:
+    client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    url = f'http://127.0.0.1:{port}{path}'
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await client.fetch(url, headers={'Accept-Encoding': 'gzip'}, decompress_response=False)
+
+    started = time.perf_counter()
+    await gen.multi([worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    client.close()
+    return requests / elapsed
+
+async def main(args):
+    body = build_feed(args.items)
+    feed = feeds.make_feed(body, datetime.datetime.now() + datetime.timedelta(hours=1))
+    uncompressed = dict(feed, encoded={})
+    app = web.Application([
+        (r'/identity', BenchmarkFeedHandler, {'feed': uncompressed}),
+        (r'/per-request', BenchmarkFeedHandler, {'feed': uncompressed, 'compress_each_request': True}),
+        (r'/precompressed', BenchmarkFeedHandler, {'feed': feed}),
+    ], compress_response=True)
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    server = httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    port = sockets[0].getsockname()[1]
+    print(f'Feed: {args.items} items, {len(body)} bytes, gzip {len(feed["encoded"]["gzip"])} bytes')
+    for name in ('identity', 'per-request', 'precompressed'):
+        await measure(port, '/' + name, args.concurrency, args.concurrency) # warm up
+        rate = await measure(port, '/' + name, args.requests, args.concurrency)
+        print(f'{name:>13}: {rate:8.1f} requests/sec')
+    server.stop()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark pre-compressed feed serving')
+    parser.add_argument('--items', type=int, default=3000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    ioloop.IOLoop.current().run_sync(lambda: main(parser.parse_args()))
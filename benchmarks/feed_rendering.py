@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+"""
+Benchmark building a large channel feed with the streaming writer and with FeedGenerator.
+
+A local fixture stands in for the YouTube Data API and serves a channel with 5,000
+uploads in pages of 50. Every mode runs in a fresh process which requests the channel
+feed once, cold, and reports the time to the first response byte and how much the peak
+RSS of the process grew during the request. "feedgen" renders through FeedGenerator the
+way the handlers did before the streaming writer, "streaming" uses rss_writer.FeedWriter.
+
+Usage: python benchmarks/feed_rendering.py [--items 5000]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+import types
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from feedgen.feed import FeedGenerator
+from tornado import httpclient, httpserver, ioloop, netutil, web
+import rss_writer
+import youtube
+import youtube_api
+
+PAGE_SIZE = 50
+
+class FixtureApiHandler(web.RequestHandler):
+    """Serves a channel and its uploads, newest first."""
+    items = 5000
+
+    def get(self, endpoint):
+        thumbnails = {
+            'default': {'url': 'https://i.ytimg.com/vi/x/default.jpg', 'width': 120},
+            'high': {'url': 'https://i.ytimg.com/vi/x/hqdefault.jpg', 'width': 480}
+        }
+        if endpoint == 'channels':
+            self.write({'items': [{
+                'id': self.get_argument('id'),
+                'contentDetails': {'relatedPlaylists': {'uploads': 'UU' + self.get_argument('id')}},
+                'snippet': {'title': 'Benchmark channel', 'description': 'A large channel', 'thumbnails': thumbnails}
+            }]})
+            return
+        start = int(self.get_argument('pageToken') or 0)
+        end = min(start + PAGE_SIZE, self.items)
+        response = {'items': [{
+            'snippet': {
+                'title': f'Episode {index}',
+                'description': f'Description of episode {index}. ' * 8,
+                'channelTitle': 'Benchmark channel',
+                'channelId': 'bench',
+                'publishedAt': '2024-01-01T00:00:00Z',
+                'thumbnails': thumbnails
+            },
+            'contentDetails': {'videoId': f'video{index:08d}'}
+        } for index in range(self.items - start - 1, self.items - end - 1, -1)]}
+        if end < self.items:
+            response['nextPageToken'] = str(end)
+        self.write(response)
+
+class FeedGeneratorWriter:
+    """The FeedWriter interface on top of FeedGenerator, i.e. the rendering PodTube used before."""
+    def __init__(self, title, link, description, image, author, summary=None):
+        self.fg = FeedGenerator()
+        self.fg.load_extension('podcast')
+        self.fg.generator('PodTube (python-feedgen)', youtube.__version__, 'https://github.com/amckee/PodTube')
+        self.fg.title(title)
+        self.fg.description(description)
+        self.fg.author(name='Podtube', email='armware+podtube@gmail.com', uri='https://github.com/amckee/PodTube')
+        self.fg.podcast.itunes_author(author)
+        self.fg.image(image)
+        self.fg.link(href=link, rel='self')
+        self.fg.language('en-US')
+        self.fg.podcast.itunes_image(image)
+        self.fg.podcast.itunes_explicit('no')
+        self.fg.podcast.itunes_owner(name='Podtube', email='armware+podtube@gmail.com')
+        self.fg.podcast.itunes_summary(summary)
+        self.fg.podcast.itunes_category(cat='Technology')
+        self.count = 0
+
+    def add_entry(self, guid, title, link, description, author, image, published,
+                  enclosure_url=None, enclosure_type=None):
+        fe = self.fg.add_entry()
+        self.count += 1
+        fe.title(title)
+        fe.id(guid)
+        fe.podcast.itunes_image(image)
+        if enclosure_url:
+            fe.enclosure(url=enclosure_url, type=enclosure_type)
+        fe.author(name=author)
+        fe.podcast.itunes_author(author)
+        fe.pubDate(published)
+        fe.link(href=link, title=title)
+        fe.podcast.itunes_summary(description)
+        fe.description(description)
+
+    def __len__(self):
+        return self.count
+
+    def rss_bytes(self):
+        return self.fg.rss_str()
+
+def max_rss() -> int:
+    """Peak resident set size of this process in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+async def run_mode(mode: str):
+    if mode == 'feedgen':
+        youtube.rss_writer = types.SimpleNamespace(FeedWriter=FeedGeneratorWriter, parse_date=rss_writer.parse_date)
+    app = web.Application([
+        (r'/youtube/v3/(.*)', FixtureApiHandler),
+        (r'/youtube/channel/(.*)', youtube.ChannelHandler, {
+            'video_handler_path': '/youtube/video/',
+            'audio_handler_path': '/youtube/audio/',
+        }),
+    ])
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    server = httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    port = sockets[0].getsockname()[1]
+    youtube_api.api_url = f'http://127.0.0.1:{port}/youtube/v3/'
+    client = httpclient.AsyncHTTPClient()
+
+    # Warm up the server, the client and the fixture with a small channel
+    FixtureApiHandler.items = 10
+    await client.fetch(f'http://127.0.0.1:{port}/youtube/channel/warmup/audio')
+    FixtureApiHandler.items = ARGS.items
+
+    baseline = max_rss()
+    first_byte = None
+    def on_header(_line):
+        nonlocal first_byte
+        if first_byte is None:
+            first_byte = time.perf_counter()
+    started = time.perf_counter()
+    response = await client.fetch(
+        f'http://127.0.0.1:{port}/youtube/channel/bench/audio',
+        header_callback=on_header,
+        headers={'Accept-Encoding': 'identity'}
+    )
+    print(f'{mode:>9}: time to first byte {first_byte - started:6.2f} s, '
+          f'peak RSS +{(max_rss() - baseline) / 1024:6.1f} MiB, feed {len(response.body) / 1048576:.1f} MiB')
+    server.stop()
+
+ARGS = None
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark rendering a large channel feed')
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--mode', choices=('feedgen', 'streaming'))
+    ARGS = parser.parse_args()
+    if ARGS.mode:
+        ioloop.IOLoop.current().run_sync(lambda: run_mode(ARGS.mode))
+    else:
+        print(f'Channel with {ARGS.items} uploads in pages of {PAGE_SIZE}')
+        for name in ('feedgen', 'streaming'):
+            # A fresh process per mode, so the peak RSS of one does not hide the other
+            subprocess.run([sys.executable, __file__, '--items', str(ARGS.items), '--mode', name], check=True)
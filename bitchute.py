@@ -5,13 +5,17 @@ This handles converting Bitchute channels into podcast-friendly RSS feeds.
 import logging
 import requests
 from feedgen.feed import FeedGenerator
-from tornado import web
+from tornado import gen, ioloop, web
+import feeds
+import utils
 
 __version__ = 'v2024.07.09.2'
 
 USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
 
-class ChannelHandler(web.RequestHandler):
+feed_refresher = feeds.FeedRefresher(feeds.feed_cache, utils.SingleFlight('bitchute'))
+
+class ChannelHandler(feeds.FeedHandler):
     """
     Set the response headers for the specified channel.
 
@@ -19,22 +23,25 @@ class ChannelHandler(web.RequestHandler):
     :return: None
     """
 
-    def head(self):
+    @gen.coroutine
+    def head(self, channel):
         """
         Set the headers for the HTTP response.
+        The feed's validators and Content-Length are sent without the body.
 
         Args:
-            None
+            channel (str): The name of the Bitchute channel.
 
         Returns:
             None
         """
-        self.set_header('Content-type', 'application/rss+xml')
-        self.set_header('Accept-Ranges', 'bytes')
+        yield self.get( channel )
 
+    @gen.coroutine
     def get(self, channel):
         """
         A method to get the HTML and generate an RSS feed for a specified channel.
+        Concurrent requests for the same channel share a single build.
 
         Parameters:
             channel (str): The name of the Bitchute channel for which to generate the RSS feed.
@@ -43,10 +50,14 @@ class ChannelHandler(web.RequestHandler):
             None
         """
         # make/build RSS feed
-        self.set_header('Content-type', 'application/rss+xml')
-        feed = self.generate_rss( channel )
-        self.write( feed.rss_str(pretty=False) )
-        self.finish()
+        feed = yield feeds.get_feed(
+            f"bitchute/channel/{channel}",
+            feed_refresher,
+            lambda: ioloop.IOLoop.current().run_in_executor(
+                None, lambda: self.generate_rss( channel ).rss_str(pretty=False)
+            )
+        )
+        self.write_feed( feed )
 
     def add_channel_info( self, feed, channel ):
         """
@@ -157,7 +168,7 @@ class ChannelHandler(web.RequestHandler):
                 )
         else:
             logging.error( "Bitchute returned status code: %s", videos.status_code )
-            self.set_status(videos.status_code)
+            raise web.HTTPError(videos.status_code)
 
         return feed
 
@@ -181,9 +192,6 @@ class ChannelHandler(web.RequestHandler):
 
         return feed
 
-    def data_received(self, chunk):
-        pass
-
 class VideoHandler(web.RequestHandler):
     """
     Handles video-related requests for the Bitchute integration.
@@ -0,0 +1,281 @@
+"""
+In-memory caches with optional on-disk persistence.
+
+Cache entries are dicts carrying an ``expire`` datetime. When a store is attached, a
+PersistentDict is rehydrated from it and every change is written through to SQLite on
+a single background thread, so request handlers never wait on the disk. A BoundedCache
+additionally limits its size and finds expired entries without scanning all of them.
+"""
+import datetime
+import heapq
+import itertools
+import logging
+import pickle
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+class PersistentStore:
+    """
+    SQLite backed storage for cache entries, grouped by namespace.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-store')
+        self.executor.submit(self._connect).result()
+
+    def _connect(self):
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'namespace TEXT NOT NULL, '
+            'key TEXT NOT NULL, '
+            'value BLOB NOT NULL, '
+            'expire REAL NOT NULL, '
+            'PRIMARY KEY (namespace, key))'
+        )
+        self.connection.commit()
+
+    def load(self, namespace: str, grace: datetime.timedelta = datetime.timedelta(0)) -> dict:
+        """
+        Read the entries of a namespace, deleting those that expired more than ``grace``
+        ago. Blocks until the entries are read.
+
+        Args:
+            namespace (str): The namespace to read.
+            grace (timedelta): How long expired entries are kept, or None to keep them all
+                and leave pruning to the owner of the namespace.
+
+        Returns:
+            dict: The stored entries by key.
+        """
+        return self.executor.submit(self._load, namespace, grace).result()
+
+    def _load(self, namespace, grace):
+        if grace is not None:
+            oldest = (datetime.datetime.now() - grace).timestamp()
+            self.connection.execute('DELETE FROM cache WHERE namespace = ? AND expire <= ?', (namespace, oldest))
+            self.connection.commit()
+        entries = {}
+        for key, value in self.connection.execute('SELECT key, value FROM cache WHERE namespace = ?', (namespace,)):
+            try:
+                entries[key] = pickle.loads(value)
+            except Exception as ex:
+                logging.error( 'Cache: Error loading %s/%s: %s', namespace, key, ex )
+        return entries
+
+    def put(self, namespace: str, key: str, value: dict):
+        """
+        Queue an entry to be written.
+
+        Args:
+            namespace (str): The namespace of the entry.
+            key (str): The key of the entry.
+            value (dict): The entry. Must carry an ``expire`` datetime.
+        """
+        # Serialize right away so later changes to the entry can't race the writer thread
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.executor.submit(self._write, 'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                             (namespace, key, data, value['expire'].timestamp()))
+
+    def delete(self, namespace: str, key: str):
+        """
+        Queue an entry to be deleted.
+        """
+        self.executor.submit(self._write, 'DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def clear(self, namespace: str):
+        """
+        Queue all entries of a namespace to be deleted.
+        """
+        self.executor.submit(self._write, 'DELETE FROM cache WHERE namespace = ?', (namespace,))
+
+    def _write(self, statement, parameters):
+        try:
+            self.connection.execute(statement, parameters)
+            self.connection.commit()
+        except Exception as ex:
+            logging.error( 'Cache: Error writing to %s: %s', self.path, ex )
+
+    def close(self):
+        """
+        Wait for the queued writes and close the database.
+        """
+        self.executor.submit(self.connection.close)
+        self.executor.shutdown(wait=True)
+
+class PersistentDict(dict):
+    """
+    A dict of cache entries whose changes are written through to a PersistentStore.
+    Entries must be replaced, not mutated in place, for the change to be persisted.
+    """
+    def __init__(self, namespace: str):
+        super().__init__()
+        self.namespace = namespace
+        self.store = None
+
+    def attach(self, store: PersistentStore, grace: datetime.timedelta = datetime.timedelta(0)):
+        """
+        Rehydrate the dict from the store and write all further changes to it.
+
+        Args:
+            store (PersistentStore): The store to use.
+            grace (timedelta): How long expired entries are kept, or None to keep them all.
+        """
+        self.store = store
+        entries = store.load(self.namespace, grace)
+        super().update(entries)
+        if entries:
+            logging.info( 'Cache: Loaded %s items into %s', len(entries), self.namespace )
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self.store is not None:
+            self.store.put(self.namespace, key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if self.store is not None:
+            self.store.delete(self.namespace, key)
+
+    def clear(self):
+        super().clear()
+        if self.store is not None:
+            self.store.clear(self.namespace)
+
+    def remove_expired(self, current_time: datetime.datetime) -> int:
+        """
+        Delete the entries which expired before the given time.
+
+        Args:
+            current_time (datetime): The time to compare the entries against.
+
+        Returns:
+            int: The number of deleted entries.
+        """
+        expired = [key for key, info in self.items() if info['expire'] <= current_time]
+        for key in expired:
+            del self[key]
+        return len(expired)
+
+def entry_size(value) -> int:
+    """
+    Estimate the memory held by a cache entry. Strings and bytes dominate the entries,
+    so they are counted by length and everything else by its shallow size.
+
+    Args:
+        value: The entry or a part of it.
+
+    Returns:
+        int: The estimated size in bytes.
+    """
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(entry_size(k) + entry_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(entry_size(v) for v in value)
+    return sys.getsizeof(value)
+
+class BoundedCache(PersistentDict):
+    """
+    A PersistentDict holding at most ``max_entries`` entries and about ``max_bytes`` of
+    data. When a limit is exceeded the least recently used entries are evicted.
+
+    Expiry times are kept in a heap, so ``remove_expired`` only visits expired entries.
+    Heap records of replaced or evicted entries are skipped when they come up, and the
+    heap is rebuilt when such records make up most of it.
+    """
+    def __init__(self, namespace: str, max_entries: int = None, max_bytes: int = None):
+        """
+        Args:
+            namespace (str): The namespace of the entries in a PersistentStore.
+            max_entries (int): The maximum number of entries, or None for no limit.
+            max_bytes (int): The maximum estimated size of all entries, or None for no limit.
+        """
+        super().__init__(namespace)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizes = {}
+        self.total_bytes = 0
+        self.expiry = []
+        self.sequence = itertools.count()
+        self.evictions = 0
+
+    def limit(self, max_entries: int = None, max_bytes: int = None):
+        """
+        Change the limits of the cache and evict entries exceeding them.
+
+        Args:
+            max_entries (int): The maximum number of entries, or None for no limit.
+            max_bytes (int): The maximum estimated size of all entries, or None for no limit.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def attach(self, store: PersistentStore, grace: datetime.timedelta = datetime.timedelta(0)):
+        super().attach(store, grace)
+        for key, value in dict.items(self):
+            if key not in self.sizes:
+                self._track(key, value)
+        self._evict()
+
+    def __getitem__(self, key):
+        # Move the entry to the end, which keeps the dict in least recently used order
+        value = dict.pop(self, key)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.total_bytes -= self.sizes.pop(key)
+            dict.__delitem__(self, key)
+        super().__setitem__(key, value)
+        self._track(key, value)
+        self._evict()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.total_bytes -= self.sizes.pop(key)
+
+    def clear(self):
+        super().clear()
+        self.sizes.clear()
+        self.total_bytes = 0
+        self.expiry = []
+
+    def _track(self, key, value):
+        size = entry_size(value)
+        self.sizes[key] = size
+        self.total_bytes += size
+        heapq.heappush(self.expiry, (value['expire'], next(self.sequence), key))
+        if len(self.expiry) > 2 * len(self) + 64:
+            self.expiry = [(info['expire'], next(self.sequence), k) for k, info in dict.items(self)]
+            heapq.heapify(self.expiry)
+
+    def _evict(self):
+        while len(self) and ((self.max_entries is not None and len(self) > self.max_entries)
+                             or (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            oldest = next(iter(self))
+            del self[oldest]
+            self.evictions += 1
+            logging.debug( 'Cache: Evicted %s from %s', oldest, self.namespace )
+
+    def remove_expired(self, current_time: datetime.datetime) -> int:
+        removed = 0
+        while self.expiry and self.expiry[0][0] <= current_time:
+            _, _, key = heapq.heappop(self.expiry)
+            info = dict.get(self, key)
+            if info is not None and info['expire'] <= current_time:
+                del self[key]
+                removed += 1
+        return removed
@@ -0,0 +1,638 @@
+"""
+Scheduling of audio conversions.
+
+Conversion jobs wait in a priority queue. A job starts as soon as it is enqueued if
+fewer than ``concurrency`` conversions are running, otherwise as soon as one finishes,
+so conversions run back-to-back without polling. All clients waiting for a job get its
+result the moment it finishes. The concurrency is either fixed or picked by a
+ConcurrencyTuner from the cores, the load average and the speed of the conversions.
+Running jobs report the progress ffmpeg writes with ``-progress``. Conversions running
+too long or not progressing are cancelled, and so are, if wanted, conversions every client
+waiting for has given up on. With a journal, the queued and running jobs survive a restart
+and are enqueued again on the next start. Prefetches, the jobs of autoload priority, can be
+held back, e.g. outside an off-peak window or while the audio cache is full.
+"""
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import os
+
+from tornado import concurrent, ioloop, iostream
+
+# Lower values run first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_AUTOLOAD = 10
+
+RESULT_SUCCESS = 'success'
+RESULT_UNAVAILABLE = 'unavailable'
+RESULT_FAILED = 'failed'
+RESULT_CANCELLED = 'cancelled'
+
+# Number of finished jobs kept for the status
+RECENT_JOBS = 50
+# Jobs older than this are not restored from the journal
+JOURNAL_EXPIRATION = datetime.timedelta(days=1)
+# Jobs interrupted more often than this are not restarted, they might be what brings PodTube down
+MAX_RESTARTS = 3
+
+class ConversionJob:
+    """
+    A queued or running conversion.
+    """
+    def __init__(self, key: str, priority: int):
+        """
+        Args:
+            key (str): What to convert, e.g. the video id.
+            priority (int): The priority of the job. Lower values run first.
+        """
+        self.key = key
+        self.priority = priority
+        self.added = datetime.datetime.now()
+        self.started = None
+        self.finished = None
+        self.status = 'queued'
+        # Seconds of media converted, if known. Used to measure the speed of the conversion.
+        self.duration = None
+        # The highest number of conversions running at the same time as this one
+        self.concurrency = 0
+        self.result = None
+        self.waiting = set()
+        # The latest progress reported by ffmpeg, see ``read_progress``
+        self.progress = {}
+        # When the conversion last made progress
+        self.progressed = None
+        # Prefetches are kept when nobody waits for them
+        self.prefetch = priority >= PRIORITY_AUTOLOAD
+        # Why the job was cancelled, if it was
+        self.cancelled = None
+        # Stops the running conversion, set by the conversion while it can be stopped
+        self.stop = None
+        # Called when the last client waiting for the job gives up
+        self.on_abandoned = None
+        # How often the job was interrupted by a restart
+        self.restarts = 0
+
+    @property
+    def waiters(self) -> int:
+        """
+        The number of clients waiting for the job.
+        """
+        return len(self.waiting)
+
+    def wait(self) -> concurrent.Future:
+        """
+        Wait for the job to finish.
+
+        Returns:
+            Future: Resolves to the result of the job: RESULT_SUCCESS, RESULT_UNAVAILABLE
+                or RESULT_FAILED, or to None if the wait is cancelled.
+        """
+        waiter = concurrent.Future()
+        if self.result is not None:
+            waiter.set_result(self.result)
+        else:
+            self.waiting.add(waiter)
+        return waiter
+
+    def cancel_wait(self, waiter: concurrent.Future, abandon: bool = True):
+        """
+        Stop one client's wait, e.g. because it disconnected. The job goes on, unless the
+        scheduler cancels jobs nobody waits for.
+
+        Args:
+            waiter (Future): The future returned by ``wait``.
+            abandon (bool): Whether the client gave up on the job, rather than having
+                got what it needed from it already.
+        """
+        if waiter in self.waiting:
+            self.waiting.discard(waiter)
+            waiter.set_result(None)
+            if abandon and not self.waiting and self.on_abandoned is not None:
+                self.on_abandoned(self)
+
+    def cancel(self, reason: str):
+        """
+        Cancel the job, stopping the conversion if it is running.
+
+        Args:
+            reason (str): Why the job is cancelled, reported in the status.
+        """
+        if self.cancelled is None:
+            self.cancelled = reason
+            if self.stop is not None:
+                self.stop()
+
+    def finish(self, result: str):
+        """
+        Record the result of the job and wake everybody waiting for it.
+        """
+        self.status = 'finished'
+        self.finished = datetime.datetime.now()
+        self.result = result
+        waiting, self.waiting = self.waiting, set()
+        for waiter in waiting:
+            waiter.set_result(result)
+
+    def update_progress(self, values: dict):
+        """
+        Record a progress report of ffmpeg.
+
+        Args:
+            values (dict): The keys and values of the report, as strings.
+        """
+        previous = (self.progress.get('out_time'), self.progress.get('total_size'))
+        try:
+            self.progress['out_time'] = int(values['out_time_us']) / 1000000
+        except (KeyError, ValueError):
+            pass
+        try:
+            self.progress['speed'] = float(values['speed'].rstrip('x'))
+        except (KeyError, ValueError):
+            pass
+        try:
+            self.progress['total_size'] = int(values['total_size'])
+        except (KeyError, ValueError):
+            pass
+        try:
+            self.progress['bitrate'] = float(values['bitrate'].rstrip('kbits/s')) * 1000
+        except (KeyError, ValueError):
+            pass
+        if (self.progress.get('out_time'), self.progress.get('total_size')) != previous:
+            self.progressed = datetime.datetime.now()
+
+    def to_dict(self) -> dict:
+        """
+        The state of the job, for the status.
+
+        Returns:
+            dict: The job. Times are in seconds, bitrates in bit/s.
+        """
+        now = datetime.datetime.now()
+        job = {
+            'key': self.key,
+            'priority': self.priority,
+            'status': self.status,
+            'result': self.result,
+            'added': self.added.isoformat(),
+            'waiters': self.waiters,
+            'wait_time': ((self.started or now) - self.added).total_seconds(),
+            'runtime': ((self.finished or now) - self.started).total_seconds() if self.started else None,
+            'duration': self.duration,
+            'prefetch': self.prefetch,
+            'cancelled': self.cancelled,
+            'restarts': self.restarts
+        }
+        job.update(self.progress)
+        if self.duration and 'out_time' in self.progress:
+            job['percent'] = min(100.0, round(100 * self.progress['out_time'] / self.duration, 1))
+        return job
+
+async def read_progress(job: ConversionJob, stream: iostream.BaseIOStream):
+    """
+    Read the progress ffmpeg writes with ``-progress pipe:1`` until it exits.
+
+    ffmpeg writes a report of ``key=value`` lines about every half second, each ending
+    with a ``progress`` line. Every report updates the progress of the job.
+
+    Args:
+        job (ConversionJob): The job running ffmpeg.
+        stream (BaseIOStream): The standard output of ffmpeg.
+    """
+    values = {}
+    while True:
+        try:
+            line = await stream.read_until(b'\n')
+        except iostream.StreamClosedError:
+            return
+        key, _, value = line.decode('utf-8', 'replace').partition('=')
+        values[key.strip()] = value.strip()
+        if key.strip() == 'progress':
+            job.update_progress(values)
+            values = {}
+
+def available_cores() -> int:
+    """
+    The number of cores this process may run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def load_average():
+    """
+    The load average over the last minute, or None where the platform has none.
+    """
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+class ConcurrencyTuner:
+    """
+    Picks the number of conversions to run at the same time.
+
+    The ceiling is a conversion per ``threads`` cores, keeping one core for the IOLoop,
+    lowered by the load that other processes put on the box. Below the ceiling the
+    concurrency grows by one per tuning period while jobs are waiting, and shrinks by
+    one when conversions running next to others get much slower than conversions
+    running alone, i.e. when they compete for the CPU or the disk.
+    """
+    # Weight of the latest measurement in the moving averages of the speed
+    SMOOTHING = 0.3
+
+    def __init__(self, cores: int = None, threads: int = 1, contention: float = 0.6):
+        """
+        Args:
+            cores (int): The number of cores, by default the ones available to this process.
+            threads (int): The number of threads of a conversion.
+            contention (float): The fraction of the speed of conversions running alone
+                below which conversions running side by side count as competing.
+        """
+        self.cores = cores or available_cores()
+        self.threads = max(1, threads)
+        self.contention = contention
+        self.solo_speed = None
+        self.shared_speed = None
+
+    def capacity(self, running: int) -> int:
+        """
+        The number of conversions the cores can take right now.
+
+        Args:
+            running (int): The number of conversions running, whose load is not held against them.
+
+        Returns:
+            int: The number of conversions, at least 1.
+        """
+        limit = (self.cores - 1) // self.threads
+        load = load_average()
+        if load is not None:
+            other = max(0.0, load - running * self.threads)
+            limit = min(limit, int((self.cores - 1 - other) // self.threads))
+        return max(1, limit)
+
+    def record(self, speed: float, concurrency: int):
+        """
+        Record the speed of a finished conversion.
+
+        Args:
+            speed (float): Seconds of media converted per second.
+            concurrency (int): The highest number of conversions that ran at the same time as it.
+        """
+        if concurrency <= 1:
+            self.solo_speed = self._average(self.solo_speed, speed)
+        else:
+            self.shared_speed = self._average(self.shared_speed, speed)
+
+    def _average(self, average, speed):
+        if average is None:
+            return speed
+        return average + self.SMOOTHING * (speed - average)
+
+    def contended(self) -> bool:
+        """
+        Whether conversions running side by side were measured to slow each other down.
+        """
+        if self.solo_speed is None or self.shared_speed is None:
+            return False
+        return self.shared_speed < self.solo_speed * self.contention
+
+    def target(self, current: int, running: int, waiting: int) -> int:
+        """
+        Pick the concurrency for the next tuning period.
+
+        Args:
+            current (int): The current concurrency.
+            running (int): The number of conversions running.
+            waiting (int): The number of jobs waiting for a free slot.
+
+        Returns:
+            int: The new concurrency, at least 1.
+        """
+        limit = self.capacity(running)
+        if self.contended():
+            # Start over measuring at the lower concurrency
+            self.shared_speed = None
+            return max(1, min(limit, current - 1))
+        if waiting and current < limit:
+            return current + 1
+        return max(1, min(limit, current))
+
+class ConversionScheduler:
+    """
+    Runs conversion jobs by priority, then in the order they were added.
+    A key can only be queued once; enqueueing it again returns the existing job.
+    """
+    # Seconds between two adjustments of the concurrency by the tuner
+    TUNE_PERIOD = 10
+    # Seconds between two checks of the time limits of the running jobs
+    WATCH_PERIOD = 5
+    # Seconds between two checks whether held back prefetches may start
+    HOLD_PERIOD = 60
+
+    def __init__(self, convert, concurrency: int = 2, tuner: ConcurrencyTuner = None):
+        """
+        Args:
+            convert: A callable taking a ConversionJob and returning an awaitable
+                of the result of the conversion.
+            concurrency (int): The number of conversions running at the same time.
+                The starting point when a tuner is given.
+            tuner (ConcurrencyTuner): Adjusts the concurrency while running, if given.
+        """
+        self.convert = convert
+        self.concurrency = concurrency
+        self.tuner = tuner
+        self.jobs = {}
+        self.queue = []
+        self.sequence = itertools.count()
+        self.running = set()
+        self.recent = collections.deque(maxlen=RECENT_JOBS)
+        self.tuning = None
+        self.watching = None
+        self.holding = None
+        self.prefetch_allowed = None
+        self.timeout = None
+        self.stall_timeout = None
+        self.cancel_abandoned = False
+        self.journal = None
+
+    def __contains__(self, key):
+        return key in self.jobs
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def enqueue(self, key: str, priority: int = PRIORITY_INTERACTIVE) -> ConversionJob:
+        """
+        Queue a conversion unless it is already queued or running.
+
+        Args:
+            key (str): What to convert.
+            priority (int): The priority of the job. A queued job is moved up if
+                it is enqueued again with a higher priority.
+
+        Returns:
+            ConversionJob: The new or existing job.
+        """
+        job = self.jobs.get(key)
+        if job is not None:
+            changed = priority >= PRIORITY_AUTOLOAD and not job.prefetch
+            job.prefetch = job.prefetch or priority >= PRIORITY_AUTOLOAD
+            if job.status == 'queued' and priority < job.priority:
+                job.priority = priority
+                heapq.heappush(self.queue, (priority, next(self.sequence), job))
+                changed = True
+            if changed:
+                self._journal(job)
+                # A held back prefetch may start now
+                self._dispatch()
+            return job
+        job = ConversionJob(key, priority)
+        self._add(job)
+        return job
+
+    def restore(self, journal: dict, done=None) -> int:
+        """
+        Record the jobs in a journal from now on, and enqueue again the jobs it holds from
+        before a restart. Jobs that were running start over.
+
+        Args:
+            journal (dict): The journal, e.g. a cache.PersistentDict attached to a store.
+            done: A callable telling whether the conversion of a key finished after all,
+                e.g. because its file exists, or None.
+
+        Returns:
+            int: The number of jobs enqueued again.
+        """
+        self.journal = journal
+        restored = 0
+        for key, entry in sorted(journal.items(), key=lambda item: (item[1]['priority'], item[1]['added'])):
+            if key in self.jobs:
+                continue
+            restarts = entry['restarts'] + (1 if entry['started'] else 0)
+            if done is not None and done(key):
+                del journal[key]
+                continue
+            if restarts > MAX_RESTARTS:
+                logging.error( 'Conversion: Giving up on %s, it was interrupted %s times', key, restarts )
+                del journal[key]
+                continue
+            if entry['started']:
+                logging.warning( 'Conversion: Restarting %s, it was interrupted', key )
+            job = ConversionJob(key, entry['priority'])
+            job.added = entry['added']
+            job.prefetch = entry['prefetch']
+            job.restarts = restarts
+            self._add(job)
+            restored += 1
+        if restored:
+            logging.info( 'Conversion: Restored %s jobs from the journal', restored )
+        return restored
+
+    def _add(self, job: ConversionJob):
+        job.on_abandoned = self._abandoned
+        self.jobs[job.key] = job
+        heapq.heappush(self.queue, (job.priority, next(self.sequence), job))
+        self._journal(job)
+        self._dispatch()
+
+    def _journal(self, job: ConversionJob):
+        if self.journal is None:
+            return
+        # Entries are replaced rather than changed, so the change is persisted
+        self.journal[job.key] = {
+            'priority': job.priority,
+            'prefetch': job.prefetch,
+            'added': job.added,
+            'started': job.started,
+            'restarts': job.restarts,
+            'expire': job.added + JOURNAL_EXPIRATION
+        }
+
+    def _forget(self, job: ConversionJob):
+        if self.journal is not None and job.key in self.journal:
+            del self.journal[job.key]
+
+    def configure(self, concurrency: int, tuner: ConcurrencyTuner = None):
+        """
+        Change the concurrency and the tuner.
+
+        Args:
+            concurrency (int): The number of conversions running at the same time.
+                The starting point when a tuner is given.
+            tuner (ConcurrencyTuner): Adjusts the concurrency while running, if given.
+        """
+        self.tuner = tuner
+        self.set_concurrency(concurrency)
+
+    def set_concurrency(self, concurrency: int):
+        """
+        Change the number of conversions running at the same time. Lowering it lets
+        running conversions finish.
+        """
+        concurrency = max(1, concurrency)
+        if concurrency != self.concurrency:
+            logging.info( 'Conversion: Running up to %s conversions at the same time', concurrency )
+            self.concurrency = concurrency
+        self._dispatch()
+
+    def limit(self, timeout: float = None, stall_timeout: float = None, cancel_abandoned: bool = False):
+        """
+        Set the limits of the conversions.
+
+        Args:
+            timeout (float): Seconds after which a conversion is cancelled, or None for no limit.
+            stall_timeout (float): Seconds without progress after which a conversion is
+                cancelled, or None for no limit.
+            cancel_abandoned (bool): Whether to cancel a job once every client waiting for it
+                has given up on it. Prefetches are never cancelled for this.
+        """
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.cancel_abandoned = cancel_abandoned
+
+    def hold_prefetches(self, allowed):
+        """
+        Hold back the jobs of autoload priority while they are not allowed to start.
+        Jobs moved up by an interactive request are not held back.
+
+        Args:
+            allowed: A callable telling whether prefetches may start now, or None to
+                start them as soon as there is room.
+        """
+        self.prefetch_allowed = allowed
+        self._dispatch()
+
+    def start(self):
+        """
+        Start tuning the concurrency, if there is a tuner, checking the time limits
+        of the conversions and, if prefetches are held back, whether they may start
+        on the current IOLoop.
+        """
+        for callback in (self.tuning, self.watching, self.holding):
+            if callback is not None:
+                callback.stop()
+        self.tuning = self.watching = self.holding = None
+        if self.tuner is not None:
+            self.set_concurrency(self.tuner.capacity(len(self.running)))
+            self.tuning = ioloop.PeriodicCallback(self.tune, self.TUNE_PERIOD * 1000)
+            self.tuning.start()
+        if self.timeout or self.stall_timeout:
+            self.watching = ioloop.PeriodicCallback(self.watch, self.WATCH_PERIOD * 1000)
+            self.watching.start()
+        if self.prefetch_allowed is not None:
+            self.holding = ioloop.PeriodicCallback(self._dispatch, self.HOLD_PERIOD * 1000)
+            self.holding.start()
+
+    def watch(self):
+        """
+        Cancel the running conversions that exceed the time limits.
+        """
+        now = datetime.datetime.now()
+        for job in list(self.running):
+            if self.timeout and (now - job.started).total_seconds() > self.timeout:
+                logging.warning( 'Conversion: %s is taking longer than %s seconds, cancelling it', job.key, self.timeout )
+                job.cancel('timeout')
+            elif self.stall_timeout and (now - job.progressed).total_seconds() > self.stall_timeout:
+                logging.warning( 'Conversion: %s made no progress for %s seconds, cancelling it', job.key, self.stall_timeout )
+                job.cancel('stalled')
+
+    def _abandoned(self, job: ConversionJob):
+        if not self.cancel_abandoned or job.prefetch or job.waiters or job.status == 'finished':
+            return
+        logging.info( 'Conversion: Nobody waits for %s any more, cancelling it', job.key )
+        if job.status == 'queued':
+            # Its entry in the queue is skipped once the job is finished
+            del self.jobs[job.key]
+            self._forget(job)
+            job.cancel('abandoned')
+            job.finish(RESULT_CANCELLED)
+            self.recent.appendleft(job)
+        else:
+            job.cancel('abandoned')
+
+    def tune(self):
+        """
+        Let the tuner adjust the concurrency.
+        """
+        running = len(self.running)
+        self.set_concurrency(self.tuner.target(self.concurrency, running, len(self.jobs) - running))
+
+    def status(self) -> dict:
+        """
+        The state of the scheduler, for the status.
+
+        Returns:
+            dict: The concurrency, whether prefetches are held back, the queued jobs in the
+                order they will run, the running jobs and the most recently finished jobs,
+                newest first.
+        """
+        queued = sorted(
+            (job for job in self.jobs.values() if job.status == 'queued'),
+            key=lambda job: (job.priority, job.added)
+        )
+        return {
+            'concurrency': self.concurrency,
+            'prefetches_held': not self._prefetching(),
+            'queued': [job.to_dict() for job in queued],
+            'running': [job.to_dict() for job in sorted(self.running, key=lambda job: job.started)],
+            'finished': [job.to_dict() for job in self.recent]
+        }
+
+    def _prefetching(self) -> bool:
+        return self.prefetch_allowed is None or self.prefetch_allowed()
+
+    def _next_job(self) -> ConversionJob:
+        while self.queue:
+            priority, _, job = self.queue[0]
+            # Skip the entries left behind when a job was moved up
+            if job.status != 'queued' or job.priority != priority:
+                heapq.heappop(self.queue)
+                continue
+            # Everything behind a prefetch is a prefetch as well
+            if priority >= PRIORITY_AUTOLOAD and not self._prefetching():
+                return None
+            heapq.heappop(self.queue)
+            return job
+        return None
+
+    def _dispatch(self):
+        while len(self.running) < self.concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+            job.status = 'running'
+            job.started = job.progressed = datetime.datetime.now()
+            self.running.add(job)
+            self._journal(job)
+            for running in self.running:
+                running.concurrency = max(running.concurrency, len(self.running))
+            ioloop.IOLoop.current().spawn_callback(self._run, job)
+
+    async def _run(self, job: ConversionJob):
+        result = RESULT_FAILED
+        try:
+            # Cancelled before it got to run
+            if job.cancelled is None:
+                result = await self.convert(job) or RESULT_FAILED
+        except Exception as ex:
+            logging.error( 'Conversion: Error converting %s: %s', job.key, ex )
+        finally:
+            if job.cancelled is not None:
+                result = RESULT_CANCELLED
+            self.running.discard(job)
+            del self.jobs[job.key]
+            self._forget(job)
+            job.finish(result)
+            self.recent.appendleft(job)
+            self._record(job)
+            self._dispatch()
+
+    def _record(self, job: ConversionJob):
+        if self.tuner is None or job.result != RESULT_SUCCESS or not job.duration:
+            return
+        runtime = (datetime.datetime.now() - job.started).total_seconds()
+        if runtime > 0:
+            self.tuner.record(job.duration / runtime, job.concurrency)
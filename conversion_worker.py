@@ -0,0 +1,223 @@
+"""
+Audio conversions in a separate worker process.
+
+With ``convert_worker`` set, ``podtube.py worker`` runs the conversions and the web
+process only hands them over and waits for them, so a burst of conversions does not
+compete with serving feeds and audio. The worker schedules the jobs with its own
+ConversionScheduler and writes the audio into the ``./audio`` directory both share.
+
+The processes exchange JSON messages, one per line, over a Unix socket. The web process
+sends ``{"enqueue": key, "priority": priority}``, also to move a job up, and
+``{"cancel": key, "reason": reason}``. The worker answers ``{"finished": key, "result":
+result}`` once a job it was asked for finishes, and sends ``{"status": status}`` with the
+state of its scheduler every second. Jobs the web process waits for are sent again when
+the connection is restored, e.g. after the worker restarted.
+"""
+import json
+import logging
+import os
+import socket
+import sys
+
+from tornado import concurrent, gen, ioloop, iostream, netutil, tcpserver
+
+import conversion
+
+# Longest message accepted, the status with all its jobs being the longest
+MAX_MESSAGE = 16777216 # 16MiB
+# Seconds between two status messages of the worker
+STATUS_PERIOD = 1
+
+def encode(message: dict) -> bytes:
+    """
+    Encode a message as a line of JSON.
+    """
+    return json.dumps(message).encode('utf-8') + b'\n'
+
+class WorkerServer(tcpserver.TCPServer):
+    """
+    Runs the conversions the web process asks for. Runs in the worker process.
+    """
+    def __init__(self, scheduler: conversion.ConversionScheduler, done=None):
+        """
+        Args:
+            scheduler (ConversionScheduler): The scheduler running the conversions.
+            done: A callable telling whether the conversion of a key finished already,
+                e.g. because its file exists, or None.
+        """
+        super().__init__(max_buffer_size=MAX_MESSAGE)
+        self.scheduler = scheduler
+        self.done = done
+
+    def listen_unix(self, path: str):
+        """
+        Accept the web process on a Unix socket, replacing a socket left behind.
+
+        Args:
+            path (str): The path of the socket.
+        """
+        self.add_socket(netutil.bind_unix_socket(path))
+        logging.info( 'Conversion: Worker listening on %s', path )
+
+    async def handle_stream(self, stream: iostream.IOStream, address):
+        logging.info( 'Conversion: Web process connected' )
+        waiting = {}
+        reporting = ioloop.PeriodicCallback(
+            lambda: self._send(stream, {'status': self.scheduler.status()}),
+            STATUS_PERIOD * 1000
+        )
+        reporting.start()
+        try:
+            while True:
+                message = json.loads(await stream.read_until(b'\n', max_bytes=MAX_MESSAGE))
+                if 'enqueue' in message:
+                    self._enqueue(stream, message['enqueue'], message['priority'], waiting)
+                elif 'cancel' in message:
+                    job = self.scheduler.jobs.get(message['cancel'])
+                    if job is not None:
+                        job.cancel(message['reason'])
+        except iostream.StreamClosedError:
+            logging.warning( 'Conversion: Web process disconnected' )
+        except (ValueError, KeyError) as ex:
+            logging.error( 'Conversion: Invalid message from the web process: %s', ex )
+            stream.close()
+        finally:
+            reporting.stop()
+            # Nobody waits for these any more
+            for job, waiter in list(waiting.values()):
+                job.cancel_wait(waiter)
+
+    def _enqueue(self, stream: iostream.IOStream, key: str, priority: int, waiting: dict):
+        # Keys are file names in ./audio
+        if not key or os.path.basename(key) != key or key.startswith('.'):
+            logging.error( 'Conversion: Refusing to convert %s', key )
+            self._send(stream, {'finished': key, 'result': conversion.RESULT_FAILED})
+            return
+        if key not in self.scheduler and self.done is not None and self.done(key):
+            self._send(stream, {'finished': key, 'result': conversion.RESULT_SUCCESS})
+            return
+        job = self.scheduler.enqueue(key, priority)
+        if key in waiting:
+            return
+        waiter = job.wait()
+        waiting[key] = (job, waiter)
+        waiter.add_done_callback(lambda future: self._finished(stream, key, future, waiting))
+
+    def _finished(self, stream: iostream.IOStream, key: str, waiter: concurrent.Future, waiting: dict):
+        waiting.pop(key, None)
+        # A cancelled wait resolves to None, the web process is gone then
+        if waiter.result() is not None:
+            self._send(stream, {'finished': key, 'result': waiter.result()})
+
+    def _send(self, stream: iostream.IOStream, message: dict):
+        if not stream.closed():
+            stream.write(encode(message))
+
+class WorkerClient(conversion.ConversionScheduler):
+    """
+    Hands every conversion to the worker process right away and waits for its result.
+    Runs in the web process, in place of the scheduler; the worker decides when the
+    conversions run.
+    """
+    # Seconds between two attempts to reach the worker
+    RECONNECT_PERIOD = 1
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The path of the Unix socket of the worker.
+        """
+        super().__init__(self._convert, concurrency=sys.maxsize)
+        self.path = path
+        self.stream = None
+        self.connecting = False
+        # The result of each job handed to the worker, by key
+        self.results = {}
+        self.worker_status = None
+
+    def enqueue(self, key: str, priority: int = conversion.PRIORITY_INTERACTIVE) -> conversion.ConversionJob:
+        job = super().enqueue(key, priority)
+        # Handed over already, the worker moves the job up if it still waits there
+        if job.status == 'running' and priority < job.priority:
+            job.priority = priority
+            self._send({'enqueue': key, 'priority': priority})
+        return job
+
+    def start(self):
+        """
+        Start checking the time limits and connect to the worker, reconnecting whenever
+        the connection is lost.
+        """
+        super().start()
+        if not self.connecting:
+            self.connecting = True
+            ioloop.IOLoop.current().spawn_callback(self._connect)
+
+    def status(self) -> dict:
+        """
+        The state of the worker's scheduler as last reported, or of the jobs handed to the
+        worker while it cannot be reached.
+
+        Returns:
+            dict: The status, with whether the worker is connected.
+        """
+        status = self.worker_status if self.stream is not None and self.worker_status else super().status()
+        return dict(status, worker='connected' if self.stream is not None else 'disconnected')
+
+    async def _convert(self, job: conversion.ConversionJob) -> str:
+        result = concurrent.Future()
+        self.results[job.key] = result
+        job.stop = lambda: self._cancel(job)
+        try:
+            self._send({'enqueue': job.key, 'priority': job.priority})
+            return await result
+        finally:
+            del self.results[job.key]
+            job.stop = None
+
+    def _cancel(self, job: conversion.ConversionJob):
+        if self.stream is not None:
+            self._send({'cancel': job.key, 'reason': job.cancelled})
+        elif not self.results[job.key].done():
+            self.results[job.key].set_result(conversion.RESULT_CANCELLED)
+
+    async def _connect(self):
+        unreachable = False
+        while True:
+            stream = iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), max_buffer_size=MAX_MESSAGE)
+            try:
+                await stream.connect(self.path)
+            except (OSError, iostream.StreamClosedError) as ex:
+                if not unreachable:
+                    logging.error( 'Conversion: Cannot reach the worker at %s: %s', self.path, stream.error or ex )
+                    unreachable = True
+                stream.close()
+                await gen.sleep(self.RECONNECT_PERIOD)
+                continue
+            unreachable = False
+            logging.info( 'Conversion: Connected to the worker at %s', self.path )
+            self.stream = stream
+            for key in self.results:
+                self._send({'enqueue': key, 'priority': self.jobs[key].priority})
+            try:
+                while True:
+                    self._received(json.loads(await stream.read_until(b'\n', max_bytes=MAX_MESSAGE)))
+            except iostream.StreamClosedError:
+                logging.warning( 'Conversion: Lost the connection to the worker' )
+            except (ValueError, KeyError) as ex:
+                logging.error( 'Conversion: Invalid message from the worker: %s', ex )
+                stream.close()
+            self.stream = self.worker_status = None
+
+    def _received(self, message: dict):
+        if 'finished' in message:
+            result = self.results.get(message['finished'])
+            if result is not None and not result.done():
+                result.set_result(message['result'])
+        elif 'status' in message:
+            self.worker_status = message['status']
+
+    def _send(self, message: dict):
+        # Jobs are sent again once connected
+        if self.stream is not None and not self.stream.closed():
+            self.stream.write(encode(message))
@@ -4,25 +4,32 @@ import datetime, pytz
 import json
 
 from feedgen.feed import FeedGenerator
-from tornado import web
+from tornado import gen, ioloop, web
+import feeds
+import utils
 
 __version__ = 'v2026.03.05.2'
 
-class ChannelHandler(web.RequestHandler):
+feed_refresher = feeds.FeedRefresher(feeds.feed_cache, utils.SingleFlight('dailymotion'))
+
+class ChannelHandler(feeds.FeedHandler):
+    @gen.coroutine
     def head(self, channel):
-        self.set_header('Content-type', 'application/rss+xml')
-        self.set_header('Accept-Ranges', 'bytes')
+        yield self.get( channel )
 
+    @gen.coroutine
     def get(self, channel):
         logging.info( "Got channel: %s" % channel )
 
         url = "https://dailymotion.com/user/%s/videos?sort=recent&limit=30&flags=no_live" % channel
         logging.info( "Handling Daily Motion URL: %s" % url )
         
-        self.set_header('Content-type', 'application/rss+xml')
-        feed = self.generate_rss( channel )
-        self.write( feed )
-        self.finish()
+        feed = yield feeds.get_feed(
+            f"dailymotion/channel/{channel}",
+            feed_refresher,
+            lambda: ioloop.IOLoop.current().run_in_executor( None, self.generate_rss, channel )
+        )
+        self.write_feed( feed )
 
     def get_html( self, channel ):
         url = "https://dailymotion.com/%s/videos" % channel
@@ -0,0 +1,206 @@
+"""
+Downloads over several connections at once.
+
+YouTube throttles each connection to its stream servers, so a conversion reading the
+stream through a single connection is bound by the throttled rate rather than by the CPU.
+RangeDownload splits the stream into chunks and fetches them with concurrent Range
+requests into a file, which the conversion then reads at disk speed. A chunk that fails
+is requested again from where it broke off. A stopped download returns right away, even
+when the connections of chunks in flight stall. Tornado cannot end a request in flight,
+so such a connection stays open until it fails or hits CHUNK_TIMEOUT.
+"""
+import asyncio
+import logging
+import os
+import re
+
+from tornado import concurrent, gen, httpclient, httputil
+
+# Bytes requested at a time. YouTube throttles requests for much larger ranges.
+CHUNK_SIZE = 10485760 # 10MiB
+# Seconds a chunk may take at most, throttled connections included
+CHUNK_TIMEOUT = 600
+CONNECT_TIMEOUT = 20
+# Seconds before a failed chunk is requested again, doubled with each attempt
+RETRY_DELAY = 0.5
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+class DownloadError(Exception):
+    """
+    Raised when a download fails for good.
+    """
+
+class DownloadStopped(DownloadError):
+    """
+    Raised when a download is stopped.
+    """
+
+class RangeDownload:
+    """
+    Downloads a URL with concurrent Range requests into a file.
+    """
+    def __init__(self, url: str, path: str, connections: int = 4, chunk_size: int = CHUNK_SIZE,
+                 retries: int = 3, on_progress=None):
+        """
+        Args:
+            url (str): The URL to download.
+            path (str): The file to download to. It is replaced.
+            connections (int): The number of requests running at the same time.
+            chunk_size (int): The number of bytes requested at a time.
+            retries (int): How often a chunk is requested again before the download fails.
+            on_progress: A callable taking the bytes downloaded and the size of the
+                download, called as data arrives, or None.
+        """
+        self.url = url
+        self.path = path
+        self.connections = max(1, connections)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.on_progress = on_progress
+        self.size = None
+        self.downloaded = 0
+        self.stopped = False
+        self.error = None
+        self.chunks = []
+        self.fd = None
+        self.client = None
+        # Resolved when the download is stopped or fails, ending the requests in flight
+        self.aborted = None
+
+    def stop(self):
+        """
+        Stop the download. ``run`` raises DownloadStopped right away, without waiting for
+        the chunks in flight. Their connections close once data arrives for them, or once
+        they time out after CHUNK_TIMEOUT if they stall.
+        """
+        self.stopped = True
+        self._abort()
+
+    def _abort(self):
+        if self.aborted is not None and not self.aborted.done():
+            self.aborted.set_result(None)
+
+    async def run(self) -> int:
+        """
+        Download the URL. The first chunk tells the size, the others are then fetched
+        ``connections`` at a time. A server ignoring the range sends everything at once.
+
+        Raises:
+            DownloadError: If a chunk failed more than ``retries`` times.
+            DownloadStopped: If the download was stopped.
+
+        Returns:
+            int: The size of the download in bytes.
+        """
+        self.client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=self.connections)
+        self.aborted = concurrent.Future()
+        if self.stopped:
+            self._abort()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            await self._fetch(0, self.chunk_size - 1)
+            if self.size is None:
+                # The whole body came with the first response
+                return self.downloaded
+            os.ftruncate(self.fd, self.size)
+            self.chunks = [
+                (start, min(start + self.chunk_size, self.size) - 1)
+                for start in range(self.chunk_size, self.size, self.chunk_size)
+            ]
+            self.chunks.reverse()
+            # Each connection takes the next chunk as soon as its last one is done
+            await gen.multi([self._fetch_chunks() for _ in range(min(self.connections, len(self.chunks)))])
+            if self.stopped:
+                raise DownloadStopped('Download stopped')
+            if self.error is not None:
+                raise self.error
+            return self.size
+        finally:
+            os.close(self.fd)
+            self.client.close()
+
+    async def _fetch_chunks(self):
+        while self.chunks and self.error is None and not self.stopped:
+            start, end = self.chunks.pop()
+            try:
+                await self._fetch(start, end)
+            except DownloadError as ex:
+                # The other connections give up as well
+                self.error = self.error or ex
+                self._abort()
+
+    async def _fetch(self, start: int, end: int):
+        attempt = 0
+        while True:
+            offset = start
+            response_start = None
+            headers = httputil.HTTPHeaders()
+            def header(line):
+                nonlocal response_start, headers
+                if line.startswith('HTTP/'):
+                    # A new response, e.g. after a redirect
+                    response_start = httputil.parse_response_start_line(line.strip())
+                    headers = httputil.HTTPHeaders()
+                elif line.strip():
+                    headers.parse_line(line)
+            def write(data):
+                nonlocal offset
+                if self.stopped or self.error is not None:
+                    raise DownloadStopped('Download stopped')
+                if not self._expected(response_start, headers, start):
+                    # An error page or the body of a redirect
+                    return
+                if self.size is not None and offset + len(data) > end + 1:
+                    raise DownloadError(f'Got more than bytes {start}-{end}')
+                os.pwrite(self.fd, data, offset)
+                offset += len(data)
+                self.downloaded += len(data)
+                if self.on_progress is not None:
+                    self.on_progress(self.downloaded, self.size)
+            try:
+                fetch = self.client.fetch(
+                    self.url,
+                    headers={'Range': f'bytes={start}-{end}'},
+                    header_callback=header,
+                    streaming_callback=write,
+                    connect_timeout=CONNECT_TIMEOUT,
+                    request_timeout=CHUNK_TIMEOUT
+                )
+                await asyncio.wait([fetch, self.aborted], return_when=asyncio.FIRST_COMPLETED)
+                if not fetch.done():
+                    # Left to fail on its own, e.g. when the stalled connection times out
+                    fetch.add_done_callback(lambda future: future.cancelled() or future.exception())
+                    raise DownloadStopped('Download stopped')
+                response = fetch.result()
+                if not self._expected(response_start, headers, start):
+                    raise DownloadError(f'Got {response.code} instead of bytes {start}-{end}')
+                if response.code == 200:
+                    return
+                if self.size is None:
+                    self.size = int(CONTENT_RANGE.match(headers['Content-Range']).group(3))
+                    end = min(end, self.size - 1)
+                if offset != end + 1:
+                    raise DownloadError(f'Got {offset - start} of bytes {start}-{end}')
+                return
+            except (DownloadError, httpclient.HTTPError, OSError) as ex:
+                if self.stopped or self.error is not None:
+                    raise DownloadStopped('Download stopped') from ex
+                attempt += 1
+                if attempt > self.retries:
+                    raise DownloadError(f'Failed to download bytes {start}-{end}: {ex}') from ex
+                logging.warning( 'Download: Retrying bytes %s-%s after %s, attempt %s', offset, end, ex, attempt )
+                # Keep what arrived and ask for the rest
+                start = offset
+                await gen.sleep(min(RETRY_DELAY * 2 ** (attempt - 1), 10))
+
+    def _expected(self, response_start, headers: httputil.HTTPHeaders, start: int) -> bool:
+        if response_start is None:
+            return False
+        if response_start.code == 200:
+            # Only the first request may get the whole body
+            return start == 0 and self.size is None
+        if response_start.code != 206:
+            return False
+        content_range = CONTENT_RANGE.match(headers.get('Content-Range', ''))
+        return content_range is not None and int(content_range.group(1)) == start
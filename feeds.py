@@ -0,0 +1,361 @@
+"""
+Shared helpers for caching RSS feeds and serving them with HTTP validators.
+
+Every cached feed is a dict holding the rendered ``feed`` body, its ``expire`` time,
+an ``etag`` derived from the body, the ``last_modified`` time the body last changed and
+the body pre-compressed once per content coding in ``encoded``. A rebuilt feed whose
+body only differs in its ``lastBuildDate`` keeps the previous body and validators.
+"""
+from asyncio import ensure_future
+from configparser import ConfigParser
+import datetime
+import email.utils
+import gzip
+import hashlib
+import logging
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from tornado import ioloop, web
+import cache
+import utils
+
+FEED_EXPIRATION = datetime.timedelta(minutes=15)
+# Rendered anew with every build, whether the items changed or not
+LAST_BUILD_DATE = re.compile(rb'<lastBuildDate>[^<]*</lastBuildDate>')
+
+stale_grace = datetime.timedelta(hours=1)
+refresh_lead = datetime.timedelta(minutes=10)
+refresh_min_hits = 2
+refresh_period = 60000
+
+refreshers = []
+
+utils.stats['feed_refresh'] = {
+    'background_refreshes': 0,
+    'stale_served': 0
+}
+
+# Feeds of the scraping sources (Rumble, Bitchute, Dailymotion). YouTube keeps its own caches.
+feed_cache = cache.BoundedCache('feeds')
+
+def get_env_or_config_option(conf: ConfigParser,
+                             env_name: str,
+                             config_name: str,
+                             default_value = None):
+    """
+    Get the value of a configuration option of the ``general`` section, either
+    from the environment variables or from the configuration file.
+    """
+    return utils.get_env_or_config_option(conf, env_name,
+                                          config_name, "general",
+                                          default_value=default_value)
+
+def init(conf: ConfigParser, cleanup_period: int):
+    """
+    Read the feed cache and refresh settings and start the refresh and cleanup timers.
+
+    Args:
+        conf (ConfigParser): The configuration parser object.
+        cleanup_period (int): Periodicity of the cache cleanup. In milliseconds.
+
+    Returns:
+        None
+    """
+    global stale_grace, refresh_lead, refresh_min_hits, refresh_period
+    stale_grace      = datetime.timedelta(seconds=int(get_env_or_config_option(conf, "GENERAL_FEED_STALE_GRACE"     , "feed_stale_grace"     , default_value=3600)))
+    refresh_lead     = datetime.timedelta(seconds=int(get_env_or_config_option(conf, "GENERAL_FEED_REFRESH_LEAD"    , "feed_refresh_lead"    , default_value=600)))
+    refresh_min_hits = int(get_env_or_config_option(conf, "GENERAL_FEED_REFRESH_MIN_HITS", "feed_refresh_min_hits", default_value=2))
+    refresh_period   = int(get_env_or_config_option(conf, "GENERAL_FEED_REFRESH_PERIOD"  , "feed_refresh_period"  , default_value=60000))
+    feed_cache.limit(
+        int(get_env_or_config_option(conf, "GENERAL_FEED_CACHE_MAX_ENTRIES", "feed_cache_max_entries", default_value=10000)),
+        int(get_env_or_config_option(conf, "GENERAL_FEED_CACHE_MAX_BYTES"  , "feed_cache_max_bytes"  , default_value=268435456)) # 256MiB
+    )
+
+    ioloop.PeriodicCallback(
+        callback=refresh_hot_feeds,
+        callback_time=refresh_period
+    ).start()
+    ioloop.PeriodicCallback(
+        callback=cleanup,
+        callback_time=cleanup_period
+    ).start()
+
+def refresh_hot_feeds():
+    """
+    Refresh popular feeds of every FeedRefresher before they expire.
+    """
+    for refresher in refreshers:
+        refresher.refresh_hot()
+
+class FeedRefresher:
+    """
+    Serves cached feeds stale-while-revalidate and keeps popular feeds warm.
+
+    Every request of a feed is counted. Feeds requested at least ``refresh_min_hits``
+    times since their last build are rebuilt in the background once they are within
+    ``refresh_lead`` of expiring. An expired feed is still served for ``stale_grace``
+    while a single rebuild runs, so only feeds nobody polls make clients wait.
+
+    While ``conserve`` returns True, e.g. because the API quota runs low, cached feeds
+    are served however old they are and nothing is rebuilt in the background.
+    """
+    def __init__(self, feed_cache: dict, flight: utils.SingleFlight, conserve=None):
+        """
+        Args:
+            feed_cache (dict): The cache the feeds are stored in.
+            flight (utils.SingleFlight): Coalesces rebuilds with request driven builds.
+            conserve: A callable telling whether rebuilds should be avoided, or None.
+        """
+        self.feed_cache = feed_cache
+        self.flight = flight
+        self.conserve = conserve
+        self.popularity = {}
+        refreshers.append(self)
+
+    def conserving(self) -> bool:
+        """
+        Check whether rebuilds should be avoided.
+        """
+        return self.conserve is not None and self.conserve()
+
+    def get(self, key, rebuild) -> dict:
+        """
+        Record a request of a feed and return the cached copy if it may be served.
+
+        Args:
+            key: The cache key of the feed.
+            rebuild: A callable returning an awaitable that builds the feed and stores it in the cache.
+
+        Returns:
+            dict: The fresh or stale cache entry, or None if the caller has to wait for a build.
+        """
+        now = datetime.datetime.now()
+        popularity = self.popularity.setdefault(key, {'hits': 0})
+        popularity['hits'] += 1
+        popularity['last_hit'] = now
+        popularity['rebuild'] = rebuild
+        feed = self.feed_cache.get(key)
+        if feed is None:
+            return None
+        if feed['expire'] > now:
+            return feed
+        if self.conserving():
+            utils.stats['feed_refresh']['stale_served'] += 1
+            return feed
+        if feed['expire'] + stale_grace > now:
+            utils.stats['feed_refresh']['stale_served'] += 1
+            self.refresh(key)
+            return feed
+        return None
+
+    def refresh(self, key):
+        """
+        Rebuild a feed in the background unless a build of it is already running.
+
+        Args:
+            key: The cache key of the feed.
+        """
+        if key in self.flight.in_flight:
+            return
+        popularity = self.popularity[key]
+        popularity['hits'] = 0
+        utils.stats['feed_refresh']['background_refreshes'] += 1
+        logging.info( 'Feeds: Refreshing %s in the background', key )
+        future = ensure_future(self.flight.run(key, popularity['rebuild']))
+        future.add_done_callback(lambda f: self.log_refresh_error(key, f))
+
+    @staticmethod
+    def log_refresh_error(key, future):
+        """
+        Log the failure of a background refresh. The stale copy keeps being served.
+        """
+        if not future.cancelled() and future.exception() is not None:
+            logging.error( 'Feeds: Error refreshing %s: %s', key, future.exception() )
+
+    def refresh_hot(self):
+        """
+        Refresh popular feeds about to expire and forget feeds nobody requested for a while.
+        """
+        if self.conserving():
+            return
+        now = datetime.datetime.now()
+        for key, popularity in list(self.popularity.items()):
+            feed = self.feed_cache.get(key)
+            if feed is None or feed['expire'] + stale_grace < now:
+                if popularity['last_hit'] + stale_grace < now:
+                    del self.popularity[key]
+                continue
+            if popularity['hits'] >= refresh_min_hits and feed['expire'] - refresh_lead <= now:
+                self.refresh(key)
+
+def make_feed(body: bytes, expire: datetime.datetime, previous: dict = None) -> dict:
+    """
+    Create a cache entry for a rendered feed.
+
+    Args:
+        body (bytes): The rendered feed.
+        expire (datetime): The time the entry expires.
+        previous (dict): The entry this one replaces, if any. Its body and validators
+            are kept when only the build date changed.
+
+    Returns:
+        dict: The cache entry.
+    """
+    etag = '"' + hashlib.sha1(LAST_BUILD_DATE.sub(b'', body, count=1)).hexdigest() + '"'
+    if previous is not None and previous.get('etag') == etag:
+        return dict(previous, expire=expire)
+    return {
+        'feed': body,
+        'expire': expire,
+        'etag': etag,
+        'last_modified': datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0),
+        'encoded': compress(body)
+    }
+
+def compress(body: bytes) -> dict:
+    """
+    Compress a feed body with every supported content coding.
+
+    Args:
+        body (bytes): The rendered feed.
+
+    Returns:
+        dict: The compressed bodies by coding. Codings that don't make the body smaller are left out.
+    """
+    encoded = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(body, mode=brotli.MODE_TEXT, quality=9)
+    return {
+        coding: data
+        for coding, data in encoded.items()
+        if len(data) < len(body)
+    }
+
+def accepted_encodings(header: str) -> set:
+    """
+    Parse an Accept-Encoding header.
+
+    Args:
+        header (str): The header value.
+
+    Returns:
+        set: The codings the client accepts.
+    """
+    encodings = set()
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and not params[2:].strip('0.'):
+            continue # q=0 means "not acceptable"
+        encodings.add(coding.strip().lower())
+    return encodings
+
+async def get_feed(key: str, refresher, build, expiration: datetime.timedelta = FEED_EXPIRATION) -> dict:
+    """
+    Get a feed from ``feed_cache``, building and caching it when it is missing or expired.
+
+    Args:
+        key (str): The cache key of the feed.
+        refresher (FeedRefresher): The refresher of the source. Its flight coalesces
+            concurrent builds of the same key.
+        build: A callable returning an awaitable of the rendered feed, or of None on failure.
+        expiration (timedelta): How long a built feed stays cached.
+
+    Returns:
+        dict: The cache entry, or None if the feed could not be built.
+    """
+    rebuild = lambda: _build_feed(key, build, expiration)
+    feed = refresher.get(key, rebuild)
+    if feed is not None:
+        return feed
+    return await refresher.flight.run(key, rebuild)
+
+async def _build_feed(key, build, expiration):
+    body = await build()
+    if body is None:
+        return None
+    feed = make_feed(body, datetime.datetime.now() + expiration, feed_cache.get(key))
+    feed_cache[key] = feed
+    return feed
+
+def cleanup():
+    """
+    Remove expired feeds from ``feed_cache``.
+    """
+    feed_cache_length = feed_cache.remove_expired(datetime.datetime.now() - stale_grace)
+    if feed_cache_length:
+        logging.info( 'Feeds: Cleaned %s items from feed cache', feed_cache_length )
+
+class FeedHandler(web.RequestHandler):
+    """
+    Base class for handlers serving cached RSS feeds.
+
+    Answers conditional requests (If-None-Match / If-Modified-Since) with 304 Not Modified.
+    HEAD requests get the same headers as GET, including Content-Length, without the body.
+    Pre-compressed bodies are picked according to Accept-Encoding, so a cache hit costs no
+    compression work.
+    """
+    ENCODING_PREFERENCE = ('br', 'gzip')
+
+    def write_feed(self, feed: dict):
+        """
+        Write a cached feed, or a 304 response if the client already has it.
+
+        Args:
+            feed (dict): The cache entry to serve.
+        """
+        if feed is None:
+            raise web.HTTPError(404, reason='Feed not available')
+        body = feed['feed']
+        etag = feed['etag']
+        encoded = feed.get('encoded', {})
+        if encoded:
+            accepted = accepted_encodings(self.request.headers.get('Accept-Encoding', ''))
+            for coding in self.ENCODING_PREFERENCE:
+                if coding in encoded and coding in accepted:
+                    body = encoded[coding]
+                    etag = etag[:-1] + '-' + coding + '"'
+                    self.set_header('Content-Encoding', coding)
+                    break
+            if not self.settings.get('compress_response'):
+                # With compress_response Tornado's own transform adds the Vary header
+                self.set_header('Vary', 'Accept-Encoding')
+        self.set_header('Content-type', 'application/rss+xml')
+        self.set_header('Etag', etag)
+        self.set_header('Last-Modified', feed['last_modified'])
+        if self.is_feed_modified(feed):
+            self.write(body)
+        else:
+            self.set_status(304)
+        self.finish()
+
+    def is_feed_modified(self, feed: dict) -> bool:
+        """
+        Check the request validators against a cached feed.
+
+        Args:
+            feed (dict): The cache entry to check.
+
+        Returns:
+            bool: False if the client's copy is current, otherwise True.
+        """
+        if self.request.headers.get('If-None-Match'):
+            return not self.check_etag_header()
+        since = self.request.headers.get('If-Modified-Since')
+        if since:
+            try:
+                since = email.utils.parsedate_to_datetime(since)
+            except (TypeError, ValueError):
+                return True
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            return feed['last_modified'] > since
+        return True
+
+    def data_received(self, chunk):
+        pass
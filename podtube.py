@@ -11,6 +11,8 @@ import sys
 
 from tornado import ioloop, web
 import misaka
+import conversion_worker
+import feeds
 import utils
 import youtube
 import bitchute
@@ -43,6 +45,17 @@ class FileHandler(web.RequestHandler):
     def data_received(self, chunk):
         pass
 
+class StatsHandler(web.RequestHandler):
+    """Reports runtime statistics as JSON."""
+    def get(self):
+        """
+        A method to handle GET requests and serve the current statistics.
+        """
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(utils.stats)
+    def data_received(self, chunk):
+        pass
+
 def get_env_or_config_option(conf: ConfigParser,
                                 env_name: str,
                                 config_name: str,
@@ -77,6 +90,7 @@ def make_app(config: ConfigParser):
     - web.Application - the initialized web application.
     """
     youtube.init(config)
+    feeds.init(config, youtube.cleanup_period)
     webapp = web.Application([
         (r'/youtube/channel/(.*)', youtube.ChannelHandler, {
             'video_handler_path': '/youtube/video/',
@@ -90,6 +104,7 @@ def make_app(config: ConfigParser):
         (r'/youtube/audio/(.*)', youtube.AudioHandler),
         (r'/youtube/user/@(.*)', youtube.UserHandler, {'channel_handler_path':'/youtube/channel/'}),
         (r'/youtube/cache/', youtube.ClearCacheHandler),
+        (r'/youtube/conversions/', youtube.ConversionStatusHandler),
         (r'/rumble/user/(.*)', rumble.UserHandler),
         (r'/rumble/channel/(.*)', rumble.ChannelHandler),
         (r'/rumble/video/(.*)', rumble.VideoHandler),
@@ -98,6 +113,7 @@ def make_app(config: ConfigParser):
         (r'/bitchute/video/(.*)', bitchute.VideoHandler),
         (r'/dailymotion/channel/(.*)', dailymotion.ChannelHandler),
         (r'/dailymotion/video/(.*)', dailymotion.VideoHandler),
+        (r'/stats', StatsHandler),
         (r'/config.ini', web.RedirectHandler, {'url': '/'}),
         (r'/README.md', web.RedirectHandler, {'url': '/'}),
         (r'/Dockerfile', web.RedirectHandler, {'url': '/'}),
@@ -107,6 +123,24 @@ def make_app(config: ConfigParser):
     ], compress_response=True)
     return webapp
 
+def start_worker(config: ConfigParser) -> conversion_worker.WorkerServer:
+    """
+    Initializes the conversions and starts the conversion worker, which converts the audio
+    the web process asks for into ./audio.
+
+    Parameters:
+    - config: ConfigParser - the configuration, the same as the web process uses.
+
+    Returns:
+    - conversion_worker.WorkerServer - the started worker.
+    """
+    youtube.init(config, worker=True)
+    if not youtube.convert_worker:
+        raise ValueError('The conversion worker needs the convert_worker socket path')
+    server = conversion_worker.WorkerServer(youtube.conversion_queue, youtube.converted)
+    server.listen_unix(youtube.convert_worker)
+    return server
+
 if __name__ == '__main__':
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     if not os.path.exists('./audio'):
@@ -158,6 +192,10 @@ if __name__ == '__main__':
         action='version',
         version="%(prog)s " + __version__
     )
+    # "podtube.py worker" runs the conversion worker instead of the web server
+    worker = sys.argv[1:2] == ['worker']
+    if worker:
+        del sys.argv[1]
     args = parser.parse_args()
     conf = None
     env_conf_file = os.getenv("CONFIG_FILE")
@@ -180,13 +218,19 @@ if __name__ == '__main__':
         filename=args.log_file,
         filemode=args.log_filemode
     )
-    for file in glob.glob('audio/*.temp'):
-        os.remove(file)
+    # Left behind by interrupted conversions, unless a worker converts and may still be at it
+    if worker or not youtube.get_env_or_config_option(conf, "YT_CONVERT_WORKER", "convert_worker"):
+        for file in glob.glob('audio/*.temp'):
+            os.remove(file)
     logging.info("Start server")
     try:
-        app = make_app(conf)
-        app.listen(args.port)
-        logging.info("Podtube v%s started. Listening on %s" % (__version__, args.port))
+        if worker:
+            start_worker(conf)
+            logging.info("Podtube v%s conversion worker started" % __version__)
+        else:
+            app = make_app(conf)
+            app.listen(args.port)
+            logging.info("Podtube v%s started. Listening on %s" % (__version__, args.port))
         ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
         logging.info("Stopping server")
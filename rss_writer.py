@@ -0,0 +1,187 @@
+"""
+Streaming writer for the RSS/iTunes feeds of the YouTube handlers.
+
+FeedGenerator keeps every entry as an object, builds a complete lxml tree from them and
+serializes the tree in one go, so rendering a channel with thousands of uploads needs
+several times the memory of the resulting feed. FeedWriter renders each entry to bytes
+as soon as it is added and only keeps those, producing the same bytes as
+``FeedGenerator.rss_str()`` with the podcast extension loaded.
+"""
+import datetime
+import email.utils
+import re
+
+from dateutil import parser as date_parser
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+RSS_START = (
+    b'<rss xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd"'
+    b' xmlns:atom="http://www.w3.org/2005/Atom"'
+    b' xmlns:content="http://purl.org/rss/1.0/modules/content/"'
+    b' version="2.0"><channel>'
+)
+RSS_END = b'</channel></rss>'
+RSS_DOCS = 'http://www.rssboard.org/rss-specification'
+
+# Characters XML 1.0 does not allow. lxml refuses them, so FeedGenerator did as well.
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+def escape_text(value: str) -> str:
+    """
+    Escape a string for use as element content, the way lxml does.
+
+    Args:
+        value (str): The text to escape.
+
+    Returns:
+        str: The escaped text.
+
+    Raises:
+        ValueError: If the text contains characters XML does not allow.
+    """
+    if INVALID_XML_CHARS.search(value):
+        raise ValueError('All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters')
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+
+def escape_attribute(value: str) -> str:
+    """
+    Escape a string for use as an attribute value, the way lxml does.
+
+    Args:
+        value (str): The value to escape.
+
+    Returns:
+        str: The escaped value, without the surrounding quotes.
+    """
+    return escape_text(value).replace('"', '&quot;').replace('\n', '&#10;').replace('\t', '&#9;')
+
+def element(name: str, text) -> str:
+    """
+    Render a text element. Empty values are left out, as FeedGenerator does.
+    """
+    if not text:
+        return ''
+    return f'<{name}>{escape_text(text)}</{name}>'
+
+def format_date(date: datetime.datetime) -> str:
+    """
+    Format a date as RFC 2822, independent of the locale.
+    """
+    return email.utils.format_datetime(date)
+
+def parse_date(date: str) -> datetime.datetime:
+    """
+    Parse a date of the YouTube API.
+
+    Args:
+        date (str): The date, e.g. ``2024-01-01T00:00:00Z``.
+
+    Returns:
+        datetime: The parsed date.
+
+    Raises:
+        ValueError: If the date has no time zone.
+    """
+    date = date_parser.parse(date)
+    if date.tzinfo is None:
+        raise ValueError('Date has no timezone')
+    return date
+
+class FeedWriter:
+    """
+    Renders an RSS feed with iTunes tags entry by entry.
+
+    Like ``FeedGenerator.add_entry()`` the entries are written in the reverse order
+    they are added in, so adding the newest upload first puts it at the end of the feed.
+    """
+    def __init__(self, title: str, link: str, description: str, image: str,
+                 author: str, summary: str = None, generator: str = 'PodTube (python-feedgen)'):
+        """
+        Render the channel part of the feed.
+
+        Args:
+            title (str): The title of the feed.
+            link (str): The link of the feed, also used as its atom self link.
+            description (str): The description of the feed.
+            image (str): The URL of the feed's image.
+            author (str): The iTunes author of the feed.
+            summary (str): The iTunes summary of the feed.
+            generator (str): The generator of the feed.
+        """
+        last_build_date = datetime.datetime.now(datetime.timezone.utc)
+        self.header = ''.join((
+            element('title', title),
+            element('link', link),
+            element('description', description),
+            f'<atom:link href="{escape_attribute(link)}" rel="self"/>',
+            element('docs', RSS_DOCS),
+            element('generator', generator),
+            '<image>',
+            element('url', image),
+            element('title', title),
+            element('link', link),
+            '</image>',
+            element('language', 'en-US'),
+            element('lastBuildDate', format_date(last_build_date)),
+            element('itunes:author', author),
+            '<itunes:category text="Technology"/>',
+            f'<itunes:image href="{escape_attribute(image)}"/>',
+            element('itunes:explicit', 'no'),
+            '<itunes:owner>',
+            element('itunes:name', 'Podtube'),
+            element('itunes:email', 'armware+podtube@gmail.com'),
+            '</itunes:owner>',
+            element('itunes:summary', summary)
+        )).encode('utf-8')
+        self.entries = []
+
+    def add_entry(self, guid: str, title: str, link: str, description: str, author: str,
+                  image: str, published: datetime.datetime, enclosure_url: str = None,
+                  enclosure_type: str = None):
+        """
+        Render an entry of the feed.
+
+        Args:
+            guid (str): The id of the entry. It is not a permalink.
+            title (str): The title of the entry.
+            link (str): The link of the entry.
+            description (str): The description, also used as iTunes summary.
+            author (str): The iTunes author of the entry.
+            image (str): The URL of the entry's iTunes image.
+            published (datetime): The publication date. Must carry a time zone.
+            enclosure_url (str): The URL of the enclosed media, if any.
+            enclosure_type (str): The MIME type of the enclosed media.
+        """
+        if not (title or description):
+            raise ValueError('Required fields not set')
+        enclosure = ''
+        if enclosure_url:
+            enclosure = (
+                f'<enclosure url="{escape_attribute(enclosure_url)}" length="None"'
+                f' type="{escape_attribute(enclosure_type)}"/>'
+            )
+        self.entries.append(''.join((
+            '<item>',
+            element('title', title),
+            element('link', link),
+            element('description', description),
+            f'<guid isPermaLink="false">{escape_text(guid)}</guid>',
+            enclosure,
+            element('pubDate', format_date(published)),
+            element('itunes:author', author),
+            f'<itunes:image href="{escape_attribute(image)}"/>' if image else '',
+            element('itunes:summary', description),
+            '</item>'
+        )).encode('utf-8'))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rss_bytes(self) -> bytes:
+        """
+        Assemble the rendered feed.
+
+        Returns:
+            bytes: The feed, as ``FeedGenerator.rss_str()`` would have produced it.
+        """
+        return b''.join((XML_DECLARATION, RSS_START, self.header, *reversed(self.entries), RSS_END))
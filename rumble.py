@@ -10,28 +10,35 @@ import json
 
 from feedgen.feed import FeedGenerator
 from bs4 import BeautifulSoup
-from tornado import web
+from tornado import gen, ioloop, web
+import feeds
+import utils
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.104 Safari/537.36'
 }
 
-class ChannelHandler(web.RequestHandler):
+feed_refresher = feeds.FeedRefresher(feeds.feed_cache, utils.SingleFlight('rumble'))
 
+class ChannelHandler(feeds.FeedHandler):
+
+    @gen.coroutine
     def head(self, channel):
-        self.set_header('Content-type', 'application/rss+xml')
-        self.set_header('Accept-Ranges', 'bytes')
+        yield self.get( channel )
 
+    @gen.coroutine
     def get(self, channel):
         logging.debug( "Got channel: %s", channel )
 
         url = "https://rumble.com/c/%s" % channel
         logging.info( "Rumble: Handling URL: %s", url )
 
-        self.set_header('Content-type', 'application/rss+xml')
-        feed = self.generate_rss( channel )
-        self.write( feed )
-        self.finish()
+        feed = yield feeds.get_feed(
+            f"rumble/channel/{channel}",
+            feed_refresher,
+            lambda: ioloop.IOLoop.current().run_in_executor( None, self.generate_rss, channel )
+        )
+        self.write_feed( feed )
 
     def get_html( self, channel ):
         url = "https://rumble.com/c/%s" % channel
@@ -142,21 +149,24 @@ class ChannelHandler(web.RequestHandler):
             )
         return feed.rss_str( pretty=True )
 
-class UserHandler(web.RequestHandler):
+class UserHandler(feeds.FeedHandler):
+    @gen.coroutine
     def head(self, user):
-        self.set_header('Content-type', 'application/rss+xml')
-        self.set_header('Accept-Ranges', 'bytes')
+        yield self.get( user )
 
+    @gen.coroutine
     def get(self, user):
         logging.debug( "Got user: %s", user )
 
         url = f"https://rumble.com/user/{user}"
         logging.info( "Handling Rumble URL: %s", url )
 
-        self.set_header('Content-type', 'application/rss+xml')
-        feed = self.generate_rss( user )
-        self.write( feed )
-        self.finish()
+        feed = yield feeds.get_feed(
+            f"rumble/user/{user}",
+            feed_refresher,
+            lambda: ioloop.IOLoop.current().run_in_executor( None, self.generate_rss, user )
+        )
+        self.write_feed( feed )
 
     def get_html( self, user ):
         url = f"https://rumble.com/user/{user}"
@@ -174,8 +184,7 @@ class UserHandler(web.RequestHandler):
         html = self.get_html( user )
         if html is None:
             logging.error("Rumble returned 404: Not found")
-            self.set_status( 404 )
-            return None
+            raise web.HTTPError( 404 )
         bs = BeautifulSoup( html, 'lxml' )
 
         feed = FeedGenerator()
@@ -275,21 +284,24 @@ class UserHandler(web.RequestHandler):
             logging.error("Failed to find video list")
         return feed.rss_str( pretty=True )
 
-class CategoryHandler(web.RequestHandler):
+class CategoryHandler(feeds.FeedHandler):
+    @gen.coroutine
     def head(self, category):
-        self.set_header('Content-type', 'application/rss+xml')
-        self.set_header('Accept-Ranges', 'bytes')
+        yield self.get( category )
 
+    @gen.coroutine
     def get(self, category):
         logging.info( "Got category: %s", category )
 
         url = f"https://rumble.com/category/{category}"
         logging.info( "Handling Rumble URL: %s", url )
 
-        self.set_header('Content-type', 'application/rss+xml')
-        feed = self.generate_rss( category )
-        self.write( feed )
-        self.finish()
+        feed = yield feeds.get_feed(
+            f"rumble/category/{category}",
+            feed_refresher,
+            lambda: ioloop.IOLoop.current().run_in_executor( None, self.generate_rss, category )
+        )
+        self.write_feed( feed )
 
     def get_html(self, category):
         url = f"https://rumble.com/category/{category}/recorded"
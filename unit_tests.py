@@ -4,9 +4,28 @@
 Unit tests for PodTube
 """
 
+import datetime
+import gzip
+import json
+import os
+import re
+import tempfile
+import time
 import unittest
+from unittest import mock
 import sys
+from feedgen.feed import FeedGenerator
+from tornado import concurrent, gen, httpclient, ioloop, iostream, web
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+import cache
+import conversion
+import conversion_worker
+import download
 import podtube
+import rss_writer
+import utils
+import youtube
+import youtube_api
 
 class TestPodTube(unittest.TestCase):
     """Run unit tests on PodTube."""
@@ -20,5 +39,1235 @@ class TestPodTube(unittest.TestCase):
         except Exception as e:
             self.fail(f"podtube.py threw an error: {e}")
 
+class TestPersistentCache(unittest.TestCase):
+    """Run unit tests on the on-disk cache store."""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_rehydrate(self):
+        """
+        Test that unexpired entries survive a restart and expired ones do not.
+        """
+        now = datetime.datetime.now()
+        store = cache.PersistentStore(self.path)
+        feeds = cache.PersistentDict('channel_feed')
+        feeds.attach(store)
+        feeds['fresh'] = {'feed': b'<rss/>', 'expire': now + datetime.timedelta(hours=1)}
+        feeds['stale'] = {'feed': b'<rss/>', 'expire': now - datetime.timedelta(hours=1)}
+        feeds['deleted'] = {'feed': b'<rss/>', 'expire': now + datetime.timedelta(hours=1)}
+        del feeds['deleted']
+        store.close()
+
+        store = cache.PersistentStore(self.path)
+        feeds = cache.PersistentDict('channel_feed')
+        feeds.attach(store)
+        links = cache.PersistentDict('video_links')
+        links.attach(store)
+        store.close()
+        self.assertEqual(list(feeds.keys()), ['fresh'])
+        self.assertEqual(feeds['fresh']['feed'], b'<rss/>')
+        self.assertEqual(len(links), 0)
+
+    def test_rehydrate_stale(self):
+        """
+        Test that expired entries are kept for a grace period, or until the owner prunes them.
+        """
+        now = datetime.datetime.now()
+        store = cache.PersistentStore(self.path)
+        feeds = cache.PersistentDict('channel_feed')
+        feeds.attach(store)
+        feeds['stale'] = {'feed': b'<rss/>', 'expire': now - datetime.timedelta(minutes=30)}
+        feeds['old'] = {'feed': b'<rss/>', 'expire': now - datetime.timedelta(hours=2)}
+        store.close()
+
+        store = cache.PersistentStore(self.path)
+        feeds = cache.PersistentDict('channel_feed')
+        feeds.attach(store, grace=None)
+        self.assertEqual(sorted(feeds.keys()), ['old', 'stale'])
+        feeds = cache.PersistentDict('channel_feed')
+        feeds.attach(store, grace=datetime.timedelta(hours=1))
+        store.close()
+        self.assertEqual(list(feeds.keys()), ['stale'])
+
+class TestBoundedCache(unittest.TestCase):
+    """Run unit tests on the size limited cache."""
+    def test_evicts_least_recently_used(self):
+        """
+        Test that the least recently used entries are evicted when a limit is exceeded.
+        """
+        expire = datetime.datetime.now() + datetime.timedelta(hours=1)
+        links = cache.BoundedCache('video_links', max_entries=2)
+        links['a'] = {'url': 'a', 'expire': expire}
+        links['b'] = {'url': 'b', 'expire': expire}
+        links.get('a')
+        links['c'] = {'url': 'c', 'expire': expire}
+        self.assertEqual(sorted(links), ['a', 'c'])
+
+        feeds = cache.BoundedCache('channel_feed', max_bytes=2500)
+        for name in ('x', 'y', 'z'):
+            feeds[name] = {'feed': b'.' * 1000, 'expire': expire}
+        self.assertEqual(sorted(feeds), ['y', 'z'])
+        self.assertLessEqual(feeds.total_bytes, 2500)
+        self.assertEqual(feeds.evictions, 1)
+
+    def test_remove_expired(self):
+        """
+        Test that replaced entries are expired by their current expiry time only.
+        """
+        now = datetime.datetime.now()
+        links = cache.BoundedCache('video_links')
+        links['old'] = {'url': 'old', 'expire': now - datetime.timedelta(minutes=1)}
+        links['renewed'] = {'url': 'renewed', 'expire': now - datetime.timedelta(minutes=1)}
+        links['renewed'] = {'url': 'renewed', 'expire': now + datetime.timedelta(hours=1)}
+        links['fresh'] = {'url': 'fresh', 'expire': now + datetime.timedelta(hours=1)}
+        self.assertEqual(links.remove_expired(now), 1)
+        self.assertEqual(sorted(links), ['fresh', 'renewed'])
+        self.assertEqual(links.remove_expired(now + datetime.timedelta(hours=2)), 2)
+        self.assertEqual(len(links), 0)
+        self.assertEqual(links.total_bytes, 0)
+
+class TestConversionScheduler(AsyncTestCase):
+    """Run unit tests on the conversion job scheduler."""
+    CONVERT_TIME = 0.1
+
+    def setUp(self):
+        super().setUp()
+        self.started = {}
+        self.running = 0
+        self.max_running = 0
+        self.scheduler = conversion.ConversionScheduler(self.convert, concurrency=2)
+
+    async def convert(self, job):
+        self.started[job.key] = time.monotonic()
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await gen.sleep(self.CONVERT_TIME)
+        self.running -= 1
+
+    @gen_test(timeout=10)
+    def test_runs_jobs_without_polling(self):
+        """
+        Test that jobs start right away, back-to-back, by priority and within the concurrency limit.
+        """
+        enqueued = time.monotonic()
+        self.scheduler.enqueue('a', conversion.PRIORITY_AUTOLOAD)
+        self.scheduler.enqueue('b', conversion.PRIORITY_AUTOLOAD)
+        self.scheduler.enqueue('c', conversion.PRIORITY_AUTOLOAD)
+        self.scheduler.enqueue('d', conversion.PRIORITY_INTERACTIVE)
+        self.assertIs(self.scheduler.enqueue('a'), self.scheduler.jobs['a'])
+        while len(self.scheduler):
+            yield gen.sleep(0.01)
+        self.assertLess(self.started['a'] - enqueued, 0.05)
+        self.assertLess(self.started['d'], self.started['c'])
+        self.assertLess(self.started['c'] - enqueued, self.CONVERT_TIME * 1.5)
+        self.assertEqual(self.max_running, 2)
+
+    @gen_test(timeout=10)
+    def test_raising_concurrency_starts_waiting_jobs(self):
+        """
+        Test that waiting jobs start as soon as the concurrency is raised.
+        """
+        self.scheduler.set_concurrency(1)
+        for key in 'abc':
+            self.scheduler.enqueue(key)
+        yield gen.sleep(0.01)
+        self.assertEqual(self.running, 1)
+        self.scheduler.set_concurrency(3)
+        yield gen.sleep(0.01)
+        self.assertEqual(self.running, 3)
+
+    async def convert_until_stopped(self, job):
+        stopped = concurrent.Future()
+        job.stop = lambda: stopped.set_result(None)
+        self.running += 1
+        await stopped
+        self.running -= 1
+
+    @gen_test(timeout=10)
+    def test_time_limits(self):
+        """
+        Test that conversions running too long or without progress are cancelled.
+        """
+        self.scheduler.convert = self.convert_until_stopped
+        self.scheduler.limit(timeout=0.3, stall_timeout=0.1)
+        with mock.patch.object(conversion.ConversionScheduler, 'WATCH_PERIOD', 0.02):
+            self.scheduler.start()
+            stalled = self.scheduler.enqueue('stalled')
+            progressing = self.scheduler.enqueue('progressing')
+            for out_time in range(8):
+                progressing.update_progress({'out_time_us': str(out_time * 1000000)})
+                yield gen.sleep(0.05)
+            result = yield progressing.wait()
+        self.scheduler.watching.stop()
+        self.assertEqual((stalled.result, stalled.cancelled), (conversion.RESULT_CANCELLED, 'stalled'))
+        self.assertEqual((result, progressing.cancelled), (conversion.RESULT_CANCELLED, 'timeout'))
+        self.assertEqual(self.running, 0)
+
+    @gen_test(timeout=10)
+    def test_abandoned_jobs_cancelled(self):
+        """
+        Test that jobs are cancelled once every client waiting for them gave up, except prefetches.
+        """
+        self.scheduler.convert = self.convert_until_stopped
+        self.scheduler.set_concurrency(1)
+        self.scheduler.limit(cancel_abandoned=True)
+        running = self.scheduler.enqueue('running')
+        queued = self.scheduler.enqueue('queued')
+        prefetch = self.scheduler.enqueue('prefetch', conversion.PRIORITY_AUTOLOAD)
+        waiters = [job.wait() for job in (running, running, queued, prefetch)]
+        running.cancel_wait(waiters[0])
+        self.assertIsNone(running.cancelled)
+        running.cancel_wait(waiters[1])
+        queued.cancel_wait(waiters[2])
+        prefetch.cancel_wait(waiters[3])
+        yield running.wait()
+        self.assertEqual((running.result, running.cancelled), (conversion.RESULT_CANCELLED, 'abandoned'))
+        self.assertEqual(queued.result, conversion.RESULT_CANCELLED)
+        self.assertNotIn('queued', self.scheduler)
+        yield gen.sleep(0.01)
+        self.assertIsNone(prefetch.cancelled)
+        self.assertEqual(self.running, 1)
+        prefetch.stop()
+
+    @gen_test(timeout=10)
+    def test_journal_restores_jobs(self):
+        """
+        Test that queued and interrupted jobs are enqueued again after a restart, except finished and failing ones.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.sqlite')
+            store = cache.PersistentStore(path)
+            journal = cache.PersistentDict('conversion_jobs')
+            journal.attach(store)
+            first = conversion.ConversionScheduler(self.convert_until_stopped, concurrency=1)
+            first.restore(journal)
+            running = first.enqueue('running', conversion.PRIORITY_AUTOLOAD)
+            first.enqueue('queued')
+            first.enqueue('done')
+            journal['failing'] = dict(journal['done'], started=datetime.datetime.now(), restarts=conversion.MAX_RESTARTS)
+            yield gen.sleep(0.01)
+            # Crash, leaving the journal behind
+            store.close()
+            first.journal = None
+            running.stop()
+
+            store = cache.PersistentStore(path)
+            journal = cache.PersistentDict('conversion_jobs')
+            journal.attach(store)
+            restored = self.scheduler.restore(journal, lambda key: key == 'done')
+            self.assertEqual(restored, 2)
+            self.assertEqual(set(journal), {'running', 'queued'})
+            jobs = self.scheduler.jobs
+            self.assertEqual((jobs['running'].restarts, jobs['running'].prefetch), (1, True))
+            self.assertEqual((jobs['queued'].restarts, jobs['queued'].prefetch), (0, False))
+            self.assertEqual(jobs['running'].added, running.added)
+            yield [jobs['running'].wait(), jobs['queued'].wait()]
+            self.assertEqual(set(self.started), {'running', 'queued'})
+            self.assertEqual(len(journal), 0)
+            store.close()
+
+    @gen_test(timeout=10)
+    def test_prefetches_held(self):
+        """
+        Test that prefetches wait while they are not allowed, unless a client asks for them.
+        """
+        allowed = False
+        self.scheduler.hold_prefetches(lambda: allowed)
+        self.scheduler.enqueue('prefetch', conversion.PRIORITY_AUTOLOAD)
+        self.scheduler.enqueue('later', conversion.PRIORITY_AUTOLOAD)
+        self.scheduler.enqueue('interactive')
+        yield gen.sleep(0.01)
+        self.assertEqual(set(self.started), {'interactive'})
+        self.assertTrue(self.scheduler.status()['prefetches_held'])
+        self.scheduler.enqueue('prefetch')
+        yield gen.sleep(0.01)
+        self.assertIn('prefetch', self.started)
+        yield gen.sleep(self.CONVERT_TIME * 1.5)
+        self.assertNotIn('later', self.started)
+        allowed = True
+        with mock.patch.object(conversion.ConversionScheduler, 'HOLD_PERIOD', 0.02):
+            self.scheduler.start()
+            yield gen.sleep(0.05)
+        self.scheduler.holding.stop()
+        self.assertIn('later', self.started)
+
+class TestConversionWorker(AsyncTestCase):
+    """Run unit tests on handing conversions to a worker process over a Unix socket."""
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'worker.sock')
+        self.converted = []
+        self.scheduler = conversion.ConversionScheduler(self.convert, concurrency=1)
+        self.server = conversion_worker.WorkerServer(self.scheduler, lambda key: key == 'done')
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+        super().tearDown()
+
+    async def convert(self, job):
+        stopped = concurrent.Future()
+        job.stop = lambda: stopped.set_result(None)
+        try:
+            await gen.with_timeout(datetime.timedelta(seconds=0.1), stopped)
+            return conversion.RESULT_CANCELLED
+        except gen.TimeoutError:
+            self.converted.append(job.key)
+            return conversion.RESULT_SUCCESS
+
+    @gen_test(timeout=10)
+    def test_conversions_handed_to_worker(self):
+        """
+        Test that jobs enqueued in the web process run in the worker, by priority, once it can be reached.
+        """
+        client = conversion_worker.WorkerClient(self.path)
+        with mock.patch.object(conversion_worker.WorkerClient, 'RECONNECT_PERIOD', 0.05):
+            client.start()
+            first = client.enqueue('first')
+            prefetch = client.enqueue('prefetch', conversion.PRIORITY_AUTOLOAD)
+            later = client.enqueue('later', conversion.PRIORITY_AUTOLOAD)
+            done = client.enqueue('done')
+            yield gen.sleep(0.1)
+            self.assertEqual(client.status()['worker'], 'disconnected')
+            self.server.listen_unix(self.path)
+            results = yield [done.wait(), gen.sleep(0.03)]
+            self.assertEqual(results[0], conversion.RESULT_SUCCESS)
+            # Moved up while waiting in the worker
+            client.enqueue('later')
+            results = yield [first.wait(), prefetch.wait(), later.wait()]
+            self.assertEqual(results, [conversion.RESULT_SUCCESS] * 3)
+        self.assertEqual(self.converted, ['first', 'later', 'prefetch'])
+        self.assertEqual(client.status()['worker'], 'connected')
+
+    @gen_test(timeout=10)
+    def test_cancelled_in_worker(self):
+        """
+        Test that cancelling a job in the web process stops the conversion in the worker.
+        """
+        self.server.listen_unix(self.path)
+        client = conversion_worker.WorkerClient(self.path)
+        client.start()
+        job = client.enqueue('cancelled')
+        yield gen.sleep(0.05)
+        self.assertIn('cancelled', self.scheduler)
+        job.cancel('abandoned')
+        result = yield job.wait()
+        self.assertEqual(result, conversion.RESULT_CANCELLED)
+        self.assertEqual(self.scheduler.recent[0].cancelled, 'abandoned')
+        self.assertEqual(self.converted, [])
+
+class TestConcurrencyTuner(unittest.TestCase):
+    """Run unit tests on the conversion concurrency tuner."""
+    def test_capacity(self):
+        """
+        Test that a core is kept for the IOLoop and the load of other processes is left room.
+        """
+        with mock.patch('conversion.load_average', return_value=None):
+            self.assertEqual(conversion.ConcurrencyTuner(cores=1).capacity(0), 1)
+            self.assertEqual(conversion.ConcurrencyTuner(cores=32).capacity(0), 31)
+            self.assertEqual(conversion.ConcurrencyTuner(cores=32, threads=4).capacity(0), 7)
+        with mock.patch('conversion.load_average', return_value=5.0):
+            # Two of the five are the running conversions
+            self.assertEqual(conversion.ConcurrencyTuner(cores=8).capacity(2), 4)
+        with mock.patch('conversion.load_average', return_value=40.0):
+            self.assertEqual(conversion.ConcurrencyTuner(cores=8).capacity(2), 1)
+
+    def test_target(self):
+        """
+        Test that the concurrency grows while jobs wait and shrinks when conversions slow each other down.
+        """
+        tuner = conversion.ConcurrencyTuner(cores=8)
+        with mock.patch('conversion.load_average', return_value=None):
+            self.assertEqual(tuner.target(2, 2, 3), 3)
+            self.assertEqual(tuner.target(2, 2, 0), 2)
+            self.assertEqual(tuner.target(7, 7, 3), 7)
+            tuner.record(20.0, 1)
+            tuner.record(18.0, 3)
+            self.assertEqual(tuner.target(3, 3, 3), 4)
+            tuner.record(5.0, 4)
+            tuner.record(2.0, 4)
+            self.assertTrue(tuner.contended())
+            self.assertEqual(tuner.target(4, 4, 3), 3)
+            # Measured again at the lower concurrency before going further
+            self.assertFalse(tuner.contended())
+
+class TestRssWriter(unittest.TestCase):
+    """Run unit tests on the streaming feed writer."""
+    ENTRIES = [
+        ('a1', 'Fish & <Chips> "live"', 'Line one\r\nLine two > one', '2024-01-02T10:00:00Z'),
+        ('b2', 'Ünïcode 😀', '', '2023-12-31T23:59:59+01:00'),
+        ('c3', '', 'Only a description', '2023-06-01T00:00:00Z'),
+    ]
+
+    @staticmethod
+    def strip_build_date(body):
+        return re.sub(rb'<lastBuildDate>[^<]*</lastBuildDate>', b'', body)
+
+    def test_matches_feedgen(self):
+        """
+        Test that the writer produces the bytes FeedGenerator produced.
+        """
+        image = 'http://example.com/a&b.jpg'
+        fg = FeedGenerator()
+        fg.load_extension('podcast')
+        fg.generator('PodTube (python-feedgen)', youtube.__version__, 'https://github.com/amckee/PodTube')
+        fg.title('Tom & Jerry')
+        fg.description(' ')
+        fg.author(name='Podtube', email='armware+podtube@gmail.com', uri='https://github.com/amckee/PodTube')
+        fg.podcast.itunes_author('Tom & Jerry')
+        fg.image(image)
+        fg.link(href='https://www.youtube.com/channel/x?a=1&b=2', rel='self')
+        fg.language('en-US')
+        fg.podcast.itunes_image(image)
+        fg.podcast.itunes_explicit('no')
+        fg.podcast.itunes_owner(name='Podtube', email='armware+podtube@gmail.com')
+        fg.podcast.itunes_summary('A "summary"\n')
+        fg.podcast.itunes_category(cat='Technology')
+        writer = rss_writer.FeedWriter(
+            title='Tom & Jerry',
+            link='https://www.youtube.com/channel/x?a=1&b=2',
+            description=' ',
+            image=image,
+            author='Tom & Jerry',
+            summary='A "summary"\n'
+        )
+        for index, (video, title, description, published) in enumerate(self.ENTRIES):
+            url = f'http://localhost/youtube/audio/{video}?q="{index}"&\t'
+            fe = fg.add_entry()
+            fe.title(title)
+            fe.id(video)
+            fe.podcast.itunes_image(image)
+            fe.enclosure(url=url, type='audio/mpeg')
+            fe.author(name='Author')
+            fe.podcast.itunes_author('Author')
+            fe.pubDate(published)
+            fe.link(href=f'https://www.youtube.com/watch?v={video}', title=title)
+            fe.podcast.itunes_summary(description)
+            fe.description(description)
+            writer.add_entry(
+                guid=video,
+                title=title,
+                link=f'https://www.youtube.com/watch?v={video}',
+                description=description,
+                author='Author',
+                image=image,
+                published=rss_writer.parse_date(published),
+                enclosure_url=url,
+                enclosure_type='audio/mpeg'
+            )
+        self.assertEqual(self.strip_build_date(writer.rss_bytes()),
+                         self.strip_build_date(fg.rss_str()))
+
+    def test_rejects_control_characters(self):
+        """
+        Test that text XML can't represent is refused like lxml refuses it.
+        """
+        writer = rss_writer.FeedWriter('t', 'http://l', 'd', 'http://i', 'a')
+        with self.assertRaises(ValueError):
+            writer.add_entry('v', 'bell\x07', 'http://l', '', 'a', 'http://i',
+                             rss_writer.parse_date('2024-01-01T00:00:00Z'))
+
+class StubYouTubeApiHandler(web.RequestHandler):
+    """A slow stand-in for the YouTube Data API."""
+    DELAY = 0.2
+    PAGE_SIZE = 2
+    video_count = 6
+    calls = {}
+
+    async def get(self, endpoint):
+        StubYouTubeApiHandler.calls[endpoint] = StubYouTubeApiHandler.calls.get(endpoint, 0) + 1
+        await gen.sleep(self.DELAY)
+        thumbnails = {'default': {'url': 'http://example.com/a.jpg', 'width': 88}}
+        if endpoint == 'channels':
+            # Usernames are no channel ids, they are looked up with forUsername
+            if self.get_argument('id', '').startswith('user-'):
+                self.set_status(404)
+                return
+            channel_id = self.get_argument('id', None) or 'UC' + self.get_argument('forUsername')
+            self.write({'items': [{
+                'id': channel_id,
+                'contentDetails': {'relatedPlaylists': {'uploads': 'UU' + channel_id}},
+                'snippet': {'title': 'Stub channel', 'description': 'Stub', 'thumbnails': thumbnails}
+            }]})
+            return
+        start = int(self.get_argument('pageToken', None) or 0)
+        end = min(start + self.PAGE_SIZE, self.video_count)
+        response = {'items': [{
+            'snippet': {
+                'title': f'Video {index}',
+                'description': 'Stub video',
+                'channelTitle': 'Stub channel',
+                'channelId': 'stub',
+                'publishedAt': '2024-01-01T00:00:00Z',
+                'thumbnails': thumbnails
+            },
+            'contentDetails': {'videoId': f'{self.get_argument("playlistId")}-{index}'}
+        } for index in range(self.video_count - start - 1, self.video_count - end - 1, -1)]}
+        if end < self.video_count:
+            response['nextPageToken'] = str(end)
+        self.write(response)
+
+class TestYouTubeApi(AsyncHTTPTestCase):
+    """Run feed builds against a local stub of the YouTube Data API."""
+    def get_app(self):
+        return web.Application([
+            (r'/youtube/v3/(.*)', StubYouTubeApiHandler),
+            (r'/youtube/channel/(.*)', youtube.ChannelHandler, {
+                'video_handler_path': '/youtube/video/',
+                'audio_handler_path': '/youtube/audio/',
+            }),
+        ])
+
+    def setUp(self):
+        super().setUp()
+        youtube_api.api_url = self.get_url('/youtube/v3/')
+        youtube.channel_feed.clear()
+        youtube.channel_items.clear()
+        StubYouTubeApiHandler.video_count = 6
+        StubYouTubeApiHandler.calls = {}
+        youtube_api.ledger.clear()
+        youtube_api.daily_quota = 10000
+        youtube_api.quota_reserve = 1000
+
+    def tearDown(self):
+        youtube_api.api_url = youtube_api.API_URL
+        youtube_api.daily_quota = 10000
+        super().tearDown()
+
+    @gen_test(timeout=10)
+    def test_concurrent_channel_feeds(self):
+        """
+        Test that two slow channel feeds are built concurrently instead of one after another.
+        """
+        pages = StubYouTubeApiHandler.video_count // StubYouTubeApiHandler.PAGE_SIZE
+        single_build = StubYouTubeApiHandler.DELAY * (1 + pages)
+        started = time.monotonic()
+        responses = yield [
+            self.http_client.fetch(self.get_url('/youtube/channel/first')),
+            self.http_client.fetch(self.get_url('/youtube/channel/second')),
+        ]
+        elapsed = time.monotonic() - started
+        for response in responses:
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body.count(b'<item>'), StubYouTubeApiHandler.video_count)
+        self.assertLess(elapsed, 1.5 * single_build)
+
+    @gen_test(timeout=10)
+    def test_coalesced_channel_feed(self):
+        """
+        Test that concurrent requests for an uncached channel share one build.
+        """
+        coalesced = utils.stats['coalesced_requests']['youtube_channel']
+        responses = yield [self.http_client.fetch(self.get_url('/youtube/channel/first')) for _ in range(3)]
+        self.assertEqual(StubYouTubeApiHandler.calls['channels'], 1)
+        self.assertEqual(utils.stats['coalesced_requests']['youtube_channel'], coalesced + 2)
+        self.assertEqual(len({response.body for response in responses}), 1)
+
+    @gen_test(timeout=10)
+    def test_conditional_channel_feed(self):
+        """
+        Test that cached feeds carry validators and answer conditional requests with 304.
+        """
+        url = self.get_url('/youtube/channel/first')
+        response = yield self.http_client.fetch(url)
+        etag = response.headers['Etag']
+        last_modified = response.headers['Last-Modified']
+        response = yield self.http_client.fetch(url, headers={'If-None-Match': etag}, raise_error=False)
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b'')
+        response = yield self.http_client.fetch(url, headers={'If-Modified-Since': last_modified}, raise_error=False)
+        self.assertEqual(response.code, 304)
+        response = yield self.http_client.fetch(url, headers={'If-None-Match': '"stale"'}, decompress_response=False)
+        self.assertEqual(response.code, 200)
+        head = yield self.http_client.fetch(url, method='HEAD', decompress_response=False)
+        self.assertEqual(head.headers['Etag'], response.headers['Etag'])
+        self.assertEqual(int(head.headers['Content-Length']), len(response.body))
+        self.assertEqual(StubYouTubeApiHandler.calls['channels'], 1)
+
+    @gen_test(timeout=10)
+    def test_rebuilt_channel_feed_not_modified(self):
+        """
+        Test that rebuilding a feed with the same items keeps its validators.
+        """
+        url = self.get_url('/youtube/channel/first')
+        response = yield self.http_client.fetch(url)
+        etag = response.headers['Etag']
+        last_modified = response.headers['Last-Modified']
+        # Let the build date change
+        yield gen.sleep(1.1)
+        youtube.channel_feed['first/video'] = dict(
+            youtube.channel_feed['first/video'],
+            expire=datetime.datetime.now() - 2 * youtube.feeds.stale_grace
+        )
+        response = yield self.http_client.fetch(url, headers={'If-None-Match': etag}, raise_error=False)
+        self.assertEqual(response.code, 304)
+        self.assertEqual(StubYouTubeApiHandler.calls['channels'], 2)
+        self.assertEqual(response.headers['Last-Modified'], last_modified)
+
+    @gen_test(timeout=10)
+    def test_precompressed_channel_feed(self):
+        """
+        Test that feeds are served from the pre-compressed variant when the client accepts gzip.
+        """
+        url = self.get_url('/youtube/channel/first')
+        plain = yield self.http_client.fetch(url, headers={'Accept-Encoding': 'identity'}, decompress_response=False)
+        compressed = yield self.http_client.fetch(url, headers={'Accept-Encoding': 'gzip'}, decompress_response=False)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.body), plain.body)
+        self.assertNotEqual(compressed.headers['Etag'], plain.headers['Etag'])
+
+    @gen_test(timeout=10)
+    def test_stale_channel_feed_refreshed_in_background(self):
+        """
+        Test that an expired feed is served stale right away while one refresh runs in the background.
+        """
+        url = self.get_url('/youtube/channel/first')
+        yield self.http_client.fetch(url)
+        youtube.channel_feed['first/video']['expire'] = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        started = time.monotonic()
+        yield [self.http_client.fetch(url) for _ in range(3)]
+        self.assertLess(time.monotonic() - started, StubYouTubeApiHandler.DELAY)
+        while youtube.channel_builds.in_flight:
+            yield gen.sleep(0.05)
+        self.assertEqual(StubYouTubeApiHandler.calls['channels'], 2)
+        self.assertGreater(youtube.channel_feed['first/video']['expire'], datetime.datetime.now())
+
+    @gen_test(timeout=10)
+    def test_username_feed_refreshed(self):
+        """
+        Test that refreshing a popular feed requested by username rebuilds the username feed.
+        """
+        yield self.http_client.fetch(self.get_url('/youtube/channel/user-first'))
+        self.assertIn('UCuser-first/video', youtube.channel_feed)
+        # Popular, with the rebuild of the request that built the feed
+        youtube.channel_refresher.popularity['user-first/video']['hits'] = youtube.feeds.refresh_min_hits
+        expiring = datetime.datetime.now()
+        youtube.channel_feed['user-first/video'] = dict(youtube.channel_feed['user-first/video'], expire=expiring)
+        youtube.channel_refresher.refresh_hot()
+        yield gen.sleep(0.01)
+        while youtube.channel_builds.in_flight:
+            yield gen.sleep(0.05)
+        self.assertGreater(youtube.channel_feed['user-first/video']['expire'], expiring)
+
+    @gen_test(timeout=10)
+    def test_audio_feed_variants(self):
+        """
+        Test that audio feeds link the requested format and encoder profile, and are cached apart.
+        """
+        profiled = yield self.http_client.fetch(self.get_url('/youtube/channel/first/audio?profile=speech-64k-mono'))
+        m4a = yield self.http_client.fetch(self.get_url('/youtube/channel/first/m4a'))
+        unknown = yield self.http_client.fetch(self.get_url('/youtube/channel/first/audio?profile=loud'), raise_error=False)
+        self.assertIn(b'/youtube/audio/UUfirst-5?profile=speech-64k-mono" length="None" type="audio/mpeg"', profiled.body)
+        self.assertIn(b'/youtube/audio/UUfirst-5.m4a" length="None" type="audio/mp4"', m4a.body)
+        self.assertEqual(unknown.code, 400)
+        self.assertIn('first/audio?profile=speech-64k-mono', youtube.channel_feed)
+        self.assertIn('first/m4a', youtube.channel_feed)
+
+    @gen_test(timeout=10)
+    def test_prefetch_newest_episodes(self):
+        """
+        Test that rendering an audio feed prefetches its newest episodes.
+        """
+        with mock.patch.multiple(youtube, autoload_newest_audio=True, prefetch_newest=3), \
+                mock.patch.object(youtube.conversion_queue, 'enqueue') as enqueue:
+            yield self.http_client.fetch(self.get_url('/youtube/channel/first/opus'))
+        self.assertEqual(enqueue.call_args_list, [
+            mock.call(f'UUfirst-{index}.opus', conversion.PRIORITY_AUTOLOAD) for index in (5, 4, 3)
+        ])
+
+    @gen_test(timeout=10)
+    def test_prefetch_pinned_feeds(self):
+        """
+        Test that the newest episodes of pinned feeds are prefetched with a single API call each.
+        """
+        pinned = youtube.parse_pinned('channel/UCfirst, playlist/PLsecond/m4a, channel/someone/audio, user/x/audio')
+        self.assertEqual(pinned, [('channel', 'UCfirst', 'audio'), ('playlist', 'PLsecond', 'm4a')])
+        with mock.patch.multiple(youtube, pinned_feeds=pinned, prefetch_newest=1, audio_profile=None), \
+                mock.patch.object(youtube.conversion_queue, 'enqueue') as enqueue:
+            yield youtube.prefetch_pinned()
+        self.assertEqual(enqueue.call_args_list, [
+            mock.call('UUfirst-5.mp3', conversion.PRIORITY_AUTOLOAD),
+            mock.call('PLsecond-5.m4a', conversion.PRIORITY_AUTOLOAD)
+        ])
+        self.assertEqual(StubYouTubeApiHandler.calls, {'playlistItems': 2})
+
+    def test_prefetch_window(self):
+        """
+        Test that off-peak windows may span midnight.
+        """
+        night = youtube.parse_window('23:00-05:30')
+        self.assertTrue(youtube.in_window(night, datetime.time(1, 0)))
+        self.assertFalse(youtube.in_window(night, datetime.time(12, 0)))
+        self.assertTrue(youtube.in_window(youtube.parse_window('01:00-06:00'), datetime.time(1, 0)))
+        self.assertFalse(youtube.in_window(youtube.parse_window('01:00-06:00'), datetime.time(6, 0)))
+        self.assertTrue(youtube.in_window(youtube.parse_window(None), datetime.time(12, 0)))
+        with self.assertRaises(ValueError):
+            youtube.parse_window('night')
+
+    @gen_test(timeout=10)
+    def test_incremental_channel_refresh(self):
+        """
+        Test that an expired channel feed only fetches pages until it reaches a known video.
+        """
+        yield self.http_client.fetch(self.get_url('/youtube/channel/first'))
+        self.assertEqual(StubYouTubeApiHandler.calls['playlistItems'], 3)
+        StubYouTubeApiHandler.video_count += 1
+        youtube.channel_feed.clear()
+        response = yield self.http_client.fetch(self.get_url('/youtube/channel/first'))
+        self.assertEqual(StubYouTubeApiHandler.calls['playlistItems'], 4)
+        self.assertEqual(response.body.count(b'<item>'), 7)
+        self.assertIn(b'Video 6', response.body)
+
+    @gen_test(timeout=10)
+    def test_incremental_channel_refresh_page_limit(self):
+        """
+        Test that a refresh from a stored list renders no more videos than the pages requested.
+        """
+        yield self.http_client.fetch(self.get_url('/youtube/channel/first'))
+        StubYouTubeApiHandler.video_count += 1
+        youtube.channel_feed.clear()
+        with mock.patch.object(youtube, 'PLAYLIST_PAGE_SIZE', StubYouTubeApiHandler.PAGE_SIZE):
+            response = yield self.http_client.fetch(self.get_url('/youtube/channel/first?max=1'))
+        self.assertEqual(response.body.count(b'<item>'), StubYouTubeApiHandler.PAGE_SIZE)
+        self.assertIn(b'Video 6', response.body)
+        self.assertIn(b'Video 5', response.body)
+        self.assertEqual(len(youtube.channel_items['UUfirst']['items']), 7)
+
+    def test_api_client_scoped(self):
+        """
+        Test that the API calls get a client of their own and leave the shared one alone.
+        """
+        configured = httpclient.AsyncHTTPClient.configured_class()
+        youtube_api.init(3)
+        self.addCleanup(youtube_api.init)
+        self.assertIs(httpclient.AsyncHTTPClient.configured_class(), configured)
+        client = youtube_api.http_client()
+        self.assertIsNot(client, httpclient.AsyncHTTPClient())
+        self.assertIs(youtube_api.http_client(), client)
+
+    @gen_test(timeout=10)
+    def test_quota_ledger(self):
+        """
+        Test that API calls are booked per endpoint and per feed.
+        """
+        yield self.http_client.fetch(self.get_url('/youtube/channel/first'))
+        quota = utils.stats['youtube_quota']
+        self.assertEqual(quota['endpoints'], {'channels': 1, 'playlistItems': 3})
+        self.assertEqual(quota['feeds'], {'first/video': 4})
+        self.assertEqual(quota['remaining'], 10000 - 4)
+
+    @gen_test(timeout=10)
+    def test_quota_conserving(self):
+        """
+        Test that a low quota caps the page depth and keeps outdated feeds from being rebuilt.
+        """
+        youtube_api.daily_quota = youtube_api.quota_reserve
+        response = yield self.http_client.fetch(self.get_url('/youtube/channel/first'))
+        self.assertEqual(StubYouTubeApiHandler.calls['playlistItems'], 1)
+        self.assertEqual(response.body.count(b'<item>'), StubYouTubeApiHandler.PAGE_SIZE)
+        feed = youtube.channel_feed['first/video']
+        youtube.channel_feed['first/video'] = dict(feed, expire=datetime.datetime.now() - datetime.timedelta(days=1))
+        response = yield self.http_client.fetch(self.get_url('/youtube/channel/first'))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, feed['feed'])
+        self.assertEqual(StubYouTubeApiHandler.calls['playlistItems'], 1)
+
+    @gen_test(timeout=10)
+    def test_quota_exhausted(self):
+        """
+        Test that a spent quota answers 503 instead of calling the API.
+        """
+        youtube_api.daily_quota = 0
+        response = yield self.http_client.fetch(self.get_url('/youtube/channel/first'), raise_error=False)
+        self.assertEqual(response.code, 503)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        self.assertEqual(StubYouTubeApiHandler.calls, {})
+
+class ThrottledRangeHandler(web.RequestHandler):
+    """Serves a file in ranges, throttling each connection like YouTube does."""
+    DATA = bytes(range(256)) * 1024
+    RATE = 1048576
+    BLOCK = 16384
+    # Requests broken off halfway, by start of their range
+    break_off = set()
+    # Requests that send their body only after STALL seconds, by start of their range
+    stall = set()
+    STALL = 1
+    ranges = True
+    requests = []
+
+    async def get(self):
+        start, end = 0, len(self.DATA) - 1
+        match = re.match(r'bytes=(\d+)-(\d+)', self.request.headers.get('Range', ''))
+        if match and self.ranges:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(self.DATA) - 1)
+            self.set_status(206)
+            self.set_header('Content-Range', f'bytes {start}-{end}/{len(self.DATA)}')
+        ThrottledRangeHandler.requests.append(start)
+        self.set_header('Content-Length', end - start + 1)
+        broken = start in self.break_off
+        self.break_off.discard(start)
+        if start in self.stall:
+            await self.flush()
+            await gen.sleep(self.STALL)
+        for offset in range(start, end + 1, self.BLOCK):
+            if broken and offset - start >= (end - start) // 2:
+                self.request.connection.stream.close()
+                return
+            self.write(self.DATA[offset:min(offset + self.BLOCK, end + 1)])
+            try:
+                await self.flush()
+            except iostream.StreamClosedError:
+                # The client gave up
+                return
+            await gen.sleep(self.BLOCK / self.RATE)
+
+class TestRangeDownload(AsyncHTTPTestCase):
+    """Run unit tests on downloading over several connections from a throttling server."""
+    def get_app(self):
+        return web.Application([(r'/stream', ThrottledRangeHandler)])
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'source')
+        ThrottledRangeHandler.ranges = True
+        ThrottledRangeHandler.requests = []
+        ThrottledRangeHandler.break_off = set()
+        ThrottledRangeHandler.stall = set()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    @gen_test(timeout=20)
+    def test_parallel_download(self):
+        """
+        Test that chunks are fetched concurrently, beating the throttled rate, and broken chunks are resumed.
+        """
+        data = ThrottledRangeHandler.DATA
+        chunk_size = len(data) // 8
+        ThrottledRangeHandler.break_off = {chunk_size * 3}
+        progress = []
+        fetch = download.RangeDownload(
+            self.get_url('/stream'), self.path, connections=4, chunk_size=chunk_size,
+            on_progress=lambda downloaded, size: progress.append((downloaded, size))
+        )
+        with mock.patch.object(download, 'RETRY_DELAY', 0.01):
+            started = time.monotonic()
+            size = yield fetch.run()
+            elapsed = time.monotonic() - started
+        single_connection = len(data) / ThrottledRangeHandler.RATE
+        self.assertEqual(size, len(data))
+        with open(self.path, 'rb') as source:
+            self.assertEqual(source.read(), data)
+        self.assertLess(elapsed, single_connection / 2)
+        # The broken chunk is asked for again from where it broke off
+        self.assertEqual(len(ThrottledRangeHandler.requests), 9)
+        self.assertNotIn(chunk_size * 3, ThrottledRangeHandler.requests[4:])
+        self.assertEqual(progress[-1], (len(data), len(data)))
+
+    @gen_test(timeout=10)
+    def test_stop_stalled(self):
+        """
+        Test that stopping a download does not wait for a stalled chunk.
+        """
+        chunk_size = len(ThrottledRangeHandler.DATA) // 4
+        ThrottledRangeHandler.stall = {chunk_size}
+        fetch = download.RangeDownload(self.get_url('/stream'), self.path, connections=2, chunk_size=chunk_size)
+        ioloop.IOLoop.current().call_later(0.3, fetch.stop)
+        started = time.monotonic()
+        with self.assertRaises(download.DownloadStopped):
+            yield fetch.run()
+        self.assertLess(time.monotonic() - started, ThrottledRangeHandler.STALL)
+        # Let the stalled request end
+        yield gen.sleep(ThrottledRangeHandler.STALL)
+
+    @gen_test(timeout=20)
+    def test_ranges_ignored_or_failing(self):
+        """
+        Test that a server ignoring ranges is read in one go and chunks failing too often fail the download.
+        """
+        ThrottledRangeHandler.ranges = False
+        size = yield download.RangeDownload(self.get_url('/stream'), self.path, chunk_size=1024).run()
+        self.assertEqual(size, len(ThrottledRangeHandler.DATA))
+        self.assertEqual(ThrottledRangeHandler.requests, [0])
+        ThrottledRangeHandler.ranges = True
+        with mock.patch.object(download, 'RETRY_DELAY', 0.01):
+            with self.assertRaises(download.DownloadError):
+                yield download.RangeDownload(self.get_url('/missing'), self.path, retries=2).run()
+
+class TestVideoHandler(AsyncHTTPTestCase):
+    """Run unit tests on resolving video streams off the IOLoop."""
+    RESOLVE_TIME = 0.3
+
+    class PingHandler(web.RequestHandler):
+        def get(self):
+            self.write('pong')
+
+    def get_app(self):
+        return web.Application([
+            (r'/ping', self.PingHandler),
+            (r'/youtube/video/(.*)', youtube.VideoHandler),
+        ])
+
+    def setUp(self):
+        super().setUp()
+        youtube.video_links.clear()
+        youtube.audio_links.clear()
+        self.resolved = []
+
+    def resolve(self, video, audio=False):
+        self.resolved.append(video + '/audio' if audio else video)
+        time.sleep(self.RESOLVE_TIME)
+        return {
+            'url': f'https://googlevideo.example/{video}' + ('?itag=251' if audio else ''),
+            'expire': datetime.datetime.now() + datetime.timedelta(hours=6)
+        }
+
+    @gen_test(timeout=10)
+    def test_resolution_does_not_block(self):
+        """
+        Test that other requests are served while streams are resolved, and that
+        concurrent requests for the same video share one resolution.
+        """
+        with mock.patch.object(youtube, 'resolve_video_link', self.resolve):
+            started = time.monotonic()
+            video_requests = [
+                self.http_client.fetch(self.get_url(f'/youtube/video/{video}'), follow_redirects=False, raise_error=False)
+                for video in ('a', 'a', 'b')
+            ]
+            yield self.http_client.fetch(self.get_url('/ping'))
+            self.assertLess(time.monotonic() - started, self.RESOLVE_TIME)
+            responses = yield video_requests
+        for response, video in zip(responses, ('a', 'a', 'b')):
+            self.assertEqual(response.code, 302)
+            self.assertEqual(response.headers['Location'], f'https://googlevideo.example/{video}')
+        self.assertEqual(sorted(self.resolved), ['a', 'b'])
+        self.assertLess(time.monotonic() - started, 2 * self.RESOLVE_TIME)
+
+    @gen_test(timeout=10)
+    def test_audio_stream_cached_separately(self):
+        """
+        Test that conversions get the audio-only stream while the video endpoint keeps the video stream.
+        """
+        with mock.patch.object(youtube, 'resolve_video_link', self.resolve):
+            audio_url = yield youtube.get_youtube_url('a', audio=True)
+            response = yield self.http_client.fetch(self.get_url('/youtube/video/a'), follow_redirects=False, raise_error=False)
+            yield youtube.get_youtube_url('a', audio=True)
+        self.assertEqual(audio_url, 'https://googlevideo.example/a?itag=251')
+        self.assertEqual(response.headers['Location'], 'https://googlevideo.example/a')
+        self.assertEqual(self.resolved, ['a/audio', 'a'])
+
+PROGRESS_REPORT = [
+    b'bitrate= 128.0kbits/s\n', b'total_size=240000\n', b'out_time_us=15000000\n', b'speed=N/A\n', b'progress=continue\n',
+    b'bitrate= 128.0kbits/s\n', b'total_size=480000\n', b'out_time_us=30000000\n', b'speed=12.5x\n', b'progress=end\n'
+]
+
+class ProgressStream:
+    """Replays the progress report of ffmpeg."""
+    def __init__(self, lines):
+        self.lines = list(lines)
+
+    async def read_until(self, _delimiter):
+        if not self.lines:
+            raise iostream.StreamClosedError()
+        return self.lines.pop(0)
+
+class TestAudioHandler(AsyncHTTPTestCase):
+    """Run unit tests on serving converted audio."""
+    CONVERT_TIME = 0.3
+
+    def get_app(self):
+        return web.Application([
+            (r'/youtube/audio/(.*)', youtube.AudioHandler),
+            (r'/youtube/conversions/', youtube.ConversionStatusHandler),
+        ])
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        os.mkdir('audio')
+        youtube.video_links.clear()
+        self.converted = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+        super().tearDown()
+
+    async def convert(self, job):
+        self.converted.append(job.key)
+        await gen.sleep(self.CONVERT_TIME)
+        if job.key.startswith('live.'):
+            youtube.video_links['live'] = {'url': None, 'unavailable': True,
+                                            'expire': datetime.datetime.now() + datetime.timedelta(hours=1)}
+            return conversion.RESULT_UNAVAILABLE
+        with open(f'./audio/{job.key}', 'wb') as audio_file:
+            audio_file.write(b'ID3' + b'.' * 1000)
+        return conversion.RESULT_SUCCESS
+
+    @gen_test(timeout=10)
+    def test_waiters_share_conversion(self):
+        """
+        Test that clients waiting for a conversion get the file as soon as it is done.
+        """
+        with mock.patch.object(youtube, 'convert_video', self.convert):
+            started = time.monotonic()
+            responses = yield [
+                self.http_client.fetch(self.get_url('/youtube/audio/new'), raise_error=False)
+                for _ in range(3)
+            ]
+            elapsed = time.monotonic() - started
+            unavailable = yield self.http_client.fetch(self.get_url('/youtube/audio/live'), raise_error=False)
+        for response in responses:
+            self.assertEqual(response.code, 200)
+            self.assertEqual(len(response.body), 1003)
+        self.assertLess(elapsed, self.CONVERT_TIME + 0.2)
+        self.assertEqual(unavailable.code, 422)
+        self.assertEqual(self.converted, ['new.mp3', 'live.mp3'])
+
+    @gen_test(timeout=10)
+    def test_disconnect_cancels_wait(self):
+        """
+        Test that a client going away stops waiting without stopping the conversion.
+        """
+        with mock.patch.object(youtube, 'convert_video', self.convert):
+            quitter = self.http_client.fetch(self.get_url('/youtube/audio/new'), request_timeout=0.1)
+            yield gen.sleep(0.05)
+            job = youtube.conversion_queue.jobs['new.mp3']
+            self.assertEqual(job.waiters, 1)
+            with self.assertRaises(httpclient.HTTPClientError):
+                yield quitter
+            yield gen.sleep(0.05)
+            self.assertEqual(job.waiters, 0)
+            result = yield job.wait()
+        self.assertEqual(result, conversion.RESULT_SUCCESS)
+
+    @gen_test(timeout=10)
+    def test_unavailable_in_worker(self):
+        """
+        Test that a video the conversion worker finds unavailable is refused without converting it again.
+        """
+        async def convert(job):
+            # The worker marks the video in its own process only
+            self.converted.append(job.key)
+            return conversion.RESULT_UNAVAILABLE
+        path = os.path.join(self.directory.name, 'worker.sock')
+        server = conversion_worker.WorkerServer(conversion.ConversionScheduler(convert, concurrency=1))
+        server.listen_unix(path)
+        client = conversion_worker.WorkerClient(path)
+        client.start()
+        try:
+            with mock.patch.object(youtube, 'conversion_queue', client):
+                first = yield self.http_client.fetch(self.get_url('/youtube/audio/live'), raise_error=False)
+                second = yield self.http_client.fetch(self.get_url('/youtube/audio/live'), raise_error=False)
+        finally:
+            server.stop()
+        self.assertEqual((first.code, second.code), (422, 422))
+        self.assertEqual(self.converted, ['live.mp3'])
+        self.assertTrue(youtube.video_links['live']['unavailable'])
+
+    @gen_test(timeout=10)
+    def test_remuxed_formats(self):
+        """
+        Test that each audio format and encoder profile is converted and cached on its own and served with its MIME type.
+        """
+        with mock.patch.object(youtube, 'convert_video', self.convert):
+            mp3 = yield self.http_client.fetch(self.get_url('/youtube/audio/new'))
+            m4a = yield self.http_client.fetch(self.get_url('/youtube/audio/new.m4a'))
+            speech = yield self.http_client.fetch(self.get_url('/youtube/audio/new?profile=speech-64k-mono'))
+            unknown = yield self.http_client.fetch(self.get_url('/youtube/audio/new.wav'), raise_error=False)
+            unknown_profile = yield self.http_client.fetch(self.get_url('/youtube/audio/new?profile=loud'), raise_error=False)
+        self.assertEqual(mp3.headers['Content-Type'], 'audio/mpeg')
+        self.assertEqual(m4a.headers['Content-Type'], 'audio/mp4')
+        self.assertEqual(speech.headers['Content-Type'], 'audio/mpeg')
+        self.assertEqual(unknown.code, 404)
+        self.assertEqual(unknown_profile.code, 400)
+        self.assertEqual(self.converted, ['new.mp3', 'new.m4a', 'new.speech-64k-mono.mp3'])
+
+    @gen_test(timeout=10)
+    def test_sendfile_ranges(self):
+        """
+        Test that converted files are sent with sendfile, whole and in ranges, like without it.
+        """
+        data = os.urandom(3 * 1024 ** 2 + 17)
+        with open('./audio/cached.mp3', 'wb') as audio_file:
+            audio_file.write(data)
+        url = self.get_url('/youtube/audio/cached')
+        for sendfile in (True, False):
+            with mock.patch.object(youtube, 'sendfile_audio', sendfile), \
+                    mock.patch('os.sendfile', side_effect=os.sendfile) as sent:
+                whole = yield self.http_client.fetch(url)
+                part = yield self.http_client.fetch(url, headers={'Range': 'bytes=1048576-2097151'})
+                suffix = yield self.http_client.fetch(url, headers={'Range': 'bytes=-17'})
+                beyond = yield self.http_client.fetch(url, headers={'Range': f'bytes={len(data)}-'}, raise_error=False)
+            self.assertEqual((whole.code, whole.body), (200, data))
+            self.assertEqual((part.code, part.body), (206, data[1048576:2097152]))
+            self.assertEqual(part.headers['Content-Range'], f'bytes 1048576-2097151/{len(data)}')
+            self.assertEqual((suffix.code, suffix.body), (206, data[-17:]))
+            self.assertEqual(beyond.code, 416)
+            self.assertEqual(int(part.headers['Content-Length']), 1048576)
+            self.assertEqual(sent.called, sendfile)
+        open('./audio/empty.mp3', 'wb').close()
+        with mock.patch.object(youtube, 'sendfile_audio', True), \
+                self.assertNoLogs('tornado.application', level='ERROR'):
+            empty = yield self.http_client.fetch(self.get_url('/youtube/audio/empty'))
+            # The handler finishes after the client got the response
+            yield gen.sleep(0.05)
+        self.assertEqual((empty.code, empty.body), (200, b''))
+
+    @gen_test(timeout=10)
+    def test_audio_track_copied(self):
+        """
+        Test that ffmpeg copies the audio track of a source of the same codec and encodes otherwise.
+        """
+        commands = []
+        class Subprocess:
+            STREAM = 'stream'
+            def __init__(self, command, **_kwargs):
+                commands.append(command)
+                with open(command[-1], 'wb') as audio_file:
+                    audio_file.write(b'audio')
+                self.stdout = ProgressStream(PROGRESS_REPORT)
+                self.proc = mock.Mock()
+            async def wait_for_exit(self):
+                return 0
+        link = {
+            'url': 'https://googlevideo.example/best?dur=60.0',
+            'expire': datetime.datetime.now() + datetime.timedelta(hours=6),
+            'sources': {'audio/mp4': 'https://googlevideo.example/aac?dur=60.0'}
+        }
+        async def get_link(_video, audio=False):
+            return link
+        job = conversion.ConversionJob('new.m4a', conversion.PRIORITY_INTERACTIVE)
+        with mock.patch.object(youtube.process, 'Subprocess', Subprocess), \
+                mock.patch.object(youtube, 'get_youtube_link', get_link), \
+                mock.patch.object(youtube, 'download_connections', 0):
+            m4a = yield youtube.convert_video(job)
+            opus = yield youtube.convert_video(conversion.ConversionJob('new.opus', conversion.PRIORITY_INTERACTIVE))
+            mp3 = yield youtube.convert_video(conversion.ConversionJob('new.speech-64k-mono.mp3', conversion.PRIORITY_INTERACTIVE))
+        self.assertEqual({m4a, opus, mp3}, {conversion.RESULT_SUCCESS})
+        self.assertIn('https://googlevideo.example/aac?dur=60.0', commands[0])
+        self.assertEqual(commands[0][commands[0].index('-c:a') + 1], 'copy')
+        self.assertIn('https://googlevideo.example/best?dur=60.0', commands[1])
+        self.assertEqual(commands[1][commands[1].index('-c:a') + 1], 'libopus')
+        self.assertTrue(os.path.exists('./audio/new.m4a'))
+        self.assertEqual(commands[2][-7:], ['-ac', '1', '-b:a', '64k', '-f', 'mp3', './audio/new.speech-64k-mono.mp3.temp'])
+        self.assertEqual(commands[0][commands[0].index('-progress') + 1], 'pipe:1')
+        self.assertEqual(job.progress, {'out_time': 30.0, 'speed': 12.5, 'total_size': 480000, 'bitrate': 128000.0})
+        self.assertEqual(job.to_dict()['percent'], 50.0)
+        with mock.patch.object(youtube.process, 'Subprocess', Subprocess), \
+                mock.patch.object(youtube, 'get_youtube_link', get_link), \
+                mock.patch.multiple(youtube, download_connections=4, progressive_audio=True), \
+                mock.patch.object(youtube, 'download_source') as download_source:
+            streamed = yield youtube.convert_video(conversion.ConversionJob('streamed.mp3', conversion.PRIORITY_INTERACTIVE))
+        # Streaming clients don't wait for the source to be downloaded first
+        self.assertEqual(streamed, conversion.RESULT_SUCCESS)
+        download_source.assert_not_called()
+        self.assertIn('https://googlevideo.example/best?dur=60.0', commands[3])
+
+    def test_audio_cache_size(self):
+        """
+        Test that the audio files are only counted again on request, not whenever their size is asked for.
+        """
+        with mock.patch.object(youtube, 'audio_bytes', None):
+            with open('./audio/a.mp3', 'wb') as audio_file:
+                audio_file.write(b'.' * 100)
+            self.assertEqual(youtube.audio_cache_size(), 100)
+            with open('./audio/b.m4a', 'wb') as audio_file:
+                audio_file.write(b'.' * 200)
+            self.assertEqual(youtube.audio_cache_size(), 100)
+            youtube.count_audio_cache()
+            self.assertEqual(youtube.audio_cache_size(), 300)
+
+    def test_priority_command(self):
+        """
+        Test that ffmpeg is started through nice and ionice where they exist.
+        """
+        with mock.patch('shutil.which', return_value='/usr/bin/tool'), \
+                mock.patch.multiple(youtube, convert_nice=10, convert_ionice='idle'):
+            self.assertEqual(youtube.priority_command(), ['nice', '-n', '10', 'ionice', '-t', '-c', '3'])
+        with mock.patch('shutil.which', return_value=None):
+            self.assertEqual(youtube.priority_command(), [])
+
+    @gen_test(timeout=10)
+    def test_conversion_status(self):
+        """
+        Test that the status lists queued, running and finished jobs with the progress of ffmpeg.
+        """
+        async def convert(job):
+            await conversion.read_progress(job, ProgressStream(PROGRESS_REPORT))
+            await gen.sleep(self.CONVERT_TIME)
+            with open(f'./audio/{job.key}', 'wb') as audio_file:
+                audio_file.write(b'audio')
+            return conversion.RESULT_SUCCESS
+        with mock.patch.object(youtube, 'convert_video', convert):
+            requests = []
+            for video in 'abc':
+                requests.append(self.http_client.fetch(self.get_url(f'/youtube/audio/{video}')))
+                yield gen.sleep(0.02)
+            yield gen.sleep(self.CONVERT_TIME / 2)
+            response = yield self.http_client.fetch(self.get_url('/youtube/conversions/'))
+            yield requests
+        status = json.loads(response.body)
+        self.assertEqual([job['key'] for job in status['running']], ['a.mp3', 'b.mp3'])
+        self.assertEqual([job['key'] for job in status['queued']], ['c.mp3'])
+        self.assertEqual(status['running'][0]['speed'], 12.5)
+        self.assertEqual(status['running'][0]['waiters'], 1)
+        self.assertGreater(status['queued'][0]['wait_time'], 0)
+        finished = youtube.conversion_queue.status()['finished']
+        self.assertEqual([job['key'] for job in finished[:3]], ['c.mp3', 'b.mp3', 'a.mp3'])
+        self.assertGreaterEqual(finished[0]['runtime'], self.CONVERT_TIME)
+
+    async def convert_progressively(self, job):
+        temp_file = f'./audio/{job.key}.temp'
+        with open(temp_file, 'wb') as audio_file:
+            for part in range(3):
+                audio_file.write(bytes([part]) * 1000)
+                audio_file.flush()
+                await gen.sleep(self.CONVERT_TIME)
+        os.rename(temp_file, f'./audio/{job.key}')
+        return conversion.RESULT_SUCCESS
+
+    @gen_test(timeout=10)
+    def test_progressive_streaming(self):
+        """
+        Test that the file is streamed while it is converted and ranges are served from the written part.
+        """
+        first_chunk = None
+        received = []
+        def on_chunk(chunk):
+            nonlocal first_chunk
+            if first_chunk is None:
+                first_chunk = time.monotonic()
+            received.append(chunk)
+        with mock.patch.object(youtube, 'convert_video', self.convert_progressively), \
+                mock.patch.object(youtube, 'progressive_audio', True), \
+                mock.patch.object(youtube.AudioHandler, 'FOLLOW_INTERVAL', 0.05):
+            started = time.monotonic()
+            streamed = self.http_client.fetch(self.get_url('/youtube/audio/new'), streaming_callback=on_chunk)
+            ranged = yield self.http_client.fetch(self.get_url('/youtube/audio/new'), headers={'Range': 'bytes=500-1999'})
+            beyond = yield self.http_client.fetch(self.get_url('/youtube/audio/new'), headers={'Range': 'bytes=2500-'})
+            streamed = yield streamed
+        self.assertLess(first_chunk - started, self.CONVERT_TIME)
+        self.assertEqual(streamed.code, 200)
+        self.assertNotIn('Content-Length', streamed.headers)
+        self.assertEqual(b''.join(received), bytes([0]) * 1000 + bytes([1]) * 1000 + bytes([2]) * 1000)
+        self.assertEqual(ranged.code, 206)
+        self.assertEqual(ranged.headers['Content-Range'], 'bytes 500-999/*')
+        self.assertEqual(ranged.body, bytes([0]) * 500)
+        self.assertEqual(beyond.code, 206)
+        self.assertEqual(beyond.headers['Content-Range'], 'bytes 2500-2999/*')
+        self.assertEqual(beyond.body, bytes([2]) * 500)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,19 @@
 from configparser import ConfigParser, NoOptionError, NoSectionError
 import logging
 import os
-from asyncio import sleep
+from asyncio import ensure_future, shield, sleep
 from datetime import datetime
 import sys
 from urllib.parse import urlencode
 
 from pytubefix import YouTube
+import cache
 
-video_links = dict()
+# Limited by youtube.init and cleaned up with the YouTube caches
+video_links = cache.BoundedCache('utils_video_links', max_entries=10000)
+stats = {
+    'coalesced_requests': {}
+}
 metric_chart = {
     'k': 3,  # kilo
     'M': 6,  # Mega
@@ -16,6 +21,28 @@ metric_chart = {
     'T': 12  # Tera
 }
 
+class SingleFlight:
+    """
+    Runs at most one build per key at a time. Callers asking for a key that is
+    already being built wait for that build and share its result.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight = {}
+        stats['coalesced_requests'][name] = 0
+
+    async def run(self, key, factory):
+        future = self.in_flight.get(key)
+        if future is None:
+            future = ensure_future(factory())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            stats['coalesced_requests'][self.name] += 1
+            logging.debug('%s: Joining in-flight build of %s', self.name, key)
+        # Shield the shared build so one waiter going away does not cancel it for the others
+        return await shield(future)
+
 def parametrize(url, params):
     return url + '?' + urlencode(params)
 
@@ -4,39 +4,120 @@ content. It includes classes such as VideoHandler, AudioHandler, ClearCacheHandl
 which handle different types of requests related to YouTube content.
 """
 from configparser import ConfigParser
+import asyncio
 
 import datetime
 import logging
 import os
+import shutil
 import time
 import glob
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from feedgen.feed import FeedGenerator
-import requests
+from urllib.parse import parse_qs, urlparse
 import psutil
 from pytubefix import YouTube, exceptions
-from tornado import gen, httputil, ioloop, iostream, process, web
-from tornado.locks import Semaphore
+from tornado import gen, httpclient, httputil, ioloop, iostream, process, web
+from tornado import version as tornado_version
+import cache
+import conversion
+import conversion_worker
+import download
+import feeds
+import rss_writer
 import utils
+import youtube_api
 import gc
 
 key = None
 cleanup_period = None
-convert_video_period = None
 audio_expiration_time = None
 start_cleanup_size_threshold = None
 stop_cleanup_size_threshold = None
 autoload_newest_audio = None
-
-video_links = {}
-playlist_feed = {}
-channel_feed = {}
-channel_name_to_id = {}
+quota_max_pages = 1
+convert_threads = 1
+convert_nice = 10
+convert_ionice = 'best-effort'
+progressive_audio = False
+audio_profile = None
+prefetch_newest = 1
+pinned_feeds = []
+prefetch_window = None
+prefetch_max_bytes = 0
+convert_worker = None
+download_connections = 4
+download_chunk_size = download.CHUNK_SIZE
+download_retries = 3
+sendfile_audio = False
+
+video_links = cache.BoundedCache('video_links')
+audio_links = cache.BoundedCache('audio_links')
+playlist_feed = cache.BoundedCache('playlist_feed')
+channel_feed = cache.BoundedCache('channel_feed')
+channel_name_to_id = cache.BoundedCache('channel_name_to_id')
+channel_items = cache.BoundedCache('channel_items')
+
+CHANNEL_ITEMS_EXPIRATION = datetime.timedelta(days=7)
+# Items per playlistItems page
+PLAYLIST_PAGE_SIZE = 50
+# Milliseconds between two checks of the pinned feeds for new episodes
+PINNED_PREFETCH_PERIOD = 3600000 # 1 hour
+
+# Audio served by the AudioHandler, by file extension. MP3 is transcoded, the others
+# copy the audio track of the source stream of the same codec into a new container,
+# or encode it if the video has no such stream. MP4 files are written in one go as the
+# index is moved to the front at the end, the others can be streamed while converting.
+AUDIO_FORMATS = {
+    'mp3': {
+        'mime_type': 'audio/mpeg',
+        'source': None,
+        'copy': None,
+        'encode': ['-f', 'mp3'],
+        'progressive': True
+    },
+    'm4a': {
+        'mime_type': 'audio/mp4',
+        'source': 'audio/mp4',
+        'copy': ['-vn', '-c:a', 'copy', '-movflags', '+faststart', '-f', 'ipod'],
+        'encode': ['-vn', '-c:a', 'aac', '-movflags', '+faststart', '-f', 'ipod'],
+        'progressive': False
+    },
+    'opus': {
+        'mime_type': 'audio/ogg',
+        'source': 'audio/webm',
+        'copy': ['-vn', '-c:a', 'copy', '-f', 'opus'],
+        'encode': ['-vn', '-c:a', 'libopus', '-f', 'opus'],
+        'progressive': True
+    }
+}
+# The audio format of each audio feed type
+FEED_AUDIO_FORMATS = {'audio': 'mp3', 'm4a': 'm4a', 'opus': 'opus'}
+# Encoder settings of MP3 conversions, chosen with the profile query parameter.
+# Without a profile ffmpeg's defaults are used, 128kbit/s CBR with the channels of the source.
+ENCODER_PROFILES = {
+    'speech-64k-mono': ['-ac', '1', '-b:a', '64k'],
+    'speech-vbr-mono': ['-ac', '1', '-q:a', '7'],
+    'music-128k': ['-b:a', '128k'],
+    'music-vbr': ['-q:a', '2']
+}
 
 __version__ = 'v2024.11.11.1'
 
-conversion_queue = {}
-converting_lock = Semaphore(2)
+conversion_queue = conversion.ConversionScheduler(lambda job: convert_video(job), concurrency=2)
+conversion_journal = cache.PersistentDict('conversion_jobs')
+# Bytes of converted audio in ./audio, counted by the cleanup and raised by each conversion
+audio_bytes = None
+
+resolve_max_workers = 4
+resolver_executor = ThreadPoolExecutor(max_workers=resolve_max_workers, thread_name_prefix='youtube-resolve')
+video_resolutions = utils.SingleFlight('youtube_video')
+
+channel_builds = utils.SingleFlight('youtube_channel')
+playlist_builds = utils.SingleFlight('youtube_playlist')
+channel_token_lookups = utils.SingleFlight('youtube_user')
+channel_refresher = feeds.FeedRefresher(channel_feed, channel_builds, youtube_api.quota_conserving)
+playlist_refresher = feeds.FeedRefresher(playlist_feed, playlist_builds, youtube_api.quota_conserving)
 
 def get_env_or_config_option(conf: ConfigParser,
                                  env_name: str,
@@ -59,35 +140,152 @@ def get_env_or_config_option(conf: ConfigParser,
                                           config_name, "youtube",
                                           default_value=default_value)
 
-def init(conf: ConfigParser):
+def init(conf: ConfigParser, worker: bool = False):
     """
     Initializes the configuration settings for the system.
 
     Args:
         conf (ConfigParser): The configuration parser object.
+        worker (bool): Whether this is the conversion worker process, which only converts.
 
     Returns:
         None
     """
-    global key, cleanup_period, convert_video_period, audio_expiration_time, start_cleanup_size_threshold, stop_cleanup_size_threshold
+    global key, cleanup_period, audio_expiration_time, start_cleanup_size_threshold, stop_cleanup_size_threshold, quota_max_pages
+    global resolve_max_workers, resolver_executor, convert_threads, convert_nice, convert_ionice, progressive_audio, audio_profile
+    global autoload_newest_audio, prefetch_newest, pinned_feeds, prefetch_window, prefetch_max_bytes, convert_worker, conversion_queue
+    global download_connections, download_chunk_size, download_retries, sendfile_audio
     key                          = str(get_env_or_config_option(conf, "YT_API_KEY"                     , "api_key"                     , default_value=None))
     cleanup_period               = int(get_env_or_config_option(conf, "YT_CLEANUP_PERIOD"              , "cleanup_period"              , default_value=600000)) # 10 minutes
-    convert_video_period         = int(get_env_or_config_option(conf, "YT_CONVERT_VIDEO_PERIOD"        , "convert_video_period"        , default_value=1000)) # 1 second
     audio_expiration_time        = int(get_env_or_config_option(conf, "YT_AUDIO_EXPIRATION_TIME"       , "audio_expiration_time"       , default_value=259200000)) # 3 days
     start_cleanup_size_threshold = int(get_env_or_config_option(conf, "YT_START_CLEANUP_SIZE_THRESHOLD", "start_cleanup_size_threshold", default_value=536870912)) # 0.5GiB
     stop_cleanup_size_threshold  = int(get_env_or_config_option(conf, "YT_STOP_CLEANUP_SIZE_THRESHOLD" , "stop_cleanup_size_threshold" , default_value=16106127360)) # 15GiB
     poToken                      = str(get_env_or_config_option(conf, "YT_TOKEN"                    , "po_token"                    , default_value=None))
     autoload_newest_audio        = get_env_or_config_option(conf, "YT_AUTOLOAD_NEWEST_AUDIO"       , "autoload_newest_audio"       , default_value=True)
     autoload_newest_audio = utils.convert_to_bool(autoload_newest_audio)
+    api_max_connections          = int(get_env_or_config_option(conf, "YT_API_MAX_CONNECTIONS"         , "api_max_connections"         , default_value=10))
+
+    cache_file                   = get_env_or_config_option(conf, "YT_CACHE_FILE"                  , "cache_file"                  , default_value=None)
+    cache_max_entries            = int(get_env_or_config_option(conf, "YT_CACHE_MAX_ENTRIES"           , "cache_max_entries"           , default_value=10000))
+    cache_max_bytes              = int(get_env_or_config_option(conf, "YT_CACHE_MAX_BYTES"             , "cache_max_bytes"             , default_value=268435456)) # 256MiB
+    api_daily_quota              = int(get_env_or_config_option(conf, "YT_API_DAILY_QUOTA"             , "api_daily_quota"             , default_value=10000))
+    api_quota_reserve            = int(get_env_or_config_option(conf, "YT_API_QUOTA_RESERVE"           , "api_quota_reserve"           , default_value=1000))
+    quota_max_pages              = int(get_env_or_config_option(conf, "YT_API_QUOTA_MAX_PAGES"         , "api_quota_max_pages"         , default_value=1))
+    resolve_max_workers          = int(get_env_or_config_option(conf, "YT_RESOLVE_MAX_WORKERS"         , "resolve_max_workers"         , default_value=4))
+    convert_concurrency          = str(get_env_or_config_option(conf, "YT_CONVERT_CONCURRENCY"         , "convert_concurrency"         , default_value='auto'))
+    convert_threads              = int(get_env_or_config_option(conf, "YT_CONVERT_THREADS"             , "convert_threads"             , default_value=1))
+    convert_nice                 = int(get_env_or_config_option(conf, "YT_CONVERT_NICE"                , "convert_nice"                , default_value=10))
+    convert_ionice               = str(get_env_or_config_option(conf, "YT_CONVERT_IONICE"              , "convert_ionice"              , default_value='best-effort'))
+    progressive_audio            = get_env_or_config_option(conf, "YT_PROGRESSIVE_AUDIO"           , "progressive_audio"           , default_value=False)
+    progressive_audio = utils.convert_to_bool(progressive_audio)
+    convert_timeout              = int(get_env_or_config_option(conf, "YT_CONVERT_TIMEOUT"             , "convert_timeout"             , default_value=10800)) # 3 hours
+    convert_stall_timeout        = int(get_env_or_config_option(conf, "YT_CONVERT_STALL_TIMEOUT"       , "convert_stall_timeout"       , default_value=300)) # 5 minutes
+    convert_cancel_abandoned     = get_env_or_config_option(conf, "YT_CONVERT_CANCEL_ABANDONED"    , "convert_cancel_abandoned"    , default_value=False)
+    convert_cancel_abandoned = utils.convert_to_bool(convert_cancel_abandoned)
+    audio_profile                = get_env_or_config_option(conf, "YT_AUDIO_PROFILE"               , "audio_profile"               , default_value=None) or None
+    if audio_profile is not None and audio_profile not in ENCODER_PROFILES:
+        logging.error( 'YouTube: Unknown audio profile %s, using the defaults of ffmpeg', audio_profile )
+        audio_profile = None
+    prefetch_newest              = int(get_env_or_config_option(conf, "YT_PREFETCH_NEWEST"             , "prefetch_newest"             , default_value=1))
+    pinned_feeds                 = parse_pinned(get_env_or_config_option(conf, "YT_PREFETCH_PINNED"   , "prefetch_pinned"             , default_value=''))
+    prefetch_window              = get_env_or_config_option(conf, "YT_PREFETCH_WINDOW"             , "prefetch_window"             , default_value=None)
+    try:
+        prefetch_window = parse_window(prefetch_window)
+    except ValueError:
+        logging.error( 'YouTube: Invalid prefetch window %s, prefetching at any time', prefetch_window )
+        prefetch_window = None
+    prefetch_max_bytes           = int(get_env_or_config_option(conf, "YT_PREFETCH_MAX_BYTES"          , "prefetch_max_bytes"          , default_value=2147483648)) # 2GiB
+    convert_worker               = get_env_or_config_option(conf, "YT_CONVERT_WORKER"              , "convert_worker"              , default_value=None) or None
+    download_connections         = int(get_env_or_config_option(conf, "YT_DOWNLOAD_CONNECTIONS"        , "download_connections"        , default_value=4))
+    download_chunk_size          = int(get_env_or_config_option(conf, "YT_DOWNLOAD_CHUNK_SIZE"         , "download_chunk_size"         , default_value=10485760)) # 10MiB
+    download_retries             = int(get_env_or_config_option(conf, "YT_DOWNLOAD_RETRIES"            , "download_retries"            , default_value=3))
+    sendfile_audio               = get_env_or_config_option(conf, "YT_SENDFILE_AUDIO"              , "sendfile_audio"              , default_value=False)
+    sendfile_audio = utils.convert_to_bool(sendfile_audio)
+
+    youtube_api.init(api_max_connections, api_daily_quota, api_quota_reserve)
+    resolver_executor = ThreadPoolExecutor(max_workers=resolve_max_workers, thread_name_prefix='youtube-resolve')
+    for cached in (video_links, audio_links, playlist_feed, channel_feed, channel_name_to_id, channel_items, utils.video_links):
+        cached.limit(cache_max_entries, cache_max_bytes)
+    if cache_file:
+        store = cache.PersistentStore(cache_file)
+        # The worker only keeps its journal there
+        if not worker:
+            for cached in (video_links, audio_links, channel_name_to_id, channel_items, youtube_api.ledger):
+                cached.attach(store)
+            # Expired feeds are still served during the stale grace, cleanup prunes them after
+            for cached in (playlist_feed, channel_feed):
+                cached.attach(store, grace=None)
+            youtube_api.update_stats()
+
+    if convert_worker and not worker:
+        # The worker schedules and runs the conversions, this process only hands them over
+        conversion_queue = conversion_worker.WorkerClient(convert_worker)
+        conversion_queue.limit(cancel_abandoned=convert_cancel_abandoned)
+        conversion_queue.start()
+    else:
+        if convert_concurrency.lower() == 'auto':
+            tuner = conversion.ConcurrencyTuner(threads=convert_threads or conversion.available_cores())
+            conversion_queue.configure(tuner.capacity(0), tuner)
+        else:
+            conversion_queue.configure(int(convert_concurrency))
+        conversion_queue.limit(convert_timeout or None, convert_stall_timeout or None, convert_cancel_abandoned)
+        # Before restoring, or journaled prefetches would start regardless
+        conversion_queue.hold_prefetches(prefetch_allowed)
+        if cache_file:
+            conversion_journal.attach(store)
+            conversion_queue.restore(conversion_journal, converted)
+        else:
+            logging.warning( 'YouTube: No cache_file set, queued conversions are not journaled and get lost on restart' )
+        conversion_queue.start()
+    if worker:
+        # The web process deletes the files, count them as often as it does
+        ioloop.PeriodicCallback(
+            callback=count_audio_cache,
+            callback_time=cleanup_period
+        ).start()
+        return
 
     ioloop.PeriodicCallback(
         callback=cleanup,
         callback_time=cleanup_period
     ).start()
-    ioloop.PeriodicCallback(
-        callback=convert_videos,
-        callback_time=convert_video_period
-    ).start()
+    if pinned_feeds:
+        ioloop.PeriodicCallback(
+            callback=prefetch_pinned,
+            callback_time=PINNED_PREFETCH_PERIOD
+        ).start()
+        ioloop.IOLoop.current().spawn_callback(prefetch_pinned)
+
+def api_error(reason: str) -> web.HTTPError:
+    """
+    Create the error for a failed API call.
+
+    Args:
+        reason (str): The reason reported when the call failed for another reason than quota.
+
+    Returns:
+        web.HTTPError: A 503 error if the API quota is exhausted, otherwise a 500 error.
+    """
+    if youtube_api.quota_exhausted():
+        return web.HTTPError(503, reason='YouTube API Quota Exhausted')
+    return web.HTTPError(500, reason=reason)
+
+def quota_page_limit(max_pages):
+    """
+    Limit the number of pages a feed build may download while the API quota runs low.
+
+    Args:
+        max_pages (str): The maximum number of pages requested, or None.
+
+    Returns:
+        The maximum number of pages to download, or None for no limit.
+    """
+    if not youtube_api.quota_conserving():
+        return max_pages
+    logging.info( 'YouTube: Quota running low, downloading at most %s pages', quota_max_pages )
+    if max_pages:
+        return min(int(max_pages), quota_max_pages)
+    return quota_max_pages
 
 def set_key( new_key=None ):
     """
@@ -104,69 +302,55 @@ def set_key( new_key=None ):
 def cleanup():
     """
     Clean up expired video links, playlist feeds, channel feeds, and channel name map.
+    Feeds are kept for the stale grace period after they expire.
     Delete audio files older than a certain time or when the disk space is low.
     Logs the items cleaned from each category.
     """
     # Globals
-    global video_links, playlist_feed, channel_name_to_id, channel_feed, audio_expiration_time, start_cleanup_size_threshold, stop_cleanup_size_threshold
+    global audio_expiration_time, start_cleanup_size_threshold, stop_cleanup_size_threshold
     current_time = datetime.datetime.now()
     # Video Links
-    video_links_length = len(video_links)
-    video_links = {
-        video:
-            info
-            for video, info in video_links.items()
-            if info['expire'] > current_time
-    }
-    video_links_length -= len(video_links)
+    video_links_length = (video_links.remove_expired(current_time) + audio_links.remove_expired(current_time)
+                          + utils.video_links.remove_expired(current_time))
     if video_links_length:
         logging.info( 'YouTube: Cleaned %s items from video list', video_links_length )
-    # Playlist Feeds
-    playlist_feed_length = len(playlist_feed)
-    playlist_feed = {
-        playlist:
-            info
-            for playlist, info in playlist_feed.items()
-            if info['expire'] > current_time
-    }
-    playlist_feed_length -= len(playlist_feed)
-    if playlist_feed_length:
-        logging.info(
-            'YouTube: Cleaned %s items from playlist feeds',
-            playlist_feed_length
-        )
-    # Channel Feeds
-    channel_feed_length = len(channel_feed)
-    channel_feed = {
-        channel:
-            info
-            for channel, info in channel_feed.items()
-            if info['expire'] > current_time
-    }
-    channel_feed_length -= len(channel_feed)
-    if channel_feed_length:
-        logging.info(
-            'YouTube: Cleaned %s items from channel feeds',
-            channel_feed_length
-        )
+    # Quota Ledger
+    youtube_api.ledger.remove_expired(current_time)
+    youtube_api.update_stats()
+    # While the quota runs low, expired feeds are all there is to serve
+    if not youtube_api.quota_conserving():
+        # Playlist Feeds
+        playlist_feed_length = playlist_feed.remove_expired(current_time - feeds.stale_grace)
+        if playlist_feed_length:
+            logging.info(
+                'YouTube: Cleaned %s items from playlist feeds',
+                playlist_feed_length
+            )
+        # Channel Feeds
+        channel_feed_length = channel_feed.remove_expired(current_time - feeds.stale_grace)
+        if channel_feed_length:
+            logging.info(
+                'YouTube: Cleaned %s items from channel feeds',
+                channel_feed_length
+            )
     # Channel Feeds
-    channel_name_to_id_length = len(channel_name_to_id)
-    channel_name_to_id = {
-        channel:
-            info
-            for channel, info in channel_name_to_id.items()
-            if info['expire'] > current_time
-    }
-    channel_name_to_id_length -= len(channel_name_to_id)
+    channel_name_to_id_length = channel_name_to_id.remove_expired(current_time)
     if channel_name_to_id_length:
         logging.info(
             'YouTube: Cleaned %s items from channel name map',
             channel_name_to_id_length
         )
+    # Channel Items
+    channel_items_length = channel_items.remove_expired(current_time)
+    if channel_items_length:
+        logging.info(
+            'YouTube: Cleaned %s items from channel video lists',
+            channel_items_length
+        )
     # Space Check
     expired_time = time.time() - (audio_expiration_time / 1000)
     size_clean = False
-    for f in sorted(glob.glob('./audio/*mp3'), key=lambda a_file: os.path.getctime(a_file)):
+    for f in sorted(audio_files(), key=lambda a_file: os.path.getctime(a_file)):
         size = psutil.disk_usage('./audio')
         ctime = os.path.getctime(f)
         size_clean = size_clean or size.free < start_cleanup_size_threshold
@@ -181,81 +365,477 @@ def cleanup():
                 break
         else:
             break
+    count_audio_cache()
+
+def audio_name(video: str, audio_format: str = 'mp3', profile: str = None) -> str:
+    """
+    The name of the audio file of a video in ``./audio``, also the key of its conversion.
+    Profiles only apply to MP3, the other formats copy the audio track of the video.
+    """
+    if profile and audio_format == 'mp3':
+        return f'{video}.{profile}.{audio_format}'
+    return f'{video}.{audio_format}'
+
+def requested_profile(handler: web.RequestHandler) -> str:
+    """
+    The encoder profile requested with the profile query parameter.
+
+    Raises:
+        web.HTTPError: If the profile is unknown.
+
+    Returns:
+        str: The profile, or None if none is requested.
+    """
+    profile = handler.get_argument('profile', None)
+    if profile is not None and profile not in ENCODER_PROFILES:
+        raise web.HTTPError(400, reason='Unknown Profile')
+    return profile
+
+def audio_files() -> list:
+    """
+    The converted audio files in ``./audio``, of every format.
+    """
+    return [f for audio_format in AUDIO_FORMATS for f in glob.glob(f'./audio/*.{audio_format}')]
+
+def converted(key: str) -> bool:
+    """
+    Whether the audio of a conversion is in ``./audio``.
+    """
+    return os.path.exists(f'./audio/{key}')
+
+def audio_cache_size() -> int:
+    """
+    The size of the converted audio files in ``./audio`` in bytes, as last counted by
+    ``count_audio_cache`` plus the conversions finished since.
+    """
+    if audio_bytes is None:
+        count_audio_cache()
+    return audio_bytes
+
+def count_audio_cache():
+    """
+    Count the size of the converted audio files in ``./audio``. Runs with the cleanup, as
+    scanning the directory at every dispatch of a conversion would block the IOLoop.
+    """
+    global audio_bytes
+    size = 0
+    for f in audio_files():
+        try:
+            size += os.path.getsize(f)
+        except OSError:
+            # Deleted by the cleanup in the meantime
+            pass
+    audio_bytes = size
+
+def parse_window(window: str) -> tuple:
+    """
+    Parse an off-peak window like ``01:00-06:00``. The window may span midnight.
+
+    Args:
+        window (str): The window, or None.
+
+    Raises:
+        ValueError: If the window is malformed.
+
+    Returns:
+        tuple: The start and the end of the window as datetime.time, or None if no window is given.
+    """
+    if not window:
+        return None
+    start, end = window.split('-')
+    return datetime.time.fromisoformat(start.strip()), datetime.time.fromisoformat(end.strip())
+
+def in_window(window: tuple, now: datetime.time) -> bool:
+    """
+    Whether a time is within a window parsed by parse_window. Always true without a window.
+    """
+    if window is None:
+        return True
+    start, end = window
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+def parse_pinned(pinned: str) -> list:
+    """
+    Parse the comma separated list of pinned feeds, e.g. ``channel/UC.../audio,playlist/PL.../m4a``.
+    The feed type defaults to audio. Channels must be given by their id.
+
+    Args:
+        pinned (str): The pinned feeds.
+
+    Returns:
+        list: The feed kind (channel or playlist), id and feed type of each valid feed.
+    """
+    parsed = []
+    for feed in (feed.strip().strip('/') for feed in (pinned or '').split(',')):
+        if not feed:
+            continue
+        parts = feed.split('/')
+        if len(parts) == 2:
+            parts.append('audio')
+        if len(parts) != 3 or parts[0] not in ('channel', 'playlist') or parts[2] not in FEED_AUDIO_FORMATS:
+            logging.error( 'YouTube: Ignoring pinned feed %s, expected channel/<id>/<type> or playlist/<id>/<type>', feed )
+        elif parts[0] == 'channel' and not parts[1].startswith('UC'):
+            logging.error( 'YouTube: Ignoring pinned feed %s, channels must be given by their id', feed )
+        else:
+            parsed.append(tuple(parts))
+    return parsed
+
+def prefetch_allowed() -> bool:
+    """
+    Whether prefetched conversions may start: within the off-peak window, if any, while the
+    audio files stay below prefetch_max_bytes and before the cleanup would start deleting them.
+    """
+    if not in_window(prefetch_window, datetime.datetime.now().time()):
+        return False
+    if psutil.disk_usage('./audio').free < start_cleanup_size_threshold:
+        return False
+    return not prefetch_max_bytes or audio_cache_size() < prefetch_max_bytes
+
+def prefetch(videos: list, feed_type: str, profile: str = None) -> int:
+    """
+    Enqueue the conversions of the newest videos of an audio feed at autoload priority.
+
+    Args:
+        videos (list): The publication date and id of the videos, in the order of the feed.
+        feed_type (str): The feed type, audio, m4a or opus.
+        profile (str): The encoder profile of MP3s, or None for the default profile.
+
+    Returns:
+        int: The number of conversions enqueued.
+    """
+    enqueued = 0
+    # Stable, so videos published at the same time stay in the order of the feed
+    for _, video in sorted(videos, key=lambda video: video[0], reverse=True)[:prefetch_newest]:
+        audio = audio_name(video, FEED_AUDIO_FORMATS[feed_type], profile or audio_profile)
+        if not os.path.exists(f'./audio/{audio}'):
+            conversion_queue.enqueue(audio, conversion.PRIORITY_AUTOLOAD)
+            enqueued += 1
+    return enqueued
 
 @gen.coroutine
-def convert_videos():
+def prefetch_pinned():
     """
-    Asynchronous function to convert videos.
-    This function checks the conversion queue for pending videos, selects the next video to convert,
-    and then initiates the conversion process.
-    If an error occurs during the conversion, it handles the error and cleans up any temp files.
+    Enqueue the newest episodes of the pinned feeds. Costs one playlistItems call per feed,
+    so nothing is fetched while the API quota runs low.
     """
-    global conversion_queue
-    global converting_lock
-    if len(conversion_queue) == 0:
+    if youtube_api.quota_conserving():
+        logging.info( 'YouTube: Quota running low, not checking the pinned feeds' )
         return
-    try:
-        remaining = [
-            key
-            for key in conversion_queue.keys()
-            if not conversion_queue[key]['status']
+    for kind, feed_id, feed_type in pinned_feeds:
+        # The uploads of a channel are the playlist with the channel id behind UU
+        playlist = 'UU' + feed_id[2:] if kind == 'channel' else feed_id
+        payload = {
+            'part': 'snippet,contentDetails',
+            'maxResults': PLAYLIST_PAGE_SIZE,
+            'playlistId': playlist,
+            'key': key
+        }
+        request = yield youtube_api.get('playlistItems', payload, feed=f'{kind}/{feed_id}/{feed_type}')
+        if request.status_code != 200:
+            logging.error( 'YouTube: Error Downloading pinned %s %s: %s', kind, feed_id, request.reason )
+            continue
+        videos = [
+            (rss_writer.parse_date(item['snippet']['publishedAt']), item['contentDetails']['videoId'])
+            for item in request.json()['items']
+            if 'private' not in item['snippet']['title'].lower()
         ]
-        video = sorted(
-            remaining,
-            key=lambda v: conversion_queue[v]['added']
-        )[0]
-        conversion_queue[video]['status'] = True
-    except Exception:
-        return
-    with (yield converting_lock.acquire()):
-        logging.info( 'YouTube: Converting: %s', video )
-        audio_file = './audio/{}.mp3'.format(video)
+        enqueued = prefetch(videos, feed_type)
+        if enqueued:
+            logging.info( 'YouTube: Prefetching %s episodes of pinned %s %s', enqueued, kind, feed_id )
+
+def feed_suffix(feed_type: str, profile: str) -> str:
+    """
+    The suffix of the cache key of a feed rendered for an encoder profile.
+    """
+    if profile and FEED_AUDIO_FORMATS.get(feed_type) == 'mp3':
+        return f'?profile={profile}'
+    return ''
+
+def enclosure_links(handler: web.RequestHandler) -> dict:
+    """
+    What the enclosure URLs of a feed are made of: the protocol and host the feed was
+    requested with and the paths of the video and audio handlers. Plain values, so the
+    rebuilds kept for background refreshes do not hold on to the handler.
+
+    Args:
+        handler (web.RequestHandler): The handler of the feed request.
+
+    Returns:
+        dict: The ``base_url`` and the ``video_handler_path`` and ``audio_handler_path``.
+    """
+    return {
+        'base_url': f'{handler.request.protocol}://{handler.request.host}',
+        'video_handler_path': handler.video_handler_path,
+        'audio_handler_path': handler.audio_handler_path
+    }
+
+def video_enclosure(links: dict, video: str) -> tuple:
+    """
+    The enclosure of a video in a video feed.
+
+    Args:
+        links (dict): The parts of the enclosure URLs, see ``enclosure_links``.
+        video (str): The video id.
+
+    Returns:
+        tuple: The URL and the MIME type of the video.
+    """
+    return f'{links["base_url"]}{links["video_handler_path"]}{video}', 'video/mp4'
+
+def audio_enclosure(links: dict, video: str, feed_type: str, profile: str = None) -> tuple:
+    """
+    The enclosure of a video in an audio feed.
+
+    Args:
+        links (dict): The parts of the enclosure URLs, see ``enclosure_links``.
+        video (str): The video id.
+        feed_type (str): The feed type, one of ``FEED_AUDIO_FORMATS``.
+        profile (str): The encoder profile requested for the feed, or None.
+
+    Returns:
+        tuple: The URL and the MIME type of the audio. MP3 keeps the URL without extension.
+    """
+    audio_format = FEED_AUDIO_FORMATS[feed_type]
+    suffix = '' if audio_format == 'mp3' else f'.{audio_format}'
+    if profile and audio_format == 'mp3':
+        suffix += f'?profile={profile}'
+    url = f'{links["base_url"]}{links["audio_handler_path"]}{video}{suffix}'
+    return url, AUDIO_FORMATS[audio_format]['mime_type']
+
+def priority_command() -> list:
+    """
+    The command prefix lowering the CPU and I/O priority of a conversion, so it does not
+    slow down the requests served by the IOLoop. ``nice`` and ``ionice`` start ffmpeg with
+    the lower priority, which all its threads inherit.
+
+    Returns:
+        list: The prefix, empty where the tools are not available.
+    """
+    command = []
+    if convert_nice and shutil.which('nice'):
+        command += ['nice', '-n', str(convert_nice)]
+    if shutil.which('ionice'):
+        # -t runs ffmpeg anyway where the class is not supported or not permitted
+        if convert_ionice == 'idle':
+            command += ['ionice', '-t', '-c', '3']
+        elif convert_ionice == 'best-effort':
+            command += ['ionice', '-t', '-c', '2', '-n', '7']
+    return command
+
+def media_duration(url: str):
+    """
+    The duration of a stream in seconds, from the ``dur`` parameter of its googlevideo URL.
+
+    Returns:
+        float: The duration, or None if the URL does not tell.
+    """
+    try:
+        return float(parse_qs(urlparse(url).query)['dur'][0])
+    except (KeyError, ValueError):
+        return None
+
+@gen.coroutine
+def download_source(job, url: str, path: str):
+    """
+    Download the source stream of a conversion ahead of ffmpeg, with ``download_connections``
+    Range requests at a time, as YouTube throttles each connection.
+
+    Args:
+        job (conversion.ConversionJob): The conversion, which reports the download as its progress.
+        url (str): The URL of the source stream.
+        path (str): The file to download to.
+
+    Raises:
+        download.DownloadError: If the download failed or the job was cancelled.
+    """
+    def progress(downloaded, size):
+        job.progress['downloaded'] = downloaded
+        if size:
+            job.progress['download_size'] = size
+        job.progressed = datetime.datetime.now()
+    fetch = download.RangeDownload(url, path, download_connections, download_chunk_size, download_retries, progress)
+    job.stop = fetch.stop
+    started = time.monotonic()
+    try:
+        size = yield fetch.run()
+    finally:
+        job.stop = None
+    logging.info(
+        'YouTube: Downloaded %.1f MiB of %s in %.1f seconds',
+        size / 1048576, job.key, time.monotonic() - started
+    )
+
+@gen.coroutine
+def convert_video(job):
+    """
+    Convert a video to audio. Run by the ``conversion_queue`` workers.
+    MP3 is transcoded with the encoder profile in the key, if any. The other formats copy the
+    audio track of the source stream when there is one of the same codec. The source is
+    downloaded over several connections first, unless ``download_connections`` is 0 or a client
+    streams the audio while it is converted and should not wait for the whole download.
+    ffmpeg runs with at most ``convert_threads`` threads and at a lower priority than PodTube.
+    If an error occurs during the conversion, it handles the error and cleans up any temp files.
+
+    Args:
+        job (conversion.ConversionJob): The job, keyed by the name of the audio file.
+
+    Returns:
+        str: The result of the conversion, one of the ``conversion.RESULT_*`` values.
+    """
+    global audio_bytes
+    video, _, audio_format = job.key.partition('.')
+    profile, _, audio_format = audio_format.rpartition('.')
+    logging.info( 'YouTube: Converting: %s', job.key )
+    audio_file = './audio/{}'.format(job.key)
+    source_file = audio_file + '.source.temp'
+    spec = AUDIO_FORMATS[audio_format]
+    try:
+        link = yield get_youtube_link(video, audio=True)
+        if isinstance(link, Exception):
+            raise link
+        if job.cancelled is not None:
+            return conversion.RESULT_CANCELLED
+        source = link.get('sources', {}).get(spec['source'])
+        if source:
+            logging.info( 'YouTube: Copying the %s audio track of %s', spec['source'], video )
+            output = spec['copy']
+            source_bitrate = link.get('bitrates', {}).get(spec['source'])
+        else:
+            source = link['url']
+            output = ENCODER_PROFILES.get(profile, []) + spec['encode']
+            source_bitrate = link.get('bitrate')
+        job.duration = media_duration(source)
+        if source_bitrate:
+            job.progress['source_bitrate'] = source_bitrate
+        # Streaming clients get the first bytes sooner when ffmpeg reads from YouTube itself
+        streamed = progressive_audio and spec['progressive'] and job.priority < conversion.PRIORITY_AUTOLOAD
+        if download_connections and not streamed:
+            yield download_source(job, source, source_file)
+            source = source_file
+            if job.cancelled is not None:
+                return conversion.RESULT_CANCELLED
+        ffmpeg_process = process.Subprocess([
+            *priority_command(),
+            'ffmpeg',
+            '-loglevel', 'panic',
+            '-nostats',
+            '-progress', 'pipe:1',
+            '-y',
+            '-i', source,
+            '-threads', str(convert_threads),
+            *output, audio_file + '.temp'
+        ], stdout=process.Subprocess.STREAM)
+        job.stop = ffmpeg_process.proc.kill
+        yield [conversion.read_progress(job, ffmpeg_process.stdout), ffmpeg_process.wait_for_exit()]
+        os.rename(audio_file + '.temp', audio_file)
+        if audio_bytes is not None:
+            audio_bytes += os.path.getsize(audio_file)
+        logging.info( 'YouTube: Successfully converted: %s', job.key )
+        return conversion.RESULT_SUCCESS
+    except Exception as ex:
+        logging.error( 'YouTube: Error converting file: %s', ex )
+        result = conversion.RESULT_CANCELLED if job.cancelled else conversion.RESULT_FAILED
+        if isinstance(ex, (exceptions.LiveStreamError, exceptions.VideoUnavailable)):
+            mark_unavailable(video)
+            result = conversion.RESULT_UNAVAILABLE
         try:
-            yutubeUrl = get_youtube_url(video)
-            ffmpeg_process = process.Subprocess([
-                'ffmpeg',
-                '-loglevel', 'panic',
-                '-y',
-                '-i', yutubeUrl,
-                '-f', 'mp3', audio_file + '.temp'
-            ])
-            yield ffmpeg_process.wait_for_exit()
-            os.rename(audio_file + '.temp', audio_file)
-            logging.info( 'YouTube: Successfully converted: %s', video )
-        except Exception as ex:
-            logging.error( 'YouTube: Error converting file: %s', ex )
-            if isinstance(ex, (exceptions.LiveStreamError, exceptions.VideoUnavailable)):
-                if video not in video_links:
-                    video_links[video] = {
-                        'url': None,
-                        'expire': datetime.datetime.now() + datetime.timedelta(hours=6)
-                    }
-                video_links[video]['unavailable'] = True
-            try:
-                if os.path.exists(audio_file):
-                    os.remove(audio_file)
-            except Exception as ex2:
-                logging.error( 'YouTube: Error remove broken file: %s', ex2 )
-        finally:
-            del conversion_queue[video]
+            if os.path.exists(audio_file):
+                os.remove(audio_file)
+        except Exception as ex2:
+            logging.error( 'YouTube: Error remove broken file: %s', ex2 )
+        return result
+    finally:
+        job.stop = None
+        for temp_file in (audio_file + '.temp', source_file):
             try:
-                if os.path.exists(audio_file + '.temp'):
-                    os.remove(audio_file + '.temp')
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
             except Exception as ex2:
                 logging.error( 'YouTube: Error remove temp file: %s', ex2 )
 
-def get_youtube_url(video):
+def mark_unavailable(video: str):
+    """
+    Remember that a video cannot be converted, e.g. because it is a live stream, so
+    requests for its audio are refused without converting it again.
+    """
+    link = video_links.get(video) or {
+        'url': None,
+        'expire': datetime.datetime.now() + datetime.timedelta(hours=6)
+    }
+    if not link.get('unavailable'):
+        video_links[video] = dict(link, unavailable=True)
+
+@gen.coroutine
+def get_youtube_url(video, audio=False):
     """
     Function to get the YouTube URL for a given video.
+    The streams are resolved by pytubefix on the ``resolver_executor`` threads, at most
+    ``resolve_max_workers`` at a time. Concurrent requests for the same video share one resolution.
 
     Args:
     - video: The video ID for which the URL is needed.
+    - audio: Whether to get the best audio-only stream, for conversions, instead of
+      the progressive video stream. The two are cached separately.
+
+    Returns:
+    - The YouTube URL for the given video, or the exception raised while resolving it.
+    """
+    link = yield get_youtube_link(video, audio)
+    if isinstance(link, dict):
+        return link['url']
+    return link
+
+@gen.coroutine
+def get_youtube_link(video, audio=False):
+    """
+    Get the cached or freshly resolved link of a video stream.
+
+    Args:
+    - video: The video ID for which the link is needed.
+    - audio: Whether to get the best audio-only stream instead of the progressive video stream.
 
     Returns:
-    - The YouTube URL for the given video.
+    - The link, a dict with the stream ``url``, its ``expire`` time and for resolved streams
+      its ``itag`` and ``mime_type``, or the exception raised while resolving it. Audio links
+      also have the best audio-only stream of each MIME type in ``sources``.
     """
-    if video in video_links and video_links[video]['expire'] > datetime.datetime.now():
-        return video_links[video]['url']
+    links = audio_links if audio else video_links
+    if video in links and links[video]['expire'] > datetime.datetime.now():
+        return links[video]
+    link = yield video_resolutions.run(
+        f'{video}/audio' if audio else video,
+        lambda: ioloop.IOLoop.current().run_in_executor(resolver_executor, resolve_video_link, video, audio)
+    )
+    if isinstance(link, dict):
+        # Cached here, on the IOLoop thread, as the caches are not thread-safe
+        links[video] = link
+    return link
+
+def resolve_video_link(video, audio=False):
+    """
+    Resolve a stream of a video with pytubefix. Blocking, runs on a ``resolver_executor`` thread.
+
+    The video endpoint redirects to the highest resolution progressive stream. Conversions
+    use the audio-only stream with the highest bitrate (usually itag 251 or 140), which is
+    a fraction of the size and spares ffmpeg demuxing the picture.
+
+    Args:
+    - video: The video ID to resolve.
+    - audio: Whether to resolve the best audio-only stream.
+
+    Returns:
+    - The link, a dict with the stream ``url``, its ``expire`` time, ``itag``, ``mime_type`` and
+      ``bitrate``, or the exception raised while resolving it. Audio links also have the URL and
+      bitrate of the best audio-only stream of each MIME type in ``sources`` and ``bitrates``,
+      for copying the audio track.
+    """
+    # This can cause OOMs on lower spec'd servers.
+    # As such, run a garbage collection before
+    # running this function.
+    gc.collect()
+
     yturl = f"https://www.youtube.com/watch?v={video}"
     logging.debug( 'YouTube: Full URL: %s', yturl )
 
@@ -271,8 +851,21 @@ def get_youtube_url(video):
     try:
         logging.debug( 'YouTube: Stream count: %s', len(yt.streams) )
         try:
-            vid = yt.streams.get_highest_resolution().url
-            logging.debug( 'YouTube: Highest resultion URL: %s', vid )
+            stream = None
+            sources = {}
+            bitrates = {}
+            if audio:
+                # Ordered by bitrate, so each type ends up with its best stream and the loop
+                # ends on the best stream overall
+                for stream in yt.streams.filter(only_audio=True).order_by('abr'):
+                    sources[stream.mime_type] = stream.url
+                    bitrates[stream.mime_type] = stream.bitrate
+                if stream is None:
+                    logging.info( 'YouTube: No audio-only stream for %s, using the video stream', video )
+            if stream is None:
+                stream = yt.streams.get_highest_resolution()
+            vid = stream.url
+            logging.debug( 'YouTube: Stream %s (%s) URL: %s', stream.itag, stream.mime_type, vid )
         except Exception as e:
             logging.error( 'YouTube: Failed to get video URL: %s', e )
             return e
@@ -286,16 +879,21 @@ def get_youtube_url(video):
     }
     link = {
         'url': vid,
-        'expire': datetime.datetime.fromtimestamp(int(parts['expire']))
+        'expire': datetime.datetime.fromtimestamp(int(parts['expire'])),
+        'itag': stream.itag,
+        'mime_type': stream.mime_type,
+        'bitrate': stream.bitrate
     }
+    if sources:
+        link['sources'] = sources
+        link['bitrates'] = bitrates
 
     yt = None
     del yt
 
-    video_links[video] = link
-    return link['url']
+    return link
 
-class ChannelHandler(web.RequestHandler):
+class ChannelHandler(feeds.FeedHandler):
     """
     Handles HTTP requests for YouTube channel pages and video listings.
     
@@ -314,9 +912,10 @@ class ChannelHandler(web.RequestHandler):
         self.audio_handler_path = audio_handler_path
 
     @gen.coroutine
-    def head(self):
+    def head(self, channel):
         """
         Coroutine function to set header values for the specified channel.
+        The feed's validators and Content-Length are sent without the body.
 
         Args:
             self: The instance of the class.
@@ -325,8 +924,7 @@ class ChannelHandler(web.RequestHandler):
         Returns:
             None
         """
-        self.set_header('Content-type', 'application/rss+xml')
-        self.set_header('Accept-Ranges', 'bytes')
+        yield self.get(channel)
 
     @gen.coroutine
     def get(self, channel):
@@ -338,23 +936,60 @@ class ChannelHandler(web.RequestHandler):
         Return types:
             - None
         """
-        global key
         max_pages = self.get_argument('max', None)
         if max_pages:
             logging.info( 'YouTube: Will grab videos from a maximum of %s pages', max_pages )
 
+        profile = requested_profile(self)
         channel = channel.split('/')
         if len(channel) < 2:
             channel.append('video')
-        channel_name = ['/'.join(channel)]
-        self.set_header('Content-type', 'application/rss+xml')
-        if channel_name[0] in channel_feed and channel_feed[channel_name[0]]['expire'] > datetime.datetime.now():
-            self.write(channel_feed[channel_name[0]]['feed'])
-            self.finish()
-            return
-        fg = None
-        video = None
+        channel_name = '/'.join(channel) + feed_suffix(channel[1], profile)
+        links = enclosure_links(self)
+        rebuild = lambda: ChannelHandler.build_feed(channel, max_pages, profile, links)
+        feed = channel_refresher.get(channel_name, rebuild)
+        if feed is None:
+            try:
+                feed = yield channel_builds.run(channel_name, rebuild)
+            except web.HTTPError:
+                # Rather an outdated feed than none, e.g. once the API quota is spent
+                feed = channel_feed.get(channel_name)
+                if feed is not None:
+                    logging.warning( 'YouTube: Serving outdated feed of %s', channel_name )
+                elif youtube_api.quota_exhausted():
+                    self.set_status(503, reason='YouTube API Quota Exhausted')
+                    self.set_header('Retry-After', youtube_api.seconds_until_reset())
+                    self.finish()
+                    return
+                else:
+                    raise
+        self.write_feed(feed)
+
+    @staticmethod
+    @gen.coroutine
+    def build_feed(channel, max_pages, profile, links):
+        """
+        Download the channel and its uploads from the YouTube API, render the RSS feed and cache it.
+        Concurrent requests for the same channel share a single build.
+
+        Args:
+            channel (list): The channel id or username and the feed type (video, audio, m4a or opus).
+            max_pages (str): The maximum number of playlistItems pages to download, or None.
+            profile (str): The encoder profile of MP3 enclosures, or None.
+            links (dict): The parts of the enclosure URLs, see ``enclosure_links``.
+
+        Returns:
+            dict: The cached feed.
+        """
+        global key
+        # Resolving a username replaces it, the caller's list is kept for the next rebuild
+        channel = list(channel)
+        channel_name = ['/'.join(channel) + feed_suffix(channel[1], profile)]
+        videos = []
         calls = 0
+        if youtube_api.quota_exhausted():
+            raise api_error('Error Downloading Channel')
+        max_pages = quota_page_limit(max_pages)
         payload = {
             'part': 'snippet,contentDetails',
             'maxResults': 1,
@@ -363,11 +998,7 @@ class ChannelHandler(web.RequestHandler):
             'id': channel[0],
             'key': key
         }
-        request = requests.get(
-             'https://www.googleapis.com/youtube/v3/channels',
-             params=payload,
-             timeout=10
-        )
+        request = yield youtube_api.get('channels', payload, feed=channel_name[0])
         calls += 1
         if request.status_code != 200:
             payload = {
@@ -378,34 +1009,22 @@ class ChannelHandler(web.RequestHandler):
                 'forUsername': channel[0],
                 'key': key
             }
-            request = requests.get(
-                'https://www.googleapis.com/youtube/v3/channels',
-                params=payload,
-                timeout=10
-            )
+            request = yield youtube_api.get('channels', payload, feed=channel_name[0])
             calls += 1
         if request.status_code == 200:
             logging.debug( 'YouTube: Downloaded Channel Information' )
         else:
             logging.error( 'YouTube: Error Downloading Channel: %s', request.reason )
-            self.send_error(reason='Error Downloading Channel')
-            return
+            raise api_error('Error Downloading Channel')
         response = request.json()
         channel_data = response['items'][0]
         if channel[0] != channel_data['id']:
             channel[0] = channel_data['id']
-            channel_name.append('/'.join(channel))
+            channel_name.append('/'.join(channel) + feed_suffix(channel[1], profile))
         #get upload playlist
         channel_upload_list = channel_data['contentDetails']['relatedPlaylists']['uploads']
         channel_data = channel_data['snippet']
 
-        fg = FeedGenerator()
-        fg.load_extension('podcast')
-        fg.generator(
-            'PodTube (python-feedgen)',
-            __version__,
-            'https://github.com/amckee/PodTube'
-        )
         if 'title' not in channel_data:
             logging.info( 'YouTube: Channel title not found' )
             channel_data['title'] = channel[0]
@@ -418,33 +1037,26 @@ class ChannelHandler(web.RequestHandler):
             channel_data['thumbnails'],
             key=lambda x: channel_data['thumbnails'][x]['width']
         )
-        fg.title(channel_data['title'])
-        fg.id(f'{self.request.protocol}://{self.request.host}{self.request.uri}')
-        fg.description(channel_data['description'] or ' ')
-        fg.author(
-            name='Podtube',
-            email='armware+podtube@gmail.com',
-            uri='https://github.com/amckee/PodTube')
-        fg.podcast.itunes_author(channel_data['title'])
-        fg.image(channel_data['thumbnails'][icon]['url'])
-        fg.link(
-            href=f'https://www.youtube.com/channel/{channel[0]}',
-            rel='self'
+        writer = rss_writer.FeedWriter(
+            title=channel_data['title'],
+            link=f'https://www.youtube.com/channel/{channel[0]}',
+            description=channel_data['description'] or ' ',
+            image=channel_data['thumbnails'][icon]['url'],
+            author=channel_data['title'],
+            summary=channel_data['description'] or ' '
         )
-        fg.language('en-US')
-        fg.podcast.itunes_image(channel_data['thumbnails'][icon]['url'])
-        fg.podcast.itunes_explicit('no')
-        fg.podcast.itunes_owner(
-            name='Podtube',
-            email='armware+podtube@gmail.com'
-        )
-        fg.podcast.itunes_summary(channel_data['description'] or ' ')
-        fg.podcast.itunes_category(cat='Technology')
-        fg.updated(str(datetime.datetime.utcnow()) + 'Z')
 
         response = {'nextPageToken': ''}
-        page_count = item_count = 0
-        while 'nextPageToken' in response.keys():
+        page_count = 0
+        stored = channel_items.get(channel_upload_list)
+        if stored is not None and stored['expire'] > datetime.datetime.now() and (stored['complete'] or max_pages):
+            known_videos = {item['contentDetails']['videoId'] for item in stored['items']}
+        else:
+            stored = None
+            known_videos = set()
+        new_items = []
+        reached_known = False
+        while 'nextPageToken' in response.keys() and not reached_known:
             page_count += 1
             if max_pages and (page_count > int(max_pages)):
                 logging.info( 'YouTube: Reached maximum number of pages. Stopping here.' )
@@ -452,98 +1064,111 @@ class ChannelHandler(web.RequestHandler):
             next_page = response['nextPageToken']
             payload = {
                 'part': 'snippet,contentDetails',
-                'maxResults': 50,
+                'maxResults': PLAYLIST_PAGE_SIZE,
                 'playlistId': channel_upload_list,
                 'key': key,
                 'pageToken': next_page
             }
-            request = requests.get(
-                'https://www.googleapis.com/youtube/v3/playlistItems',
-                params=payload,
-                timeout=10
-            )
+            request = yield youtube_api.get('playlistItems', payload, feed=channel_name[0])
             calls += 1
-            response = request.json()
             if request.status_code == 200:
                 logging.debug( 'YouTube: Downloaded Channel Information' )
             else:
                 logging.error( 'YouTube: Error Downloading Channel: %s', request.reason )
-                self.send_error(reason='Error Downloading Channel')
-                return
+                raise api_error('Error Downloading Channel')
+            response = request.json()
             for item in response['items']:
-                snippet = item['snippet']
-                if 'private' in snippet['title'].lower():
-                    continue
-                current_video = item['contentDetails']['videoId']
-
-                try:
-                    chan=snippet['channelTitle']
-                except KeyError:
-                    snippet['channelTitle'] = snippet['channelId']
-                    logging.error( 'YouTube: Channel title not found' )
+                if item['contentDetails']['videoId'] in known_videos:
+                    reached_known = True
+                    break
+                new_items.append(item)
+                ChannelHandler.add_entry(writer, item, channel[1], videos, links, profile)
+        if reached_known:
+            logging.info( 'YouTube: Found %s new videos for channel %s', len(new_items), channel[0] )
+            known_items = stored['items']
+            if max_pages:
+                # No more than the pages would have held
+                known_items = known_items[:max(int(max_pages) * PLAYLIST_PAGE_SIZE - len(new_items), 0)]
+            for item in known_items:
+                ChannelHandler.add_entry(writer, item, channel[1], videos, links, profile)
+            stored['items'] = new_items + stored['items']
+        else:
+            stored = {
+                'items': new_items,
+                'complete': 'nextPageToken' not in response,
+                'expire': datetime.datetime.now() + CHANNEL_ITEMS_EXPIRATION
+            }
+        channel_items[channel_upload_list] = stored
 
-                logging.debug(
-                    'YouTube: ChannelVideo: %s (%s)',
-                    current_video,
-                    snippet['title']
-                )
-                fe = fg.add_entry()
-                item_count += 1
-                fe.title(snippet['title'])
-                fe.id(current_video)
-                icon = max(
-                    snippet['thumbnails'],
-                    key=lambda x: snippet['thumbnails'][x]['width'])
-                fe.podcast.itunes_image(snippet['thumbnails'][icon]['url'])
-                fe.updated(snippet['publishedAt'])
-                if channel[1] == 'video':
-                    fe.enclosure(
-                        url=f'{self.request.protocol}://{self.request.host}{self.video_handler_path}{current_video}',
-                        type="video/mp4"
-                    )
-                elif channel[1] == 'audio':
-                    fe.enclosure(
-                        url=f'{self.request.protocol}://{self.request.host}{self.audio_handler_path}{current_video}',
-                        type="audio/mpeg"
-                    )
-                fe.author(name=snippet['channelTitle'])
-                fe.podcast.itunes_author(snippet['channelTitle'])
-                fe.pubDate(snippet['publishedAt'])
-                fe.link(
-                    href=f'https://www.youtube.com/watch?v={current_video}',
-                    title=snippet['title']
-                )
-                fe.podcast.itunes_summary(snippet['description'])
-                fe.description(snippet['description'])
-                if video is None or video['expire'] < fe.pubDate():
-                    video = {'video': fe.id(), 'expire': fe.pubDate()}
-        feed = {
-            'feed': fg.rss_str(),
-            'expire': datetime.datetime.now() + datetime.timedelta(hours=calls)
-        }
+        feed = feeds.make_feed(
+            writer.rss_bytes(),
+            datetime.datetime.now() + datetime.timedelta(hours=calls),
+            channel_feed.get(channel_name[0])
+        )
         for chan in channel_name:
             channel_feed[chan] = feed
 
-        logging.info( "Got %s videos from %s pages", item_count, page_count )
-
-        self.write(feed['feed'])
-        self.finish()
+        logging.info( "Got %s videos from %s pages", len(writer), page_count )
 
         global autoload_newest_audio
-        if not autoload_newest_audio:
+        if autoload_newest_audio and channel[1] in FEED_AUDIO_FORMATS:
+            prefetch(videos, channel[1], profile)
+        return feed
+
+    @staticmethod
+    def add_entry(writer, item, feed_type, videos, links, profile=None):
+        """
+        Render an upload of the channel into the feed.
+
+        Args:
+            writer (rss_writer.FeedWriter): The feed being rendered.
+            item (dict): The playlistItems resource of the upload.
+            feed_type (str): The feed type, video, audio, m4a or opus.
+            videos (list): The publication date and id of the videos rendered so far,
+                the upload is appended to.
+            links (dict): The parts of the enclosure URLs, see ``enclosure_links``.
+            profile (str): The encoder profile of MP3 enclosures, or None.
+        """
+        snippet = item['snippet']
+        if 'private' in snippet['title'].lower():
             return
-        video_name = video['video']
-        mp3_file = f'audio/{video_name}.mp3'
-        if channel[1] == 'audio' and not os.path.exists(mp3_file) and video_name not in conversion_queue.keys():
-            conversion_queue[video_name] = {
-                'status': False,
-                'added': datetime.datetime.now()
-            }
+        current_video = item['contentDetails']['videoId']
+
+        if 'channelTitle' not in snippet:
+            snippet['channelTitle'] = snippet['channelId']
+            logging.error( 'YouTube: Channel title not found' )
+
+        logging.debug(
+            'YouTube: ChannelVideo: %s (%s)',
+            current_video,
+            snippet['title']
+        )
+        icon = max(
+            snippet['thumbnails'],
+            key=lambda x: snippet['thumbnails'][x]['width'])
+        enclosure_url = enclosure_type = None
+        if feed_type == 'video':
+            enclosure_url, enclosure_type = video_enclosure(links, current_video)
+        elif feed_type in FEED_AUDIO_FORMATS:
+            enclosure_url, enclosure_type = audio_enclosure(links, current_video, feed_type, profile)
+        published = rss_writer.parse_date(snippet['publishedAt'])
+        writer.add_entry(
+            guid=current_video,
+            title=snippet['title'],
+            link=f'https://www.youtube.com/watch?v={current_video}',
+            description=snippet['description'],
+            author=snippet['channelTitle'],
+            image=snippet['thumbnails'][icon]['url'],
+            published=published,
+            enclosure_url=enclosure_url,
+            enclosure_type=enclosure_type
+        )
+        videos.append((published, current_video))
 
     def data_received(self, chunk):
         pass
 
-class PlaylistHandler(web.RequestHandler):
+class PlaylistHandler(feeds.FeedHandler):
     """
     Handles HTTP requests for YouTube playlist processing.
     
@@ -574,54 +1199,77 @@ class PlaylistHandler(web.RequestHandler):
         Args:
             self: The instance of the class.
             playlist: The playlist for which the header is being set.
+                The feed's validators and Content-Length are sent without the body.
 
         Returns:
             None
         """
-        self.set_header('Content-type', 'application/rss+xml')
-        self.set_header('Accept-Ranges', 'bytes')
+        yield self.get(playlist)
 
     @gen.coroutine
     def get(self, playlist):
         """
         A coroutine function to fetch a playlist and generate an RSS feed.
         """
-        global key
+        profile = requested_profile(self)
         playlist = playlist.split('/')
         if len(playlist) < 2:
             playlist.append('video')
-        playlist_name = '/'.join(playlist)
-        self.set_header('Content-type', 'application/rss+xml')
-        if playlist_name in playlist_feed and playlist_feed[playlist_name]['expire'] > datetime.datetime.now():
-            self.write(playlist_feed[playlist_name]['feed'])
-            self.finish()
-            return
+        playlist_name = '/'.join(playlist) + feed_suffix(playlist[1], profile)
+        links = enclosure_links(self)
+        rebuild = lambda: PlaylistHandler.build_feed(playlist, profile, links)
+        feed = playlist_refresher.get(playlist_name, rebuild)
+        if feed is None:
+            try:
+                feed = yield playlist_builds.run(playlist_name, rebuild)
+            except web.HTTPError:
+                # Rather an outdated feed than none, e.g. once the API quota is spent
+                feed = playlist_feed.get(playlist_name)
+                if feed is not None:
+                    logging.warning( 'YouTube: Serving outdated feed of %s', playlist_name )
+                elif youtube_api.quota_exhausted():
+                    self.set_status(503, reason='YouTube API Quota Exhausted')
+                    self.set_header('Retry-After', youtube_api.seconds_until_reset())
+                    self.finish()
+                    return
+                else:
+                    raise
+        self.write_feed(feed)
+
+    @staticmethod
+    @gen.coroutine
+    def build_feed(playlist, profile, links):
+        """
+        Download the playlist from the YouTube API, render the RSS feed and cache it.
+        Concurrent requests for the same playlist share a single build.
+
+        Args:
+            playlist (list): The playlist id and the feed type (video, audio, m4a or opus).
+            profile (str): The encoder profile of MP3 enclosures, or None.
+            links (dict): The parts of the enclosure URLs, see ``enclosure_links``.
+
+        Returns:
+            dict: The cached feed.
+        """
+        global key
+        playlist_name = '/'.join(playlist) + feed_suffix(playlist[1], profile)
         calls = 0
+        if youtube_api.quota_exhausted():
+            raise api_error('Error Downloading Playlist')
+        max_pages = quota_page_limit(None)
         payload = {
             'part': 'snippet',
             'id': playlist[0],
             'key': key
         }
-        request = requests.get(
-            'https://www.googleapis.com/youtube/v3/playlists',
-            params=payload,
-            timeout=10
-        )
+        request = yield youtube_api.get('playlists', payload, feed=playlist_name)
         calls += 1
         if request.status_code == 200:
             logging.debug( 'YouTube: Downloaded Playlist Information' )
         else:
             logging.error( 'YouTube: Error Downloading Playlist: %s', request.reason )
-            self.send_error(reason='Error Downloading Playlist')
-            return
+            raise api_error('Error Downloading Playlist')
         response = request.json()
-        fg = FeedGenerator()
-        fg.load_extension('podcast')
-        fg.generator(
-            'PodTube (python-feedgen)',
-            __version__,
-            'https://github.com/amckee/PodTube'
-        )
         snippet = response['items'][0]['snippet']
         icon = max(
             snippet['thumbnails'],
@@ -632,53 +1280,37 @@ class PlaylistHandler(web.RequestHandler):
             playlist[0],
             snippet['title']
         )
-        fg.title(snippet['title'])
-        fg.id(f'{self.request.protocol}://{self.request.host}{self.request.uri}')
-        fg.description(snippet['description'] or ' ')
-        fg.author(
-            name='Podtube',
-            email='armware+podtube@gmail.com',
-            uri='https://github.com/amckee/PodTube'
-        )
-        fg.podcast.itunes_author(snippet['channelTitle'])
-        fg.image(snippet['thumbnails'][icon]['url'])
-        fg.link(
-            href=f'https://www.youtube.com/playlist/?list={playlist}',
-            rel='self'
+        writer = rss_writer.FeedWriter(
+            title=snippet['title'],
+            link=f'https://www.youtube.com/playlist/?list={playlist}',
+            description=snippet['description'] or ' ',
+            image=snippet['thumbnails'][icon]['url'],
+            author=snippet['channelTitle'],
+            summary=snippet['description']
         )
-        fg.language('en-US')
-        fg.podcast.itunes_image(snippet['thumbnails'][icon]['url'])
-        fg.podcast.itunes_explicit('no')
-        fg.podcast.itunes_owner(
-            name='Podtube',
-            email='armware+podtube@gmail.com'
-        )
-        fg.podcast.itunes_summary(snippet['description'])
-        fg.podcast.itunes_category(cat='Technology')
-        fg.updated(str(datetime.datetime.utcnow()) + 'Z')
-        video = None
+        videos = []
         response = {'nextPageToken': ''}
+        page_count = 0
         while 'nextPageToken' in response.keys():
+            page_count += 1
+            if max_pages and page_count > max_pages:
+                logging.info( 'YouTube: Reached maximum number of pages. Stopping here.' )
+                break
             payload = {
                 'part': 'snippet',
-                'maxResults': 50,
+                'maxResults': PLAYLIST_PAGE_SIZE,
                 'playlistId': playlist[0],
                 'key': key,
                 'pageToken': response['nextPageToken']
             }
-            request = requests.get(
-                'https://www.googleapis.com/youtube/v3/playlistItems',
-                params=payload,
-                timeout=10
-            )
+            request = yield youtube_api.get('playlistItems', payload, feed=playlist_name)
             calls += 1
-            response = request.json()
             if request.status_code == 200:
                 logging.debug( 'YouTube: Downloaded Playlist Information' )
             else:
                 logging.error( 'YouTube: Error Downloading Playlist: %s', request.reason )
-                self.send_error(reason='Error Downloading Playlist Items')
-                return
+                raise api_error('Error Downloading Playlist Items')
+            response = request.json()
             for item in response['items']:
                 snippet = item['snippet']
                 current_video = snippet['resourceId']['videoId']
@@ -689,57 +1321,39 @@ class PlaylistHandler(web.RequestHandler):
                     current_video,
                     snippet['title']
                 )
-                fe = fg.add_entry()
-                fe.title(snippet['title'])
-                fe.id(current_video)
                 icon = max(
                     snippet['thumbnails'],
                     key=lambda x: snippet['thumbnails'][x]['width']
                 )
-                fe.podcast.itunes_image(snippet['thumbnails'][icon]['url'])
-                fe.updated(snippet['publishedAt'])
-                final_url = None
+                final_url = enclosure_type = None
                 if playlist[1] == 'video':
-                    final_url = f'{self.request.protocol}://{self.request.host}{self.video_handler_path}{current_video}'
-                    fe.enclosure(
-                        url=final_url,
-                        type="video/mp4"
-                    )
-                elif playlist[1] == 'audio':
-                    final_url = f'{self.request.protocol}://{self.request.host}{self.audio_handler_path}{current_video}'
-                    fe.enclosure(
-                        url=final_url,
-                        type="audio/mpeg"
-                    )
+                    final_url, enclosure_type = video_enclosure(links, current_video)
+                elif playlist[1] in FEED_AUDIO_FORMATS:
+                    final_url, enclosure_type = audio_enclosure(links, current_video, playlist[1], profile)
                 logging.debug( 'YouTube: Final URL created for enclosure: %s', final_url )
-                fe.author(name=snippet['channelTitle'])
-                fe.podcast.itunes_author(snippet['channelTitle'])
-                fe.pubDate(snippet['publishedAt'])
-                fe.link(
-                    href=f'https://www.youtube.com/watch?v={current_video}',
-                    title=snippet['title']
+                published = rss_writer.parse_date(snippet['publishedAt'])
+                writer.add_entry(
+                    guid=current_video,
+                    title=snippet['title'],
+                    link=f'https://www.youtube.com/watch?v={current_video}',
+                    description=snippet['description'],
+                    author=snippet['channelTitle'],
+                    image=snippet['thumbnails'][icon]['url'],
+                    published=published,
+                    enclosure_url=final_url,
+                    enclosure_type=enclosure_type
                 )
-                fe.podcast.itunes_summary(snippet['description'])
-                fe.description(snippet['description'])
-                if not video or video['expire'] < fe.pubDate():
-                    video = {'video': fe.id(), 'expire': fe.pubDate()}
-        feed = {
-            'feed': fg.rss_str(),
-            'expire': datetime.datetime.now() + datetime.timedelta(hours=calls)
-        }
+                videos.append((published, current_video))
+        feed = feeds.make_feed(
+            writer.rss_bytes(),
+            datetime.datetime.now() + datetime.timedelta(hours=calls),
+            playlist_feed.get(playlist_name)
+        )
         playlist_feed[playlist_name] = feed
-        self.write(feed['feed'])
-        self.finish()
         global autoload_newest_audio
-        if not autoload_newest_audio:
-            return
-        video = video['video']
-        mp3_file = 'audio/{}.mp3'.format(video)
-        if playlist[1] == 'audio' and not os.path.exists(mp3_file) and video not in conversion_queue.keys():
-            conversion_queue[video] = {
-                'status': False,
-                'added': datetime.datetime.now()
-            }
+        if autoload_newest_audio and playlist[1] in FEED_AUDIO_FORMATS:
+            prefetch(videos, playlist[1], profile)
+        return feed
 
 class VideoHandler(web.RequestHandler):
     """
@@ -750,10 +1364,12 @@ class VideoHandler(web.RequestHandler):
     their content to audio or video formats.
     """
 
+    @gen.coroutine
     def get(self, video):
         """
         Get the video URL from YouTube using the provided video ID,
         and handle the redirection or error response accordingly.
+        The IOLoop keeps serving other requests while the streams are resolved.
 
         Parameters:
             video (str): The ID of the video to retrieve from YouTube.
@@ -763,12 +1379,7 @@ class VideoHandler(web.RequestHandler):
         """
         logging.info( 'YouTube: Getting Video: %s', video )
 
-        # This can cause OOMs on lower spec'd servers.
-        # As such, run a garbage collection before
-        # running this function.
-        gc.collect()
-
-        yt_url = get_youtube_url( video )
+        yt_url = yield get_youtube_url( video )
         if isinstance(yt_url, str):
             logging.debug( 'YouTube: Got video URL: %s', yt_url )
             self.redirect( yt_url )
@@ -824,11 +1435,16 @@ class AudioHandler(web.RequestHandler):
     their content to audio formats.
     """
 
+    # Seconds between two checks of the size of a file being converted while streaming it
+    FOLLOW_INTERVAL = 0.5
+
     def initialize(self):
         """
         Initialize the object.
         """
         self.disconnected = False
+        self.waiting = None
+        self.mime_type = AUDIO_FORMATS['mp3']['mime_type']
 
     @gen.coroutine
     def head(self, audio):
@@ -842,47 +1458,58 @@ class AudioHandler(web.RequestHandler):
         Returns:
             None
         """
+        _, _, audio_format = audio.partition('.')
         self.set_header('Accept-Ranges', 'bytes')
-        self.set_header("Content-Type", "audio/mpeg")
+        self.set_header("Content-Type", AUDIO_FORMATS.get(audio_format or 'mp3', AUDIO_FORMATS['mp3'])['mime_type'])
 
     @gen.coroutine
     def get(self, audio):
         """
         A coroutine function that handles the GET request for audio files. It checks if the requested audio is available and, if so, streams the audio content to the client. If the audio is not available or an error occurs during the conversion, appropriate status codes are set and returned.
+        The video id is followed by the extension of the audio format, e.g. ``.m4a``. Without one, MP3 is served,
+        encoded with the profile of the profile query parameter or the configured ``audio_profile``.
         """
         logging.info( 'YouTube: Audio: %s (%s)', audio, self.request.remote_ip )
+        audio, _, audio_format = audio.partition('.')
+        audio_format = audio_format or 'mp3'
+        if audio_format not in AUDIO_FORMATS:
+            self.set_status(404)
+            return
+        self.mime_type = AUDIO_FORMATS[audio_format]['mime_type']
+        profile = requested_profile(self) or audio_profile
         if audio in video_links and 'unavailable' in video_links[audio] and video_links[audio]['unavailable'] == True:
             # logging.info('Audio: %s is not available (%s)', audio, self.request.remote_ip)
             self.set_status(422) # Unprocessable Content. E.g. the video is a live stream
             return
-        mp3_file = './audio/{}.mp3'.format(audio)
-        if not os.path.exists(mp3_file):
-            if audio not in conversion_queue.keys():
-                conversion_queue[audio] = {
-                    'status': False,
-                    'added': datetime.datetime.now()
-                }
-            while audio in conversion_queue:
-                yield gen.sleep(0.5)
-                if self.disconnected:
-                    # logging.info('User was disconnected while requested audio: %s (%s)', audio, self.request.remote_ip)
-                    self.set_status(408)
+        audio_path = './audio/{}'.format(audio_name(audio, audio_format, profile))
+        if not os.path.exists(audio_path):
+            job = conversion_queue.enqueue(audio_name(audio, audio_format, profile), conversion.PRIORITY_INTERACTIVE)
+            self.waiting = (job, job.wait())
+            if progressive_audio and AUDIO_FORMATS[audio_format]['progressive']:
+                streamed = yield self.stream_conversion(audio_path + '.temp', self.waiting[1])
+                if streamed:
+                    job.cancel_wait(self.waiting[1], abandon=self.disconnected)
+                    self.waiting = None
                     return
+            result = yield self.waiting[1]
+            self.waiting = None
+            if result is None:
+                # logging.info('User was disconnected while requested audio: %s (%s)', audio, self.request.remote_ip)
+                self.set_status(408)
+                return
+            if result == conversion.RESULT_UNAVAILABLE:
+                # Also when a conversion worker found out, its video_links are not these
+                mark_unavailable(audio)
         if audio in video_links and 'unavailable' in video_links[audio] and video_links[audio]['unavailable'] == True:
             # logging.info('Audio: %s is not available (%s)', audio, self.request.remote_ip)
             self.set_status(422) # Unprocessable Content. E.g. the video is a live stream
             return
-        if not os.path.exists(mp3_file):
+        if not os.path.exists(audio_path):
             self.set_status(404) # An error occurred during the conversion and the file was not created
             return
-        request_range = None
-        range_header = self.request.headers.get("Range")
-        if range_header:
-            # As per RFC 2616 14.16, if an invalid Range header is specified,
-            # the request will be treated as if the header didn't exist.
-            request_range = httputil._parse_request_range(range_header)
-
-        size = os.stat(mp3_file).st_size
+        request_range = self.get_request_range()
+        size = os.stat(audio_path).st_size
+        content_range = None
         if request_range:
             start, end = request_range
             if (start is not None and start >= size) or end == 0:
@@ -890,7 +1517,7 @@ class AudioHandler(web.RequestHandler):
                 # the first requested byte is equal to or greater than the
                 # content, or when a suffix with length 0 is specified
                 self.set_status(416)  # Range Not Satisfiable
-                self.set_header("Content-Type", "audio/mpeg")
+                self.set_header("Content-Type", self.mime_type)
                 self.set_header("Content-Range", "bytes */%s" % (size,))
                 return
             if start is not None and start < 0:
@@ -905,10 +1532,8 @@ class AudioHandler(web.RequestHandler):
             # ``Range: bytes=0-``.
             if size != (end or size) - (start or 0):
                 self.set_status(206)  # Partial Content
-                self.set_header(
-                    "Content-Range",
-                    httputil._get_content_range(start, end, size)
-                )
+                content_range = httputil._get_content_range(start, end, size)
+                self.set_header("Content-Range", content_range)
         else:
             start = end = None
         if start is not None and end is not None:
@@ -919,10 +1544,13 @@ class AudioHandler(web.RequestHandler):
             content_length = size - start
         else:
             content_length = size
+        if self.sendfile_possible():
+            yield self.send_file(audio_path, start or 0, content_length, content_range)
+            return
         self.set_header("Accept-Ranges", "bytes")
         self.set_header("Content-Length", content_length)
-        self.set_header('Content-Type', 'audio/mpeg')
-        content = self.get_content(mp3_file, start, end)
+        self.set_header('Content-Type', self.mime_type)
+        content = self.get_content(audio_path, start, end)
         if isinstance(content, bytes):
             content = [content]
         for chunk in content:
@@ -932,6 +1560,174 @@ class AudioHandler(web.RequestHandler):
             except iostream.StreamClosedError:
                 return
 
+    @gen.coroutine
+    def wait_for_output(self, temp_file, waiter, size):
+        """
+        Wait until a running conversion has written more than ``size`` bytes.
+
+        Args:
+            temp_file (str): The file the conversion writes to.
+            waiter (Future): The wait for the conversion to finish.
+            size (int): The number of bytes to wait for.
+
+        Returns:
+            bool: True once the bytes are written, False if the conversion finished first.
+        """
+        while not waiter.done():
+            try:
+                if os.path.getsize(temp_file) > size:
+                    return True
+            except OSError:
+                pass
+            try:
+                yield gen.with_timeout(datetime.timedelta(seconds=self.FOLLOW_INTERVAL), waiter)
+            except gen.TimeoutError:
+                pass
+        return False
+
+    @gen.coroutine
+    def stream_conversion(self, temp_file, waiter):
+        """
+        Stream the audio while ffmpeg is still writing it, following the file as it grows.
+
+        Without a range, or with ``bytes=0-``, the whole file is streamed without a
+        Content-Length until the conversion finishes. A range is answered with the part
+        of it that is already written, with an unknown complete length. A range starting
+        beyond the written part waits for ffmpeg to get there. Suffix ranges need the
+        size of the file and wait for the conversion to finish.
+
+        Args:
+            temp_file (str): The file the conversion writes to.
+            waiter (Future): The wait for the conversion to finish.
+
+        Returns:
+            bool: True if the response was sent, False if it is up to the complete file.
+        """
+        start, end = self.get_request_range() or (None, None)
+        if start is not None and start < 0:
+            return False
+        ready = yield self.wait_for_output(temp_file, waiter, start or 0)
+        if not ready:
+            return False
+        try:
+            audio_file = open(temp_file, 'rb')
+        except FileNotFoundError:
+            # Finished and renamed in the meantime
+            return False
+        logging.info( 'YouTube: Streaming %s while converting (%s)', temp_file, self.request.remote_ip )
+        with audio_file:
+            self.set_header('Accept-Ranges', 'bytes')
+            self.set_header('Content-Type', self.mime_type)
+            if start or end is not None:
+                # The renamed or deleted file stays readable through the open file
+                written = os.fstat(audio_file.fileno()).st_size
+                start = start or 0
+                end = min(end or written, written)
+                self.set_status(206)
+                self.set_header('Content-Range', f'bytes {start}-{end - 1}/*')
+                self.set_header('Content-Length', end - start)
+                for chunk in self.read_chunks(audio_file, start, end):
+                    try:
+                        self.write(chunk)
+                        yield self.flush()
+                    except iostream.StreamClosedError:
+                        self.disconnected = True
+                        break
+                return True
+            finished = False
+            while True:
+                chunk = audio_file.read(1024 ** 2)
+                if chunk:
+                    try:
+                        self.write(chunk)
+                        yield self.flush()
+                    except iostream.StreamClosedError:
+                        self.disconnected = True
+                        return True
+                elif finished:
+                    break
+                elif waiter.done():
+                    # Read once more what was written between the last read and the end of ffmpeg
+                    finished = True
+                else:
+                    try:
+                        yield gen.with_timeout(datetime.timedelta(seconds=self.FOLLOW_INTERVAL), waiter)
+                    except gen.TimeoutError:
+                        pass
+        if waiter.result() is None:
+            # The client disconnected
+            return True
+        if waiter.result() != conversion.RESULT_SUCCESS:
+            # Do not let the client take the truncated file for the complete one
+            logging.warning( 'YouTube: Conversion of %s failed while streaming it', temp_file )
+            self.request.connection.close()
+        return True
+
+    def sendfile_possible(self) -> bool:
+        """
+        Whether the response can be sent with ``os.sendfile``: it is enabled, the platform
+        has it and the connection is a plain TCP connection, not TLS.
+        """
+        stream = getattr(self.request.connection, 'stream', None)
+        return (sendfile_audio and hasattr(os, 'sendfile') and isinstance(stream, iostream.IOStream)
+                and not isinstance(stream, iostream.SSLIOStream))
+
+    @gen.coroutine
+    def send_file(self, audio_path, start, length, content_range=None):
+        """
+        Send a range of a converted file with ``os.sendfile``, from the page cache straight
+        to the socket instead of reading it into Python in chunks. The connection is taken
+        over from Tornado for this, so it is closed after the response instead of kept alive,
+        which is why ``sendfile_audio`` is off by default.
+
+        Args:
+            audio_path (str): The file to send.
+            start (int): The first byte to send.
+            length (int): The number of bytes to send.
+            content_range (str): The Content-Range of a partial response, or None.
+        """
+        Path(audio_path).touch(exist_ok=True)
+        status = self.get_status()
+        head = [
+            f'HTTP/1.1 {status} {httputil.responses.get(status, "Unknown")}',
+            f'Server: TornadoServer/{tornado_version}',
+            f'Date: {httputil.format_timestamp(time.time())}',
+            f'Content-Type: {self.mime_type}',
+            'Accept-Ranges: bytes',
+            f'Content-Length: {length}',
+            'Connection: close'
+        ]
+        if content_range:
+            head.append(f'Content-Range: {content_range}')
+        with open(audio_path, 'rb') as audio_file:
+            stream = self.detach()
+            # A socket of its own, so Tornado no longer watches the connection
+            connection = stream.socket.dup()
+            stream.close()
+            connection.setblocking(False)
+            loop = asyncio.get_running_loop()
+            try:
+                yield loop.sock_sendall(connection, ('\r\n'.join(head) + '\r\n\r\n').encode('latin1'))
+                # sock_sendfile refuses to send nothing
+                if length:
+                    yield loop.sock_sendfile(connection, audio_file, start, length)
+            except OSError:
+                self.disconnected = True
+            finally:
+                connection.close()
+        self.application.log_request(self)
+
+    def get_request_range(self):
+        """
+        The requested range, or None if there is none or it is invalid.
+        """
+        range_header = self.request.headers.get("Range")
+        if range_header:
+            # As per RFC 2616 14.16, if an invalid Range header is specified,
+            # the request will be treated as if the header didn't exist.
+            return httputil._parse_request_range(range_header)
+        return None
+
     @classmethod
     def get_content(cls, abspath, start=None, end=None):
         """Retrieve the content of the requested resource which is located
@@ -950,32 +1746,52 @@ class AudioHandler(web.RequestHandler):
         """
         Path(abspath).touch(exist_ok=True)
         with open(abspath, "rb") as audio_file:
-            if start is not None:
-                audio_file.seek(start)
-            if end is not None:
-                remaining = end - (start or 0)
+            yield from cls.read_chunks(audio_file, start, end)
+
+    @staticmethod
+    def read_chunks(audio_file, start=None, end=None):
+        """
+        Read a range of an open file in chunks of 1MiB.
+
+        Args:
+            audio_file: The file, opened in binary mode.
+            start (int): The first byte to read, or None to read from the beginning.
+            end (int): The byte to stop at, or None to read to the end.
+
+        Yields:
+            bytes: The chunks.
+        """
+        if start is not None:
+            audio_file.seek(start)
+        if end is not None:
+            remaining = end - (start or 0)
+        else:
+            remaining = None
+        while True:
+            chunk_size = 1024 ** 2
+            if remaining is not None and remaining < chunk_size:
+                chunk_size = remaining
+            chunk = audio_file.read(chunk_size)
+            if chunk:
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
             else:
-                remaining = None
-            while True:
-                chunk_size = 1024 ** 2
-                if remaining is not None and remaining < chunk_size:
-                    chunk_size = remaining
-                chunk = audio_file.read(chunk_size)
-                if chunk:
-                    if remaining is not None:
-                        remaining -= len(chunk)
-                    yield chunk
-                else:
-                    if remaining is not None:
-                        assert remaining == 0
-                    return
+                if remaining is not None:
+                    assert remaining == 0
+                return
 
     def on_connection_close(self):
         """
-        Handle the event when the connection is closed. It sets the 'disconnected' attribute to True.
+        Handle the event when the connection is closed. It sets the 'disconnected' attribute to True
+        and stops waiting for a conversion. The conversion itself goes on, unless
+        ``convert_cancel_abandoned`` is set and nobody else waits for it.
         """
         logging.warning( 'YouTube: User quit during transcoding (%s)', self.request.remote_ip )
         self.disconnected = True
+        if self.waiting is not None:
+            job, waiter = self.waiting
+            job.cancel_wait(waiter)
 
     def data_received(self, chunk):
         pass
@@ -1001,6 +1817,7 @@ class UserHandler(web.RequestHandler):
         """
         self.channel_handler_path = channel_handler_path
 
+    @gen.coroutine
     def get_canonical(self, url):
         """
         Get the canonical URL from the given input URL.
@@ -1012,10 +1829,10 @@ class UserHandler(web.RequestHandler):
             str: The canonical URL if found, otherwise None.
         """
         logging.info( 'YouTube: Getting canonical for %s', url )
-        req = requests.get( url )
-        if req.status_code == 200:
+        req = yield httpclient.AsyncHTTPClient().fetch( url, raise_error=False )
+        if req.code == 200:
             from bs4 import BeautifulSoup
-            bs = BeautifulSoup( req.text, 'lxml' )
+            bs = BeautifulSoup( req.body, 'lxml' )
             can_url = None
 
             # loop through all links and find the canonical url
@@ -1032,9 +1849,11 @@ class UserHandler(web.RequestHandler):
             return can_url
         return None
 
+    @gen.coroutine
     def get_channel_token(self, username: str) -> str:
         """
         Get the channel token for the given username.
+        Concurrent lookups of the same username share a single request to YouTube.
 
         Args:
             username (str): The username for which the channel token is being retrieved.
@@ -1045,8 +1864,22 @@ class UserHandler(web.RequestHandler):
         global channel_name_to_id
         if username in channel_name_to_id and channel_name_to_id[username]['expire'] > datetime.datetime.now():
             return channel_name_to_id[username]['id']
+        channel_token = yield channel_token_lookups.run(username, lambda: self.lookup_channel_token(username))
+        return channel_token
+
+    @gen.coroutine
+    def lookup_channel_token(self, username: str) -> str:
+        """
+        Look up the channel token of the given username on YouTube and cache it.
+
+        Args:
+            username (str): The username for which the channel token is being retrieved.
+
+        Returns:
+            str: The channel token associated with the given username, or None if not found.
+        """
         yt_url = f"https://www.youtube.com/@{username}/about"
-        canon_url = self.get_canonical( yt_url )
+        canon_url = yield self.get_canonical( yt_url )
         logging.debug( 'Canonical url: %s', canon_url )
         if canon_url is None:
             return None
@@ -1058,6 +1891,7 @@ class UserHandler(web.RequestHandler):
         }
         return channel_token
 
+    @gen.coroutine
     def get(self, username):
         """
         A method to handle a Youtube channel by name and redirect to the corresponding URL.
@@ -1074,7 +1908,7 @@ class UserHandler(web.RequestHandler):
         if append_index > -1:
             append = username[append_index:]
             username = username[:append_index]
-        channel_token = self.get_channel_token(username)
+        channel_token = yield self.get_channel_token(username)
 
         if channel_token is None:
             logging.error( 'YouTube: Failed to get canonical URL of %s', username )
@@ -1089,6 +1923,22 @@ class UserHandler(web.RequestHandler):
     def data_received(self, chunk):
         pass
 
+class ConversionStatusHandler(web.RequestHandler):
+    """
+    Reports the queued, running and recently finished audio conversions as JSON,
+    with the progress ffmpeg reports for the running ones.
+    """
+
+    def get(self):
+        """
+        A method to handle GET requests and serve the state of the conversions.
+        """
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(conversion_queue.status())
+
+    def data_received(self, chunk):
+        pass
+
 class ClearCacheHandler(web.RequestHandler):
     """
     Handles HTTP requests for clearing various caches in the YouTube application.
@@ -1117,19 +1967,17 @@ class ClearCacheHandler(web.RequestHandler):
         """
         A function to handle clearing the cache for various video and playlist items.
         """
-        global video_links, playlist_feed, channel_feed, channel_name_to_id
-
         video_file = self.get_argument(ClearCacheHandler.VIDEO_FILES, ClearCacheHandler.NONE, True)
         video_link = self.get_argument(ClearCacheHandler.VIDEO_LINKS, ClearCacheHandler.NONE, True)
-        playlist_feed = self.get_argument(ClearCacheHandler.PLAYLIST_FEED, ClearCacheHandler.NONE, True)
-        channel_feed = self.get_argument(ClearCacheHandler.CHANNEL_FEED, ClearCacheHandler.NONE, True)
-        channel_name_to_id = self.get_argument(ClearCacheHandler.CHANNEL_NAME_TO_ID, ClearCacheHandler.NONE, True)
+        playlist = self.get_argument(ClearCacheHandler.PLAYLIST_FEED, ClearCacheHandler.NONE, True)
+        channel = self.get_argument(ClearCacheHandler.CHANNEL_FEED, ClearCacheHandler.NONE, True)
+        channel_name = self.get_argument(ClearCacheHandler.CHANNEL_NAME_TO_ID, ClearCacheHandler.NONE, True)
 
-        if any(element != ClearCacheHandler.NONE for element in [video_file, video_link, playlist_feed, channel_feed, channel_name_to_id]):
+        if any(element != ClearCacheHandler.NONE for element in [video_file, video_link, playlist, channel, channel_name]):
             logging.info( 'YouTube: Force clear cache started (%s)', self.request.remote_ip )
 
         if video_file == ClearCacheHandler.ALL:
-            for f in glob.glob('./audio/*mp3'):
+            for f in audio_files():
                 try:
                     os.remove(f)
                     logging.info( 'YouTube: Deleted %s', f )
@@ -1142,41 +1990,46 @@ class ClearCacheHandler(web.RequestHandler):
                 logging.info( 'YouTube: Deleted %s', f )
             except Exception as e:
                 logging.error( 'YouTube: Error remove file %s: %s', f, e )
+        if video_file != ClearCacheHandler.NONE:
+            count_audio_cache()
 
         if video_link == ClearCacheHandler.ALL:
             video_links_length = len(video_links)
-            video_links = {}
+            video_links.clear()
+            audio_links.clear()
             logging.info( 'YouTube: Cleaned %s items from video list', video_links_length )
         elif video_link != ClearCacheHandler.NONE:
+            if video_link in audio_links:
+                del audio_links[video_link]
             if video_link in video_links:
                 del video_links[video_link]
                 logging.info( 'YouTube: Cleaned 1 items from video list' )
 
-        if playlist_feed == ClearCacheHandler.ALL:
+        if playlist == ClearCacheHandler.ALL:
             playlist_feed_length = len(playlist_feed)
-            playlist_feed = {}
+            playlist_feed.clear()
             logging.info( 'YouTube: Cleaned %s items from playlist feeds', playlist_feed_length )
-        elif playlist_feed != ClearCacheHandler.NONE:
-            if playlist_feed in playlist_feed:
-                del playlist_feed[playlist_feed]
+        elif playlist != ClearCacheHandler.NONE:
+            if playlist in playlist_feed:
+                del playlist_feed[playlist]
                 logging.info( 'YouTube: Cleaned 1 items from playlist feeds' )
 
-        if channel_feed == ClearCacheHandler.ALL:
+        if channel == ClearCacheHandler.ALL:
             channel_feed_length = len(channel_feed)
-            channel_feed = {}
+            channel_feed.clear()
             logging.info( 'YouTube: Cleaned %s items from channel feeds', channel_feed_length )
-        elif channel_feed != ClearCacheHandler.NONE:
-            if channel_feed in channel_feed:
-                del channel_feed[channel_feed]
-                logging.info( 'YouTube: Cleaned 1 items from chann  el feeds' )
+        elif channel != ClearCacheHandler.NONE:
+            if channel in channel_feed:
+                del channel_feed[channel]
+                logging.info( 'YouTube: Cleaned 1 items from channel feeds' )
 
-        if channel_name_to_id == ClearCacheHandler.ALL:
+        if channel_name == ClearCacheHandler.ALL:
             channel_name_to_id_length = len(channel_name_to_id)
-            channel_name_to_id = {}
+            channel_name_to_id.clear()
             logging.info( 'YouTube: Cleaned %s items from channel name map', channel_name_to_id_length )
-        elif channel_name_to_id != ClearCacheHandler.NONE:
-            if channel_name_to_id in channel_name_to_id:
-                del channel_name_to_id[channel_name_to_id]
+        elif channel_name != ClearCacheHandler.NONE:
+            if channel_name in channel_name_to_id:
+                del channel_name_to_id[channel_name]
                 logging.info( 'YouTube: Cleaned 1 items from channel name map' )
 
         self.write(f'<html><head><title>PodTube (v{__version__}) cache</title>')
@@ -1226,7 +2079,7 @@ class ClearCacheHandler(web.RequestHandler):
         self.write(f"<select id='{ClearCacheHandler.VIDEO_FILES}' name='{ClearCacheHandler.VIDEO_FILES}'>")
         self.write(f"<option value='{ClearCacheHandler.NONE}' selected>{ClearCacheHandler.NONE}</option>")
         self.write(f"<option value='{ClearCacheHandler.ALL}'>{ClearCacheHandler.ALL}</option>")
-        for f in sorted(glob.glob('./audio/*mp3'), key=lambda a_file: os.path.getctime(a_file)):
+        for f in sorted(audio_files(), key=lambda a_file: os.path.getctime(a_file)):
             size = os.path.getsize(f)
             if size > 10**12:
                 size = str(size // 2**40) + 'TiB'
@@ -0,0 +1,227 @@
+"""
+Non-blocking client for the YouTube Data API v3.
+
+All calls go through an AsyncHTTPClient of their own so that paginated feed builds
+never block the IOLoop. When pycurl is installed the curl based client is used,
+which keeps connections to the API host alive between pages. Other HTTP clients of
+the process are left as they are.
+
+Every call is booked in a quota ledger, per endpoint, per feed and per quota day.
+The API quota resets at midnight Pacific Time. Once fewer than ``quota_reserve`` units
+are left the handlers conserve quota, and once the budget is spent no more calls are made.
+"""
+import datetime
+import json
+import logging
+from urllib.parse import urlencode
+
+import pytz
+from tornado import httpclient, ioloop
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+import cache
+import utils
+
+API_URL = 'https://www.googleapis.com/youtube/v3/'
+QUOTA_TIMEZONE = pytz.timezone('America/Los_Angeles')
+# Units charged per call. List calls cost 1 unit, search is the expensive exception.
+UNIT_COSTS = {
+    'search': 100
+}
+
+api_url = API_URL
+request_timeout = 10
+daily_quota = 10000
+quota_reserve = 1000
+max_connections = 10
+# The client of the API calls and the IOLoop it belongs to
+client = None
+
+# Usage by quota day
+ledger = cache.PersistentDict('youtube_quota')
+
+utils.stats['youtube_quota'] = {
+    'day': None,
+    'daily_quota': daily_quota,
+    'used': 0,
+    'remaining': daily_quota,
+    'conserving': False,
+    'endpoints': {},
+    'feeds': {}
+}
+
+class ApiResponse:
+    """
+    Result of an API call. Mirrors the parts of ``requests.Response`` used by the handlers.
+    """
+    def __init__(self, status_code: int, reason: str, body: bytes = b''):
+        self.status_code = status_code
+        self.reason = reason
+        self.body = body
+
+    def json(self):
+        """
+        Decode the response body as JSON.
+        """
+        return json.loads(self.body)
+
+def init(max_clients: int = 10, quota: int = 10000, reserve: int = 1000):
+    """
+    Configure the AsyncHTTPClient used for API calls and the quota budget.
+
+    Args:
+        max_clients (int): The maximum number of simultaneous API requests.
+        quota (int): The daily quota of the API key. In units.
+        reserve (int): The number of units left at which quota is conserved.
+
+    Returns:
+        None
+    """
+    global daily_quota, quota_reserve, max_connections, client
+    daily_quota = quota
+    quota_reserve = reserve
+    max_connections = max_clients
+    if client is not None:
+        client.close()
+        client = None
+    update_stats()
+
+def http_client() -> httpclient.AsyncHTTPClient:
+    """
+    Get the client of the API calls, created for the current IOLoop. It is the curl
+    based client when pycurl is installed, and Tornado's simple client otherwise.
+    """
+    global client
+    if client is not None and client.io_loop is not ioloop.IOLoop.current():
+        client.close()
+        client = None
+    if client is None:
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient # pylint: disable=import-outside-toplevel
+            client = CurlAsyncHTTPClient(force_instance=True, max_clients=max_connections)
+        except ImportError:
+            logging.info( 'YouTube: pycurl not found, API connections will not be reused' )
+            client = SimpleAsyncHTTPClient(force_instance=True, max_clients=max_connections)
+    return client
+
+def quota_day() -> str:
+    """
+    Get the quota day the API is currently counting.
+    """
+    return datetime.datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+def seconds_until_reset() -> int:
+    """
+    Get the number of seconds until the quota resets.
+    """
+    now = datetime.datetime.now(QUOTA_TIMEZONE)
+    midnight = QUOTA_TIMEZONE.localize(datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time()))
+    return max(int((midnight - now).total_seconds()), 1)
+
+def usage() -> dict:
+    """
+    Get the ledger entry of the current quota day.
+
+    Returns:
+        dict: The used ``units``, the units by ``endpoints`` and by ``feeds``, and
+            whether the API reported the quota as ``exhausted``.
+    """
+    day = quota_day()
+    entry = ledger.get(day)
+    if entry is None:
+        entry = {
+            'units': 0,
+            'endpoints': {},
+            'feeds': {},
+            'exhausted': False,
+            'expire': datetime.datetime.now() + datetime.timedelta(seconds=seconds_until_reset())
+        }
+    return entry
+
+def record(endpoint: str, feed: str = None, exhausted: bool = False):
+    """
+    Book an API call in the ledger.
+
+    Args:
+        endpoint (str): The endpoint that was called.
+        feed (str): The feed the call was made for, if any.
+        exhausted (bool): Whether the API answered that the quota is exhausted.
+    """
+    entry = usage()
+    units = UNIT_COSTS.get(endpoint, 1)
+    entry['units'] += units
+    entry['endpoints'][endpoint] = entry['endpoints'].get(endpoint, 0) + units
+    if feed is not None:
+        entry['feeds'][feed] = entry['feeds'].get(feed, 0) + units
+    entry['exhausted'] = entry['exhausted'] or exhausted
+    ledger[quota_day()] = entry
+    update_stats()
+
+def remaining() -> int:
+    """
+    Get the number of quota units left today.
+    """
+    entry = usage()
+    if entry['exhausted']:
+        return 0
+    return max(daily_quota - entry['units'], 0)
+
+def quota_conserving() -> bool:
+    """
+    Check whether the quota is running low and feeds should be built as rarely as possible.
+    """
+    return remaining() <= quota_reserve
+
+def quota_exhausted() -> bool:
+    """
+    Check whether the quota is spent and no API calls can be made.
+    """
+    return remaining() <= 0
+
+def update_stats():
+    """
+    Publish today's usage in ``utils.stats``.
+    """
+    entry = usage()
+    utils.stats['youtube_quota'].update({
+        'day': quota_day(),
+        'daily_quota': daily_quota,
+        'used': entry['units'],
+        'remaining': remaining(),
+        'conserving': quota_conserving(),
+        'endpoints': entry['endpoints'],
+        'feeds': entry['feeds']
+    })
+
+async def get(endpoint: str, params: dict, feed: str = None) -> ApiResponse:
+    """
+    Perform a GET request against an API endpoint and book it in the quota ledger.
+
+    Args:
+        endpoint (str): The endpoint name, e.g. ``playlistItems``.
+        params (dict): The query parameters of the request.
+        feed (str): The feed the request is made for, if any.
+
+    Returns:
+        ApiResponse: The response. Network failures are reported with status code 599,
+            calls refused because the quota is exhausted with status code 403.
+    """
+    if quota_exhausted():
+        logging.warning( 'YouTube: Quota exhausted, not requesting %s', endpoint )
+        return ApiResponse(403, 'Quota Exhausted')
+    url = api_url + endpoint + '?' + urlencode(params)
+    try:
+        response = await http_client().fetch(
+            url,
+            request_timeout=request_timeout,
+            raise_error=False
+        )
+    except Exception as ex:
+        logging.error( 'YouTube: Error requesting %s: %s', endpoint, ex )
+        return ApiResponse(599, str(ex))
+    if response.code == 599:
+        return ApiResponse(599, response.reason, b'')
+    exhausted = response.code == 403 and b'quotaExceeded' in (response.body or b'')
+    if exhausted:
+        logging.warning( 'YouTube: The API reports the daily quota as exhausted' )
+    record(endpoint, feed, exhausted)
+    return ApiResponse(response.code, response.reason, response.body or b'')